@@ -0,0 +1,133 @@
+"""Правила уведомлений: компиляция условий конфига в одну функцию отбора предложений.
+
+Правило - словарь условий, объединенных через И, список правил - через ИЛИ:
+
+    "alerts": [
+        {"bonus_percent": {"min": 30}, "price": {"max": 20000}},
+        {"any": [{"title": "iphone"}, {"merchant": "^Мегамаркет"}], "price_bonus": [null, 50000]}
+    ]
+
+Диапазоны полей `price`, `price_bonus`, `bonus_amount`, `bonus_percent`, `quantity` задаются
+как {"min": x, "max": y} или [x, y], границы включены, null - без границы.
+`title` и `merchant` - регулярные выражения, ищутся в названии товара и имени продавца без учета регистра.
+`all` и `any` - вложенные списки правил через И и ИЛИ, `not` - отрицание правила.
+"""
+
+import math
+import re
+from typing import Callable
+
+from .exceptions import ConfigError
+from .models import ParsedOffer
+
+RANGE_FIELDS = {
+    "price": "offer.price",
+    "price_bonus": "offer.price_bonus",
+    "bonus_amount": "offer.bonus_amount",
+    "bonus_percent": "offer.bonus_percent",
+    "quantity": "(offer.available_quantity or 0)",
+}
+TEXT_FIELDS = {
+    "title": "offer.title",
+    "merchant": "offer.merchant_name",
+}
+
+AlertRule = Callable[[list[ParsedOffer]], list[bool]]
+
+
+class _RuleCompiler:
+    """Перевод правил в выражение Python, регулярные выражения передаются через пространство имен"""
+
+    def __init__(self):
+        self.namespace: dict[str, re.Pattern] = {}
+
+    def _number(self, field: str, value) -> float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ConfigError(f'Граница "{field}" должна быть числом, а не {value!r}')
+        try:
+            number = float(value)
+        except OverflowError:
+            number = math.inf
+        # inf и nan не записываются в выражение правила литералами
+        if not math.isfinite(number):
+            raise ConfigError(f'Граница "{field}" должна быть конечным числом, а не {value!r}')
+        return number
+
+    def _range(self, field: str, bounds) -> str:
+        if isinstance(bounds, dict):
+            unknown = bounds.keys() - {"min", "max"}
+            if unknown:
+                raise ConfigError(f'Неизвестные ключи диапазона "{field}": {", ".join(sorted(unknown))}')
+            low, high = bounds.get("min"), bounds.get("max")
+        elif isinstance(bounds, list) and len(bounds) == 2:
+            low, high = bounds
+        else:
+            raise ConfigError(f'Диапазон "{field}" задается как {{"min": x, "max": y}} или [x, y]')
+        conditions = []
+        if low is not None:
+            conditions.append(f"{RANGE_FIELDS[field]} >= {self._number(field, low)!r}")
+        if high is not None:
+            conditions.append(f"{RANGE_FIELDS[field]} <= {self._number(field, high)!r}")
+        return " and ".join(conditions) or "True"
+
+    def _text(self, field: str, pattern) -> str:
+        if not isinstance(pattern, str):
+            raise ConfigError(f'Условие "{field}" должно быть строкой регулярного выражения')
+        try:
+            compiled = re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            raise ConfigError(f'Неверное выражение "{pattern}": {e}') from e
+        name = f"pattern_{len(self.namespace)}"
+        self.namespace[name] = compiled
+        return f"{name}.search({TEXT_FIELDS[field]}) is not None"
+
+    def _rules(self, rules, operator: str) -> str:
+        if not isinstance(rules, list) or not rules:
+            raise ConfigError("Список правил не должен быть пустым")
+        return "(" + f" {operator} ".join(self.rule(rule) for rule in rules) + ")"
+
+    def rule(self, rule) -> str:
+        if not isinstance(rule, dict) or not rule:
+            raise ConfigError(f"Правило уведомлений должно быть непустым словарем условий, а не {rule!r}")
+        conditions = []
+        for field, value in rule.items():
+            if field in RANGE_FIELDS:
+                conditions.append(self._range(field, value))
+            elif field in TEXT_FIELDS:
+                conditions.append(self._text(field, value))
+            elif field == "all":
+                conditions.append(self._rules(value, "and"))
+            elif field == "any":
+                conditions.append(self._rules(value, "or"))
+            elif field == "not":
+                conditions.append(f"not {self.rule(value)}")
+            else:
+                raise ConfigError(f'Неизвестное условие правила уведомлений "{field}"')
+        return "(" + " and ".join(conditions) + ")"
+
+
+def compile_rules(rules: list | dict) -> AlertRule:
+    """Скомпилировать правила в функцию, которая отмечает подходящие предложения списка"""
+    compiler = _RuleCompiler()
+    expression = compiler._rules(rules if isinstance(rules, list) else [rules], "or")
+    code = compile(f"lambda offers: [{expression} for offer in offers]", "<alerts>", "eval")
+    return eval(code, {"__builtins__": {}, **compiler.namespace})
+
+
+def threshold_rules(
+    price_value_alert: float | None = None,
+    price_bonus_value_alert: float | None = None,
+    bonus_value_alert: float | None = None,
+    bonus_percent_alert: float | None = None,
+) -> list[dict]:
+    """Правила из порогов -price-value-alert, -price-bonus-value-alert, -bonus-value-alert и -bonus-percent-alert"""
+    rules = []
+    if price_value_alert:
+        rules.append({"price": {"max": price_value_alert}})
+    if price_bonus_value_alert:
+        rules.append({"price_bonus": {"max": price_bonus_value_alert}})
+    if bonus_value_alert:
+        rules.append({"bonus_amount": {"min": bonus_value_alert}})
+    if bonus_percent_alert:
+        rules.append({"bonus_percent": {"min": bonus_percent_alert}})
+    return rules
@@ -0,0 +1,204 @@
+"""Планировщик соединений"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+from collections import deque
+from time import time
+from typing import Any, Callable, Iterable
+
+from curl_cffi import CurlInfo
+
+from .models import Connection
+from . import db_utils
+
+
+class ConnectionPool:
+    """Пул `Соединений` для потоков.
+
+    Свободные соединения хранятся в min-heap по `Connection.sort_key` под condition variable,
+    так что из доступных раньше выбираются более быстрые соединения.
+    `acquire` ждет ровно до момента, когда освободится ближайшее соединение,
+    `release` сразу будит ожидающий поток. Обе операции O(log n).
+    """
+
+    def __init__(self, connections: Iterable[Connection]):
+        self.connections: list[Connection] = list(connections)
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.heap: list[tuple[float, int, Connection]] = [(connection.sort_key, next(self.counter), connection) for connection in self.connections]
+        heapq.heapify(self.heap)
+
+    def acquire(self) -> Connection:
+        """Дождаться и занять ближайшее доступное `Соединение`"""
+        with self.condition:
+            while True:
+                timeout = None
+                if self.heap:
+                    sort_key, _, connection = self.heap[0]
+                    if connection.sort_key > sort_key:
+                        # время соединения изменилось после попадания в кучу
+                        heapq.heapreplace(self.heap, (connection.sort_key, next(self.counter), connection))
+                        continue
+                    timeout = connection.usable_at - time()
+                    if timeout <= 0:
+                        heapq.heappop(self.heap)
+                        connection.busy = True
+                        return connection
+                self.condition.wait(timeout)
+
+    def quarantine(self, connection: Connection) -> bool:
+        """Отложить занятое `Соединение` до конца его карантина, если остается другое соединение не в карантине.
+
+        Последнее доступное соединение в карантин не уходит, иначе `acquire` ждал бы до конца карантина.
+        """
+        with self.condition:
+            now = time()
+            if any(other is not connection and other.quarantined_until <= now for other in self.connections):
+                connection.usable_at = connection.quarantined_until
+                return True
+            connection.quarantined_until = 0
+            return False
+
+    def release(self, connection: Connection) -> None:
+        """Вернуть `Соединение` в пул"""
+        with self.condition:
+            connection.busy = False
+            heapq.heappush(self.heap, (connection.sort_key, next(self.counter), connection))
+            self.condition.notify()
+
+
+class AsyncConnectionPool:
+    """Пул `Соединений` для asyncio движка, с той же логикой что и `ConnectionPool`"""
+
+    def __init__(self, connections: Iterable[Connection]):
+        self.connections: list[Connection] = list(connections)
+        self.counter = itertools.count()
+        self.heap: list[tuple[float, int, Connection]] = [(connection.sort_key, next(self.counter), connection) for connection in self.connections if not connection.busy]
+        heapq.heapify(self.heap)
+        self.waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> Connection:
+        """Дождаться и занять ближайшее доступное `Соединение`"""
+        while True:
+            timeout = None
+            if self.heap:
+                sort_key, _, connection = self.heap[0]
+                if connection.sort_key > sort_key:
+                    heapq.heapreplace(self.heap, (connection.sort_key, next(self.counter), connection))
+                    continue
+                timeout = connection.usable_at - time()
+                if timeout <= 0:
+                    heapq.heappop(self.heap)
+                    connection.busy = True
+                    return connection
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait((waiter,), timeout=timeout)
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # пробуждение досталось отмененной задаче, передаем его следующей
+                    self._wake_next()
+                raise
+            finally:
+                if not waiter.done():
+                    waiter.cancel()
+                    self.waiters.remove(waiter)
+
+    def release(self, connection: Connection) -> None:
+        """Вернуть `Соединение` в пул"""
+        connection.busy = False
+        heapq.heappush(self.heap, (connection.sort_key, next(self.counter), connection))
+        self._wake_next()
+
+    def _wake_next(self) -> None:
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
+class SessionPool:
+    """Долгоживущие http сессии, по одной на `Соединение`.
+
+    Сессия соединения используется только тем, кто занял соединение в пуле,
+    поэтому TLS и HTTP/2 соединения к серверу остаются открытыми между запросами через один прокси.
+    """
+
+    def __init__(self, session_factory: Callable[[Connection], Any]):
+        self.session_factory = session_factory
+        self.sessions: dict[Connection, Any] = {}
+        self.lock = threading.Lock()
+
+    def get(self, connection: Connection) -> Any:
+        """Сессия `Соединения`, создается при первом обращении"""
+        session = self.sessions.get(connection)
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(connection)
+                if session is None:
+                    session = self.sessions[connection] = self.session_factory(connection)
+        return session
+
+    @staticmethod
+    def count_handshakes(connection: Connection, response) -> None:
+        """Учесть новые соединения к серверу, открытые для запроса"""
+        connection.handshake_count += (getattr(response, "infos", None) or {}).get(CurlInfo.NUM_CONNECTS, 0)
+
+    def close(self) -> None:
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+    async def aclose(self) -> None:
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
+def load_connection_stats(connections: list[Connection]) -> None:
+    """Начать со статистики, накопленной соединениями в прошлых запусках.
+
+    Незакончившийся карантин переносится, но одно соединение, с самым коротким карантином, всегда остается доступным.
+    """
+    proxy_stats = db_utils.load_proxy_stats()
+    for connection in connections:
+        stats = proxy_stats.get(connection.proxy_string or "")
+        if stats:
+            connection.load_stats(stats)
+    now = time()
+    quarantined = [connection for connection in connections if connection.quarantined_until > now]
+    if quarantined and len(quarantined) == len(connections):
+        least_bad = min(quarantined, key=lambda obj: (obj.quarantined_until, obj.error_rate))
+        least_bad.quarantined_until = 0
+        quarantined.remove(least_bad)
+    for connection in quarantined:
+        connection.usable_at = max(connection.usable_at, connection.quarantined_until)
+
+
+def save_connection_stats(connections: Iterable[Connection], db_writer: db_utils.DbWriter, logger: logging.Logger) -> None:
+    """Сохранить статистику соединений, вывести сводку и обнулить счетчики запросов"""
+    connections = sorted(connections, key=lambda obj: (obj.error_rate, obj.latency))
+    for connection in connections:
+        db_utils.save_proxy_stats(db_writer, connection.proxy_string, connection.stats())
+        if connection.success_count or connection.throttle_count or connection.error_count:
+            logger.info(
+                "Соединение %s: %.2f запр/с (интервал %.2f с), задержка %.2f с, успешных запросов %s, слишком частых %s, ошибок %s, новых соединений %s",
+                connection.proxy_string or "прямое",
+                connection.rate,
+                connection.interval,
+                connection.latency,
+                connection.success_count,
+                connection.throttle_count,
+                connection.error_count,
+                connection.handshake_count,
+            )
+    requests_total = sum(connection.success_count + connection.throttle_count + connection.error_count for connection in connections)
+    handshakes_total = sum(connection.handshake_count for connection in connections)
+    logger.info("Новых соединений к серверу: %s на %s запросов", handshakes_total, requests_total)
+    for connection in connections:
+        connection.reset_counters()
@@ -0,0 +1,223 @@
+"""Режим демона: много задач по расписанию в одном процессе"""
+
+import concurrent.futures
+import inspect
+import logging
+import os
+import signal
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+
+from rich.logging import RichHandler
+
+from .models import Connection
+from .connection_pool import ConnectionPool, SessionPool, load_connection_stats, save_connection_stats
+from .exceptions import ConfigError
+from .parser_url import Parser_url
+from . import db_utils, utils
+
+DEFAULT_JOB_INTERVAL = 60  # минут
+STATS_SAVE_INTERVAL = 600  # секунд
+FORCED_EXIT_CODE = 130  # код выхода после повторного Ctrl-C, как у прерванного SIGINT процесса
+# параметры соединений задаются демону, а не отдельным задачам
+CONNECTION_KEYS = ("proxy", "proxy_file_path", "allow_direct", "delay")
+PARSER_KEYS = set(inspect.signature(Parser_url.__init__).parameters) - {"self", "connection_pool", "session_pool", "db_writer", "show_progress", *CONNECTION_KEYS}
+
+
+@dataclass
+class DaemonJob:
+    config_path: Path
+    config: dict
+    interval: float
+    priority: int = 0
+    parser: Parser_url | None = None
+    next_run: float = 0
+    running: bool = False
+    runs: int = 0
+
+    @property
+    def name(self) -> str:
+        return self.config.get("job_name") or self.config_path.stem
+
+
+class Daemon:
+    """Запуск задач из папки конфигов по расписанию.
+
+    Все задачи работают через один `ConnectionPool`, одни http сессии и один писатель БД,
+    настройка, профиль и адрес каждой задачи выполняются один раз при старте демона.
+    Готовые к запуску задачи запускаются по приоритету, не более `max_jobs` одновременно,
+    одна задача никогда не запускается повторно, пока не завершен ее прошлый запуск.
+    """
+
+    def __init__(
+        self,
+        config_dir: str,
+        proxy: str = "",
+        proxy_file_path: str = "",
+        allow_direct: bool = False,
+        delay: float | None = None,
+        max_jobs: int = 2,
+        log_level: str = "INFO",
+    ):
+        self.config_dir = Path(config_dir)
+        self.proxy = proxy
+        self.proxy_file_path = proxy_file_path
+        self.allow_direct = allow_direct
+        self.delay = delay or 1.8
+        self.max_jobs = max_jobs
+        self.log_level = log_level
+        logging.basicConfig(
+            level=log_level,
+            format="%(message)s",
+            datefmt="%H:%M:%S",
+            handlers=[RichHandler(rich_tracebacks=True)],
+        )
+        self.logger = logging.getLogger("rich")
+
+        self.connections: list[Connection] = []
+        self.connection_pool: ConnectionPool | None = None
+        self.session_pools: dict[str, SessionPool] = {}
+        self.db_writer = db_utils.DbWriter()
+        self.jobs: list[DaemonJob] = []
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.stats_saved_at = time()
+
+    def _connections_set_up(self) -> None:
+        """Общие соединения всех задач, со статистикой прошлых запусков"""
+        proxies = [self.proxy] if self.proxy else sorted(utils.parse_proxy_file(self.proxy_file_path)) if self.proxy_file_path else []
+        for proxy in proxies:
+            if not utils.proxy_format_check(proxy):
+                raise ConfigError(f"Прокси {proxy} не верного формата!")
+        self.connections = [Connection(proxy, self.delay) for proxy in proxies]
+        if not self.connections or self.allow_direct:
+            self.connections.append(Connection(None, self.delay))
+        db_utils.create_db()
+        load_connection_stats(self.connections)
+        self.connection_pool = ConnectionPool(self.connections)
+
+    def _load_jobs(self) -> None:
+        """Прочитать конфиги задач и создать для каждой парсер"""
+        config_paths = sorted(self.config_dir.glob("*.json"))
+        if not config_paths:
+            raise ConfigError(f"В папке {self.config_dir} нет конфигов!")
+        for config_path in config_paths:
+            try:
+                config = utils.read_json_file(config_path)
+            except Exception as exc:
+                raise ConfigError(f"Ошибка чтения конфига {config_path}!") from exc
+            job = DaemonJob(config_path, config, float(config.get("interval") or DEFAULT_JOB_INTERVAL) * 60, int(config.get("priority") or 0))
+            if config.get("engine", "threads") != "threads":
+                raise ConfigError(f"{config_path}: в режиме демона поддерживается только движок threads, уберите \"engine\" из конфига")
+            ignored_keys = [key for key in CONNECTION_KEYS if key in config]
+            if ignored_keys:
+                self.logger.warning("%s: %s задаются демону, значения из конфига задачи не используются", job.name, ", ".join(ignored_keys))
+            job.parser = self._create_parser(config)
+            self.jobs.append(job)
+            self.logger.info("Задача %s: каждые %.0f мин, приоритет %s", job.name, job.interval / 60, job.priority)
+
+    def _create_parser(self, config: dict) -> Parser_url:
+        cookie_file_path = config.get("cookie_file_path") or ""
+        session_pool = self.session_pools.get(cookie_file_path)
+        parser = Parser_url(
+            **{key: value for key, value in config.items() if key in PARSER_KEYS},
+            connection_pool=self.connection_pool,
+            session_pool=session_pool,
+            db_writer=self.db_writer,
+            # несколько индикаторов прогресса rich не могут работать одновременно
+            show_progress=self.max_jobs == 1,
+        )
+        if session_pool is None:
+            # сессии задач с одними cookie общие
+            self.session_pools[cookie_file_path] = parser.session_pool
+            parser.owns_session_pool = False
+        return parser
+
+    def _run_job(self, job: DaemonJob) -> None:
+        started_at = time()
+        try:
+            if self.stopping.is_set():
+                # демон остановлен, пока задача ждала свободный поток
+                return
+            job.parser.parse()
+        except Exception:
+            self.logger.exception("Задача %s завершилась с ошибкой", job.name)
+        finally:
+            job.runs += 1
+            job.next_run = max(started_at + job.interval, time())
+            job.running = False
+            self.logger.info("Задача %s: следующий запуск через %.0f мин", job.name, max(0, job.next_run - time()) / 60)
+            self.wake.set()
+
+    def _start_due_jobs(self, executor: concurrent.futures.ThreadPoolExecutor) -> None:
+        """Запустить готовые задачи в порядке приоритета, пока есть свободные места"""
+        if self.stopping.is_set():
+            return
+        now = time()
+        free_slots = self.max_jobs - sum(job.running for job in self.jobs)
+        due_jobs = sorted((job for job in self.jobs if not job.running and job.next_run <= now), key=lambda job: (-job.priority, job.next_run))
+        for job in due_jobs[: max(0, free_slots)]:
+            job.running = True
+            # остановка прошлого запуска сбрасывается здесь, а не в parse, чтобы не отменить остановку демона
+            job.parser.stop_event.clear()
+            executor.submit(self._run_job, job)
+
+    def _time_to_next_job(self) -> float:
+        """Сколько ждать до следующего запуска, без свободных мест - до завершения одной из задач"""
+        waiting = [job.next_run for job in self.jobs if not job.running]
+        if not waiting or sum(job.running for job in self.jobs) >= self.max_jobs:
+            return STATS_SAVE_INTERVAL
+        return min(max(0, min(waiting) - time()), STATS_SAVE_INTERVAL)
+
+    def _save_connection_stats(self) -> None:
+        save_connection_stats(self.connections, self.db_writer, self.logger)
+        self.stats_saved_at = time()
+
+    def _stop_jobs(self, executor: concurrent.futures.ThreadPoolExecutor) -> bool:
+        """Мягко остановить выполняемые задачи и дождаться начатых страниц, повторный Ctrl-C - не ждать.
+        Вернуть False, если задачи не дождались"""
+        self.logger.info("Остановка демона: дожидаемся начатых страниц, повторный Ctrl-C - выход сразу")
+        self.stopping.set()
+        for job in self.jobs:
+            if job.running:
+                job.parser.stop()
+        try:
+            executor.shutdown(wait=True, cancel_futures=True)
+        except KeyboardInterrupt:
+            return False
+        return True
+
+    def _shutdown(self) -> None:
+        self.logger.info("Остановка демона")
+        self._save_connection_stats()
+        self.db_writer.close()
+        for session_pool in self.session_pools.values():
+            session_pool.close()
+
+    def run(self) -> None:
+        """Метод запуска демона"""
+        self._connections_set_up()
+        self._load_jobs()
+        # парсеры ставят свой обработчик Ctrl-C, демон останавливает задачи сам
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs)
+        try:
+            while True:
+                self.wake.clear()
+                self._start_due_jobs(executor)
+                if time() - self.stats_saved_at > STATS_SAVE_INTERVAL:
+                    self._save_connection_stats()
+                self.wake.wait(self._time_to_next_job())
+        except KeyboardInterrupt:
+            stopped = self._stop_jobs(executor)
+            # очередь записи БД дописывается до конца, следующие Ctrl-C ее не прерывают
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            try:
+                self._shutdown()
+            finally:
+                if not stopped:
+                    # после повторного Ctrl-C потоки задач еще работают, завершаем процесс сразу
+                    self.logger.warning("Демон остановлен принудительно, начатые страницы не дописаны")
+                    os._exit(FORCED_EXIT_CODE)
@@ -1,25 +1,302 @@
 import sqlite3
 import datetime
+import json
+import logging
+import threading
+import queue
+from time import monotonic, perf_counter
+
+from .metrics import Histogram
+
+logger = logging.getLogger("rich")
 
 FILENAME = "storage.sqlite"
+WRITER_BATCH_SIZE = 500
+WRITER_FLUSH_INTERVAL = 1.0
+MERCHANT_INN_TTL = 30 * 86400  # ИНН продавца практически не меняется
+
+
+OFFER_COLUMNS = """goods_id,merchant_id,price,price_bonus,bonus_amount,
+        bonus_percent,available_quantity,delivery_date,
+        merchant_name,merchant_rating,scraped_at,notified"""
+
+
+def _create_job_view(cursor: sqlite3.Cursor, job_name: str, job_id: int) -> None:
+    """Представление с данными перенесенной таблицы задачи из старых версий, в прежнем формате"""
+    cursor.execute(f"""
+        CREATE VIEW IF NOT EXISTS "{job_name}_{job_id}" AS
+        SELECT
+            offers.goods_id, offers.merchant_id, goods.url, goods.title,
+            offers.price, offers.price_bonus, offers.bonus_amount, offers.bonus_percent,
+            offers.available_quantity, offers.delivery_date, offers.merchant_name,
+            offers.merchant_rating, offers.scraped_at, offers.notified
+        FROM offers JOIN goods ON goods.goods_id = offers.goods_id
+        WHERE offers.job_id = {int(job_id)};
+    """)
+
+
+def _migrate_unified_offers(cursor: sqlite3.Cursor) -> None:
+    """Общая таблица offers вместо таблицы на каждую задачу"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "goods" (
+            "goods_id"              TEXT PRIMARY KEY,
+            "title"                 TEXT,
+            "url"                   TEXT,
+            "image_url"             TEXT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "offers" (
+            "id"                    INTEGER PRIMARY KEY,
+            "job_id"                INTEGER NOT NULL REFERENCES jobs(id),
+            "goods_id"              TEXT NOT NULL REFERENCES goods(goods_id),
+            "merchant_id"           TEXT,
+            "price"                 INTEGER,
+            "price_bonus"           INTEGER,
+            "bonus_amount"          INTEGER,
+            "bonus_percent"         INTEGER,
+            "available_quantity"    INTEGER,
+            "delivery_date"         TEXT,
+            "merchant_name"         TEXT,
+            "merchant_rating"       FLOAT,
+            "scraped_at"            DATETIME,
+            "notified"              BOOL
+        );
+    """)
+    cursor.execute('CREATE INDEX IF NOT EXISTS "offers_job" ON offers (job_id, goods_id, merchant_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "offers_goods_merchant" ON offers (goods_id, merchant_id, scraped_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "offers_notified" ON offers (goods_id, merchant_id, price, bonus_amount, scraped_at) WHERE notified = 1')
+
+    cursor.execute("SELECT id, name FROM jobs")
+    for job_id, job_name in cursor.fetchall():
+        table = f"{job_name}_{job_id}"
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        if not cursor.fetchone():
+            continue
+        cursor.execute(f"""
+            INSERT OR IGNORE INTO goods (goods_id, title, url)
+            SELECT goods_id, title, url FROM "{table}" WHERE goods_id IS NOT NULL
+        """)
+        cursor.execute(f"""
+            INSERT INTO offers (job_id, {OFFER_COLUMNS})
+            SELECT ?, {OFFER_COLUMNS} FROM "{table}" WHERE goods_id IS NOT NULL
+        """, (job_id,))
+        cursor.execute(f'SELECT COUNT(*) FROM "{table}" WHERE goods_id IS NULL')
+        orphan_rows = cursor.fetchone()[0]
+        if orphan_rows:
+            # в offers нельзя без товара, строки сохраняются в отдельной таблице
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS "legacy_orphan_offers" (
+                    "job_id"                INTEGER NOT NULL,
+                    "url"                   TEXT,
+                    "title"                 TEXT,
+                    {OFFER_COLUMNS}
+                );
+            """)
+            cursor.execute(f"""
+                INSERT INTO legacy_orphan_offers (job_id, url, title, {OFFER_COLUMNS})
+                SELECT ?, url, title, {OFFER_COLUMNS} FROM "{table}" WHERE goods_id IS NULL
+            """, (job_id,))
+            logger.warning("Таблица %s: %s строк без goods_id перенесены в legacy_orphan_offers", table, orphan_rows)
+        cursor.execute(f'DROP TABLE "{table}"')
+        _create_job_view(cursor, job_name, job_id)
+
+
+def _migrate_notifications(cursor: sqlite3.Cursor) -> None:
+    """Отдельная таблица истории уведомлений"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "notifications" (
+            "goods_id"              TEXT NOT NULL,
+            "merchant_id"           TEXT NOT NULL,
+            "price"                 INTEGER NOT NULL,
+            "bonus_amount"          INTEGER NOT NULL,
+            "notified_at"           DATETIME NOT NULL,
+            PRIMARY KEY (goods_id, merchant_id, price, bonus_amount)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute('CREATE INDEX IF NOT EXISTS "notifications_notified_at" ON notifications (notified_at)')
+    cursor.execute("""
+        INSERT OR REPLACE INTO notifications (goods_id, merchant_id, price, bonus_amount, notified_at)
+        SELECT goods_id, merchant_id, price, bonus_amount, MAX(scraped_at) FROM offers
+        WHERE notified = 1 AND merchant_id IS NOT NULL AND price IS NOT NULL AND bonus_amount IS NOT NULL
+        GROUP BY goods_id, merchant_id, price, bonus_amount
+    """)
+
+
+def _migrate_proxy_stats(cursor: sqlite3.Cursor) -> None:
+    """Статистика прокси между запусками"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "proxy_stats" (
+            "proxy"                 TEXT PRIMARY KEY,
+            "interval"              FLOAT,
+            "updated_at"            DATETIME
+        );
+    """)
+
+
+def _migrate_proxy_health(cursor: sqlite3.Cursor) -> None:
+    """Здоровье прокси между запусками"""
+    for column, column_type in (
+        ("latency", "FLOAT"),
+        ("error_rate", "FLOAT"),
+        ("throttle_rate", "FLOAT"),
+        ("requests", "INTEGER"),
+        ("errors", "INTEGER"),
+        ("throttles", "INTEGER"),
+        ("quarantine_level", "INTEGER"),
+        ("quarantined_until", "FLOAT"),
+    ):
+        cursor.execute(f'ALTER TABLE proxy_stats ADD COLUMN "{column}" {column_type}')
+
+
+def _migrate_merchants(cursor: sqlite3.Cursor) -> None:
+    """Кэш ИНН продавцов"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "merchants" (
+            "merchant_id"           TEXT PRIMARY KEY,
+            "inn"                   TEXT,
+            "fetched_at"            DATETIME
+        );
+    """)
+
+
+def _migrate_offer_state(cursor: sqlite3.Cursor) -> None:
+    """Текущее состояние предложений для режима хранения только изменений"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "offer_state" (
+            "job_name"              TEXT NOT NULL,
+            "goods_id"              TEXT NOT NULL,
+            "merchant_id"           TEXT NOT NULL,
+            "price"                 INTEGER,
+            "price_bonus"           INTEGER,
+            "bonus_amount"          INTEGER,
+            "bonus_percent"         INTEGER,
+            "available_quantity"    INTEGER,
+            "delivery_date"         TEXT,
+            "merchant_name"         TEXT,
+            "merchant_rating"       FLOAT,
+            "first_seen"            DATETIME,
+            "changed_at"            DATETIME,
+            "disappeared_at"        DATETIME,
+            PRIMARY KEY (job_name, goods_id, merchant_id)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        CREATE VIEW IF NOT EXISTS "current_offers" AS
+        SELECT offer_state.*, goods.url, goods.title
+        FROM offer_state JOIN goods ON goods.goods_id = offer_state.goods_id
+        WHERE offer_state.disappeared_at IS NULL;
+    """)
+
+
+def _migrate_listing_state(cursor: sqlite3.Cursor) -> None:
+    """Данные товара в выдаче на момент последнего запроса его предложений, для инкрементального режима"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "listing_state" (
+            "job_name"              TEXT NOT NULL,
+            "goods_id"              TEXT NOT NULL,
+            "price"                 INTEGER,
+            "bonus_amount"          INTEGER,
+            "offer_count"           INTEGER,
+            "offers_fetched_at"     DATETIME,
+            PRIMARY KEY (job_name, goods_id)
+        ) WITHOUT ROWID;
+    """)
+
+
+def _migrate_api_cache(cursor: sqlite3.Cursor) -> None:
+    """Кэш ответов api редко меняющихся эндпоинтов"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "api_cache" (
+            "key"                   TEXT PRIMARY KEY,
+            "response"              TEXT NOT NULL,
+            "expires_at"            FLOAT NOT NULL
+        ) WITHOUT ROWID;
+    """)
+
+
+def _migrate_page_checkpoints(cursor: sqlite3.Cursor) -> None:
+    """Спаршенные страницы незавершенных задач, для продолжения с -resume"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS "page_checkpoints" (
+            "job_id"                INTEGER NOT NULL REFERENCES jobs(id),
+            "offset"                INTEGER NOT NULL,
+            "parse_next"            BOOL NOT NULL,
+            "completed_at"          DATETIME,
+            PRIMARY KEY (job_id, offset)
+        ) WITHOUT ROWID;
+    """)
+
+
+def _migrate_page_limit(cursor: sqlite3.Cursor) -> None:
+    """Размер страницы в отметках, чтобы продолжать задачу с теми же offset"""
+    cursor.execute('ALTER TABLE page_checkpoints ADD COLUMN "page_limit" INTEGER')
+
+
+def _migrate_page_checkpoint_shards(cursor: sqlite3.Cursor) -> None:
+    """Диапазон цен в ключе отметок страниц, для парсинга по диапазонам цен"""
+    cursor.execute("""
+        CREATE TABLE "page_checkpoints_new" (
+            "job_id"                INTEGER NOT NULL REFERENCES jobs(id),
+            "shard"                 TEXT NOT NULL DEFAULT '',
+            "offset"                INTEGER NOT NULL,
+            "parse_next"            BOOL NOT NULL,
+            "completed_at"          DATETIME,
+            "page_limit"            INTEGER,
+            PRIMARY KEY (job_id, shard, offset)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        INSERT INTO page_checkpoints_new (job_id, "offset", parse_next, completed_at, page_limit)
+        SELECT job_id, "offset", parse_next, completed_at, page_limit FROM page_checkpoints
+    """)
+    cursor.execute('DROP TABLE "page_checkpoints"')
+    cursor.execute('ALTER TABLE "page_checkpoints_new" RENAME TO "page_checkpoints"')
+
+
+# Миграции схемы по порядку, номер версии схемы = индекс миграции + 1 (PRAGMA user_version)
+MIGRATIONS = [
+    _migrate_unified_offers,
+    _migrate_notifications,
+    _migrate_proxy_stats,
+    _migrate_proxy_health,
+    _migrate_merchants,
+    _migrate_offer_state,
+    _migrate_listing_state,
+    _migrate_api_cache,
+    _migrate_page_checkpoints,
+    _migrate_page_limit,
+    _migrate_page_checkpoint_shards,
+]
 
 
 def create_db():
+    """Создать БД или обновить схему существующей"""
     sqlite_connection = sqlite3.connect(FILENAME)
     cursor = sqlite_connection.cursor()
 
     cursor.execute("""
-            CREATE TABLE "jobs" (
+            CREATE TABLE IF NOT EXISTS "jobs" (
             "id"	                INTEGER PRIMARY KEY AUTOINCREMENT,
             "name"	                TEXT,
             "started"	            DATETIME,
             "completed"	            DATETIME
-	        
         );
     """)
-
     sqlite_connection.commit()
+
+    schema_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS[schema_version:], start=schema_version + 1):
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version}")
+        except Exception:
+            sqlite_connection.rollback()
+            raise
+        sqlite_connection.commit()
     cursor.close()
+    sqlite_connection.close()
 
 
 def new_job(job_name):
@@ -33,35 +310,74 @@ def new_job(job_name):
         (job_name, now),
     )
     job_id = cursor.lastrowid
-    cursor.execute(f"""
-        CREATE TABLE "{job_name}_{job_id}" (
-            "goods_id"              TEXT,
-            "merchant_id"           TEXT,
-            "url"	                TEXT,
-            "title"                 TEXT,
-            "price"	                INTEGER,
-            "price_bonus"           INTEGER,
-            "bonus_amount"	        INTEGER,
-            "bonus_percent"	        INTEGER,
-            "available_quantity"    INTEGER,
-            "delivery_date"         TEXT,
-            "merchant_name"         TEXT,
-            "merchant_rating"       FLOAT,
-            "scraped_at"	        DATETIME,
-            "notified"              BOOL
-        );
-    """)
     sqlite_connection.commit()
     return job_id
 
 
+def load_unfinished_job(job_name: str) -> int | None:
+    """ID последнего незавершенного запуска задачи"""
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute("SELECT id FROM jobs WHERE name = ? AND completed IS NULL ORDER BY id DESC LIMIT 1", (job_name,))
+    row = cursor.fetchone()
+    cursor.close()
+    sqlite_connection.close()
+    return row[0] if row else None
+
+
+def load_page_checkpoints(job_id: int) -> dict[tuple[str, int], bool]:
+    """Спаршенные страницы запуска задачи: (диапазон цен, offset) - есть ли товары в наличии на следующих страницах"""
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute('SELECT shard, "offset", parse_next FROM page_checkpoints WHERE job_id = ?', (job_id,))
+    page_checkpoints = {(shard, offset): bool(parse_next) for shard, offset, parse_next in cursor}
+    cursor.close()
+    sqlite_connection.close()
+    return page_checkpoints
+
+
+def load_page_limit(job_id: int) -> int | None:
+    """Размер страницы, с которым парсился запуск задачи"""
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute("SELECT MAX(page_limit) FROM page_checkpoints WHERE job_id = ?", (job_id,))
+    page_limit = cursor.fetchone()[0]
+    cursor.close()
+    sqlite_connection.close()
+    return page_limit
+
+
+def load_job_goods_ids(job_id: int) -> set[str]:
+    """Товары, уже записанные в запуске задачи"""
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute("SELECT DISTINCT goods_id FROM offers WHERE job_id = ?", (job_id,))
+    goods_ids = {row[0] for row in cursor}
+    cursor.close()
+    sqlite_connection.close()
+    return goods_ids
+
+
+def save_page_checkpoint(writer, job_id, shard, offset, parse_next, page_limit):
+    """Поставить отметку о спаршенной странице в очередь записи `DbWriter`.
+
+    Отметка идет в очереди после предложений страницы, поэтому записывается не раньше их.
+    """
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    writer.execute(
+        """INSERT OR REPLACE INTO page_checkpoints (job_id,shard,"offset",parse_next,completed_at,page_limit) VALUES (?,?,?,?,?,?)""",
+        (job_id, shard, offset, bool(parse_next), now, page_limit),
+    )
+
+
 def add_to_db(
+    writer,
     job_id,
-    job_name,
     goods_id,
     merchant_id,
     url,
     title,
+    image_url,
     price,
     price_bonus,
     bonus_amount,
@@ -72,21 +388,184 @@ def add_to_db(
     merchant_rating,
     notified,
 ):
+    """Поставить предложение в очередь записи `DbWriter`"""
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # ссылка на предложение продавца оканчивается на _merchantId, в goods храним ссылку на товар
+    goods_url = url.removesuffix(f"_{merchant_id}")
+    writer.execute(
+        """INSERT INTO goods (goods_id,title,url,image_url) VALUES (?,?,?,?)
+        ON CONFLICT (goods_id) DO UPDATE SET
+        title = excluded.title, url = excluded.url, image_url = excluded.image_url
+        WHERE (goods.title, goods.url, goods.image_url) IS NOT (excluded.title, excluded.url, excluded.image_url)""",
+        (goods_id, title, goods_url, image_url),
+    )
+    writer.execute(
+        f"""INSERT INTO offers (job_id,{OFFER_COLUMNS})
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+        (
+            job_id,
+            goods_id,
+            merchant_id,
+            price,
+            price_bonus,
+            bonus_amount,
+            bonus_percent,
+            available_quantity,
+            delivery_date,
+            merchant_name,
+            merchant_rating,
+            now,
+            notified,
+        ),
+    )
+
+
+def load_notifications(since_seconds: float) -> dict[tuple, float]:
+    """Загрузить историю уведомлений не старше `since_seconds`.
+
+    Ключ - (goods_id, merchant_id, price, bonus_amount), значение - время уведомления в секундах epoch.
+    """
+    since = (datetime.datetime.now() - datetime.timedelta(seconds=since_seconds)).strftime("%Y-%m-%d %H:%M:%S")
     sqlite_connection = sqlite3.connect(FILENAME)
     cursor = sqlite_connection.cursor()
     cursor.execute(
-        f"""INSERT INTO 
-        "{job_name}_{job_id}"
-        (goods_id,merchant_id,url,title,price,price_bonus,bonus_amount,
-        bonus_percent,available_quantity,delivery_date,
-        merchant_name,merchant_rating,scraped_at,notified)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+        """SELECT goods_id, merchant_id, price, bonus_amount, notified_at FROM notifications
+        WHERE notified_at > ?""",
+        (since,),
+    )
+    history = {
+        (goods_id, merchant_id, price, bonus_amount): datetime.datetime.strptime(notified_at, "%Y-%m-%d %H:%M:%S").timestamp()
+        for goods_id, merchant_id, price, bonus_amount, notified_at in cursor
+    }
+    cursor.close()
+    sqlite_connection.close()
+    return history
+
+
+def add_notification(writer, goods_id, merchant_id, price, bonus_amount, notified_at: float):
+    """Поставить запись об уведомлении в очередь записи `DbWriter`"""
+    notified_at = datetime.datetime.fromtimestamp(notified_at).strftime("%Y-%m-%d %H:%M:%S")
+    writer.execute(
+        """INSERT OR REPLACE INTO notifications
+        (goods_id,merchant_id,price,bonus_amount,notified_at) VALUES (?,?,?,?,?)""",
+        (goods_id, merchant_id, price, bonus_amount, notified_at),
+    )
+
+
+def load_proxy_stats() -> dict[str, dict]:
+    """Загрузить сохраненную статистику прокси, ключ - строка прокси, "" для прямого соединения"""
+    sqlite_connection = sqlite3.connect(FILENAME)
+    sqlite_connection.row_factory = sqlite3.Row
+    cursor = sqlite_connection.cursor()
+    cursor.execute("SELECT * FROM proxy_stats")
+    stats = {row["proxy"]: dict(row) for row in cursor}
+    cursor.close()
+    sqlite_connection.close()
+    return stats
+
+
+def save_proxy_stats(writer, proxy, stats: dict):
+    """Поставить статистику прокси в очередь записи `DbWriter`.
+
+    Счетчики запросов, ошибок и "слишком частых запросов" суммируются с прошлыми запусками.
+    """
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    writer.execute(
+        """INSERT INTO proxy_stats
+        (proxy,interval,latency,error_rate,throttle_rate,requests,errors,throttles,quarantine_level,quarantined_until,updated_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT (proxy) DO UPDATE SET
+        interval = excluded.interval, latency = excluded.latency, error_rate = excluded.error_rate,
+        throttle_rate = excluded.throttle_rate, requests = IFNULL(requests, 0) + excluded.requests,
+        errors = IFNULL(errors, 0) + excluded.errors, throttles = IFNULL(throttles, 0) + excluded.throttles,
+        quarantine_level = excluded.quarantine_level, quarantined_until = excluded.quarantined_until,
+        updated_at = excluded.updated_at""",
         (
+            proxy or "",
+            stats["interval"],
+            stats["latency"],
+            stats["error_rate"],
+            stats["throttle_rate"],
+            stats["requests"],
+            stats["errors"],
+            stats["throttles"],
+            stats["quarantine_level"],
+            stats["quarantined_until"],
+            now,
+        ),
+    )
+
+
+def load_merchant_inns(ttl_seconds: float = MERCHANT_INN_TTL) -> dict[str, str]:
+    """Загрузить ИНН продавцов, полученные не раньше `ttl_seconds` назад"""
+    since = (datetime.datetime.now() - datetime.timedelta(seconds=ttl_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute("SELECT merchant_id, inn FROM merchants WHERE fetched_at > ?", (since,))
+    merchant_inns = dict(cursor.fetchall())
+    cursor.close()
+    sqlite_connection.close()
+    return merchant_inns
+
+
+def add_merchant_inn(writer, merchant_id, inn):
+    """Поставить ИНН продавца в очередь записи `DbWriter`"""
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    writer.execute(
+        """INSERT OR REPLACE INTO merchants (merchant_id,inn,fetched_at) VALUES (?,?,?)""",
+        (merchant_id, inn, now),
+    )
+
+
+def load_offer_state(job_name: str) -> dict[tuple, tuple]:
+    """Загрузить текущее состояние предложений задачи.
+
+    Ключ - (goods_id, merchant_id), значение - (price, price_bonus, bonus_amount, available_quantity, delivery_date).
+    Пропавшие предложения не загружаются, при появлении они снова считаются изменившимися.
+    """
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute(
+        """SELECT goods_id, merchant_id, price, price_bonus, bonus_amount, available_quantity, delivery_date
+        FROM offer_state WHERE job_name = ? AND disappeared_at IS NULL""",
+        (job_name,),
+    )
+    offer_state = {(row[0], row[1]): row[2:] for row in cursor}
+    cursor.close()
+    sqlite_connection.close()
+    return offer_state
+
+
+def save_offer_state(
+    writer,
+    job_name,
+    goods_id,
+    merchant_id,
+    price,
+    price_bonus,
+    bonus_amount,
+    bonus_percent,
+    available_quantity,
+    delivery_date,
+    merchant_name,
+    merchant_rating,
+):
+    """Поставить новое состояние предложения в очередь записи `DbWriter`"""
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    writer.execute(
+        """INSERT INTO offer_state
+        (job_name,goods_id,merchant_id,price,price_bonus,bonus_amount,bonus_percent,available_quantity,
+        delivery_date,merchant_name,merchant_rating,first_seen,changed_at,disappeared_at)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,NULL)
+        ON CONFLICT (job_name, goods_id, merchant_id) DO UPDATE SET
+        price = excluded.price, price_bonus = excluded.price_bonus, bonus_amount = excluded.bonus_amount,
+        bonus_percent = excluded.bonus_percent, available_quantity = excluded.available_quantity,
+        delivery_date = excluded.delivery_date, merchant_name = excluded.merchant_name,
+        merchant_rating = excluded.merchant_rating, changed_at = excluded.changed_at, disappeared_at = NULL""",
+        (
+            job_name,
             goods_id,
             merchant_id,
-            url,
-            title,
             price,
             price_bonus,
             bonus_amount,
@@ -96,42 +575,284 @@ def add_to_db(
             merchant_name,
             merchant_rating,
             now,
-            notified,
+            now,
         ),
     )
-    sqlite_connection.commit()
 
 
-def get_last_notified(goods_id, merchant_id, price, bonus_amount):
+def mark_offers_disappeared(writer, job_name, keys):
+    """Поставить в очередь записи `DbWriter` отметку о пропаже предложений, `keys` - (goods_id, merchant_id)"""
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for goods_id, merchant_id in keys:
+        writer.execute(
+            """UPDATE offer_state SET disappeared_at = ? WHERE job_name = ? AND goods_id = ? AND merchant_id = ?""",
+            (now, job_name, goods_id, merchant_id),
+        )
+
+
+def load_listing_state(job_name: str, max_age_seconds: float) -> dict[str, tuple]:
+    """Загрузить данные товаров в выдаче, предложения которых запрашивались не раньше `max_age_seconds` назад.
+
+    Ключ - goods_id, значение - (price, bonus_amount, offer_count).
+    """
+    since = (datetime.datetime.now() - datetime.timedelta(seconds=max_age_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+    sqlite_connection = sqlite3.connect(FILENAME)
+    cursor = sqlite_connection.cursor()
+    cursor.execute(
+        """SELECT goods_id, price, bonus_amount, offer_count FROM listing_state
+        WHERE job_name = ? AND offers_fetched_at > ?""",
+        (job_name, since),
+    )
+    listing_state = {row[0]: row[1:] for row in cursor}
+    cursor.close()
+    sqlite_connection.close()
+    return listing_state
+
+
+def save_listing_state(writer, job_name, goods_id, price, bonus_amount, offer_count):
+    """Поставить данные товара в выдаче после запроса его предложений в очередь записи `DbWriter`"""
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    writer.execute(
+        """INSERT OR REPLACE INTO listing_state
+        (job_name,goods_id,price,bonus_amount,offer_count,offers_fetched_at) VALUES (?,?,?,?,?,?)""",
+        (job_name, goods_id, price, bonus_amount, offer_count, now),
+    )
+
+
+def load_api_cache(key: str, now: float) -> dict | None:
+    """Загрузить не истекший ответ api из кэша"""
     sqlite_connection = sqlite3.connect(FILENAME)
     cursor = sqlite_connection.cursor()
-    last_notified_row = None
+    cursor.execute("SELECT response FROM api_cache WHERE key = ? AND expires_at > ?", (key, now))
+    row = cursor.fetchone()
+    cursor.close()
+    sqlite_connection.close()
+    return json.loads(row[0]) if row else None
 
-    # Get a list of all job tables
-    # cursor.execute("SELECT id, name FROM jobs")
-    # job_tables = cursor.fetchall()
 
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'jobs' AND name != 'sqlite_sequence'")
-    job_tables = [table[0] for table in cursor.fetchall()]
+def save_api_cache(key: str, response: dict, now: float, ttl_seconds: float) -> None:
+    """Сохранить ответ api в кэш и удалить истекшие записи.
 
-    # Construct a union query to select from all job tables at once
-    union_query = " UNION ".join([f"SELECT scraped FROM '{table}' WHERE notified = 1 AND goods_id = ? AND merchant_id = ? AND price = ? AND bonus_amount = ?" for table in job_tables])
+    Пишется сразу, без `DbWriter`, чтобы ответ был в кэше и при коротком запуске, например проверке конфига.
+    Если база дольше таймаута занята записью `DbWriter`, ответ не кэшируется, парсинг продолжается.
+    """
+    sqlite_connection = sqlite3.connect(FILENAME)
+    try:
+        with sqlite_connection:
+            sqlite_connection.execute("DELETE FROM api_cache WHERE expires_at <= ?", (now,))
+            sqlite_connection.execute(
+                "INSERT OR REPLACE INTO api_cache (key,response,expires_at) VALUES (?,?,?)",
+                (key, json.dumps(response, ensure_ascii=False), now + ttl_seconds),
+            )
+    except sqlite3.OperationalError as e:
+        logger.warning("Ответ api не сохранен в кэш: %s", e)
+    finally:
+        sqlite_connection.close()
 
-    union_query += "ORDER BY scraped DESC LIMIT 1"
 
-    # Concatenate all parameters to be passed into the execute function
-    parameters = tuple([goods_id, merchant_id, price, bonus_amount] * len(job_tables))
+EXPORT_COLUMNS = (
+    "job_id",
+    "job_name",
+    "goods_id",
+    "merchant_id",
+    "url",
+    "title",
+    "image_url",
+    "price",
+    "price_bonus",
+    "bonus_amount",
+    "bonus_percent",
+    "available_quantity",
+    "delivery_date",
+    "merchant_name",
+    "merchant_rating",
+    "scraped_at",
+    "notified",
+)
 
-    cursor.execute(union_query, parameters)
-    row = cursor.fetchone()
-    if row:
-        last_notified_row = row[0]
 
-    cursor.close()
-    return last_notified_row
+def iter_offers(
+    job_ids: list[int] | None = None,
+    job_name: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    chunk_size: int = 10000,
+    filename: str = FILENAME,
+):
+    """Читать предложения задач пачками по `chunk_size` строк в порядке `EXPORT_COLUMNS`.
+
+    `since` и `until` ограничивают время парсинга, в формате "%Y-%m-%d %H:%M:%S" или его начале.
+    В памяти одновременно находится только одна пачка.
+    """
+    conditions, params = [], []
+    if job_ids:
+        conditions.append(f"offers.job_id IN ({','.join('?' * len(job_ids))})")
+        params.extend(job_ids)
+    if job_name:
+        conditions.append("jobs.name = ?")
+        params.append(job_name)
+    if since:
+        conditions.append("offers.scraped_at >= ?")
+        params.append(since)
+    if until:
+        conditions.append("offers.scraped_at < ?")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sqlite_connection = sqlite3.connect(filename)
+    cursor = sqlite_connection.cursor()
+    try:
+        cursor.execute(
+            f"""SELECT offers.job_id, jobs.name, offers.goods_id, offers.merchant_id, goods.url, goods.title, goods.image_url,
+            offers.price, offers.price_bonus, offers.bonus_amount, offers.bonus_percent, offers.available_quantity,
+            offers.delivery_date, offers.merchant_name, offers.merchant_rating, offers.scraped_at, offers.notified
+            FROM offers
+            JOIN jobs ON jobs.id = offers.job_id
+            LEFT JOIN goods ON goods.goods_id = offers.goods_id
+            {where}""",
+            params,
+        )
+        while rows := cursor.fetchmany(chunk_size):
+            yield rows
+    finally:
+        cursor.close()
+        sqlite_connection.close()
+
+
+class DbWriter:
+    """Единственный писатель в БД.
+
+    Держит одно соединение в режиме WAL в отдельном потоке и записывает
+    накопленные запросы пачками через `executemany`, одной транзакцией на пачку.
+    Пачка сбрасывается при достижении `batch_size` или раз в `flush_interval` секунд.
+    Вызывающие потоки только кладут запрос в очередь и не ждут диска.
+    Ошибка записи не останавливает поток: она логируется, а `flush` и `close` поднимают ее у вызывающего.
+    """
+
+    def __init__(self, filename: str = FILENAME, batch_size: int = WRITER_BATCH_SIZE, flush_interval: float = WRITER_FLUSH_INTERVAL):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: queue.Queue = queue.Queue()
+        self.thread: threading.Thread | None = None
+        self.start_lock = threading.Lock()
+        self.logger = logger
+        self.write_latency = Histogram()
+        self.rows_written: int = 0
+        self.error: Exception | None = None
+
+    def _ensure_started(self) -> None:
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="DbWriter", daemon=True)
+                self.thread.start()
+
+    def execute(self, sql: str, params: tuple) -> None:
+        """Поставить запрос в очередь записи"""
+        self._ensure_started()
+        self.queue.put((sql, params))
+
+    def _raise_error(self) -> None:
+        """Поднять первую ошибку записи с прошлой проверки"""
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _wait(self, done: threading.Event) -> None:
+        # поток записи может завершиться, не дойдя до отметки
+        while not done.wait(1):
+            if self.thread is None or not self.thread.is_alive():
+                break
+
+    def flush(self) -> None:
+        """Дождаться записи всех поставленных в очередь запросов"""
+        if self.thread is not None and self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            self._wait(done)
+        self._raise_error()
+
+    def close(self) -> None:
+        """Записать очередь и закрыть соединение"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise_error()
+
+    def _execute_runs(self, sqlite_connection: sqlite3.Connection, batch: list[tuple[str, tuple]]) -> int:
+        """Выполнить пачку по порядку, подряд идущие одинаковые запросы - одним `executemany`, вернуть число строк"""
+        rows_written = 0
+        start = 0
+        while start < len(batch):
+            sql = batch[start][0]
+            end = start + 1
+            while end < len(batch) and batch[end][0] == sql:
+                end += 1
+            cursor = sqlite_connection.executemany(sql, [params for _, params in batch[start:end]])
+            rows_written += max(cursor.rowcount, 0)
+            start = end
+        return rows_written
+
+    def _write(self, sqlite_connection: sqlite3.Connection, batch: list[tuple[str, tuple]]) -> None:
+        write_start = perf_counter()
+        try:
+            with sqlite_connection:
+                rows_written = self._execute_runs(sqlite_connection, batch)
+        except sqlite3.Error as e:
+            # пачка откатилась целиком, повторяем по одному запросу, теряется только ошибочный
+            self.logger.warning("Ошибка записи пачки из %s запросов в БД: %s, записываем по одному", len(batch), e)
+            rows_written = 0
+            for statement in batch:
+                try:
+                    with sqlite_connection:
+                        rows_written += self._execute_runs(sqlite_connection, [statement])
+                except sqlite3.Error as e:
+                    self.logger.error("Запрос %s не записан в БД: %s", " ".join(statement[0].split()[:3]), e)
+                    self.error = self.error or e
+        self.write_latency.observe(perf_counter() - write_start)
+        self.rows_written += rows_written
+
+    def _run(self) -> None:
+        sqlite_connection = sqlite3.connect(self.filename)
+        sqlite_connection.execute("PRAGMA journal_mode=WAL")
+        sqlite_connection.execute("PRAGMA synchronous=NORMAL")
+        batch: list[tuple[str, tuple]] = []
+        pending: list[threading.Event] = []
+        deadline = monotonic() + self.flush_interval
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - monotonic()))
+                except queue.Empty:
+                    item = ()
+                if isinstance(item, tuple) and item:
+                    batch.append(item)
+                    if len(batch) < self.batch_size and monotonic() < deadline:
+                        continue
+                if isinstance(item, threading.Event):
+                    pending.append(item)
+                try:
+                    if batch:
+                        self._write(sqlite_connection, batch)
+                except Exception as e:
+                    self.logger.exception("Ошибка потока записи в БД")
+                    self.error = self.error or e
+                finally:
+                    batch = []
+                    deadline = monotonic() + self.flush_interval
+                    for done in pending:
+                        done.set()
+                    pending = []
+                if item is None:
+                    return
+        finally:
+            for done in pending:
+                done.set()
+            sqlite_connection.close()
 
 
-def finish_job(job_id):
+def finish_job(job_id, writer=None):
+    if writer:
+        writer.flush()
     now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     sqlite_connection = sqlite3.connect(FILENAME)
     cursor = sqlite_connection.cursor()
@@ -0,0 +1,141 @@
+"""Потоковый экспорт результатов из БД в CSV, JSONL и Parquet"""
+
+import bz2
+import csv
+import gzip
+import json
+import lzma
+import sys
+from typing import IO, Iterable
+
+from .exceptions import ConfigError
+from . import db_utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    _has_pyarrow = False
+else:
+    _has_pyarrow = True
+
+EXPORT_FORMATS = ("csv", "jsonl", "parquet")
+TEXT_COMPRESSIONS = {"gzip": (gzip.open, ".gz"), "bz2": (bz2.open, ".bz2"), "xz": (lzma.open, ".xz")}
+PARQUET_COMPRESSIONS = ("snappy", "gzip", "zstd", "brotli", "lz4")
+EXPORT_CHUNK_SIZE = 10000
+
+
+def _open_text(path: str, compression: str | None) -> IO[str]:
+    if path == "-":
+        if compression:
+            raise ConfigError("Сжатие при выводе в stdout не поддерживается!")
+        return sys.stdout
+    if compression:
+        open_func, _ = TEXT_COMPRESSIONS[compression]
+        return open_func(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+def _write_csv(chunks: Iterable[list[tuple]], file: IO[str]) -> int:
+    writer = csv.writer(file)
+    writer.writerow(db_utils.EXPORT_COLUMNS)
+    rows_total = 0
+    for rows in chunks:
+        writer.writerows(rows)
+        rows_total += len(rows)
+    return rows_total
+
+
+def _write_jsonl(chunks: Iterable[list[tuple]], file: IO[str]) -> int:
+    rows_total = 0
+    for rows in chunks:
+        file.writelines(json.dumps(dict(zip(db_utils.EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows)
+        rows_total += len(rows)
+    return rows_total
+
+
+def _parquet_schema():
+    return pyarrow.schema(
+        [
+            ("job_id", pyarrow.int64()),
+            ("job_name", pyarrow.string()),
+            ("goods_id", pyarrow.string()),
+            ("merchant_id", pyarrow.string()),
+            ("url", pyarrow.string()),
+            ("title", pyarrow.string()),
+            ("image_url", pyarrow.string()),
+            ("price", pyarrow.float64()),
+            ("price_bonus", pyarrow.float64()),
+            ("bonus_amount", pyarrow.float64()),
+            ("bonus_percent", pyarrow.int64()),
+            ("available_quantity", pyarrow.int64()),
+            ("delivery_date", pyarrow.string()),
+            ("merchant_name", pyarrow.string()),
+            ("merchant_rating", pyarrow.float64()),
+            ("scraped_at", pyarrow.string()),
+            ("notified", pyarrow.bool_()),
+        ]
+    )
+
+
+def _write_parquet(chunks: Iterable[list[tuple]], path: str, compression: str | None) -> int:
+    """Каждая пачка записывается отдельной группой строк"""
+    schema = _parquet_schema()
+    rows_total = 0
+    with pyarrow.parquet.ParquetWriter(path, schema, compression=compression or "none") as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            arrays = [
+                pyarrow.array([None if value is None else bool(value) for value in column] if field.type == pyarrow.bool_() else column, type=field.type)
+                for column, field in zip(columns, schema)
+            ]
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+            rows_total += len(rows)
+    return rows_total
+
+
+def default_output_path(export_format: str, compression: str | None) -> str:
+    path = f"mmparser_export.{export_format}"
+    if compression and export_format != "parquet":
+        path += TEXT_COMPRESSIONS[compression][1]
+    return path
+
+
+def export_offers(
+    path: str,
+    export_format: str = "csv",
+    compression: str | None = None,
+    job_ids: list[int] | None = None,
+    job_name: str | None = None,
+    since: str | None = None,
+    until: str | None = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+    db_filename: str = db_utils.FILENAME,
+) -> int:
+    """Выгрузить предложения задач в файл, вернуть количество строк.
+
+    Строки читаются из БД и пишутся пачками по `chunk_size`, память не зависит от размера выгрузки.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ConfigError(f"Неизвестный формат {export_format}!")
+    if export_format == "parquet":
+        if not _has_pyarrow:
+            raise ConfigError("Для экспорта в parquet установите pyarrow: pip install pyarrow")
+        if compression and compression not in PARQUET_COMPRESSIONS:
+            raise ConfigError(f"Сжатие {compression} не поддерживается для parquet!")
+        if path == "-":
+            raise ConfigError("Вывод parquet в stdout не поддерживается!")
+    elif compression and compression not in TEXT_COMPRESSIONS:
+        raise ConfigError(f"Сжатие {compression} не поддерживается для {export_format}!")
+
+    chunks = db_utils.iter_offers(job_ids, job_name, since, until, chunk_size, db_filename)
+    if export_format == "parquet":
+        return _write_parquet(chunks, path, compression)
+    file = _open_text(path, compression)
+    try:
+        if export_format == "csv":
+            return _write_csv(chunks, file)
+        return _write_jsonl(chunks, file)
+    finally:
+        if file is not sys.stdout:
+            file.close()
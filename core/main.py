@@ -1,17 +1,46 @@
 """cli"""
 
 import argparse
+import sys
 from pathlib import Path
-from rich_argparse import RichHelpFormatter
-from core.parser_url import Parser_url
-from core.interactive_config import create_config
 from core.utils import read_json_file, print_logo
 from .exceptions import ConfigError
+from .models import SHARD_SIZE
 from . import utils
 
+# парсеры, демон, интерактивный конфиг и rich_argparse импортируются только там, где нужны, для быстрого запуска
+ENGINES = ("threads", "async")
+
+
+def help_formatter(prog: str) -> argparse.HelpFormatter:
+    """Форматтер справки, rich_argparse нужен только для вывода справки и ошибок аргументов"""
+    from rich_argparse import RichHelpFormatter
+
+    return RichHelpFormatter(prog)
+
+
+def get_parser_class(engine: str) -> type:
+    if engine == "async":
+        from core.parser_url_async import Parser_url_async
+
+        return Parser_url_async
+    from core.parser_url import Parser_url
+
+    return Parser_url
+
+
+def read_alert_rules(file_path: str | None) -> list | dict | None:
+    if not file_path:
+        return None
+    alerts = read_json_file(file_path)
+    if alerts is False:
+        raise ConfigError(f"Не удалось прочитать правила уведомлений {file_path}")
+    return alerts
+
 
 def run_url_parser(args: argparse.Namespace, config: dict = {}) -> None:
-    parser_instance = Parser_url(
+    parser_class = get_parser_class(config.get("engine") or args.engine)
+    parser_instance = parser_class(
         url=config.get("url") or args.url,
         job_name=config.get("job_name") or args.job_name,
         include=config.get("include") or args.include,
@@ -30,17 +59,101 @@ def run_url_parser(args: argparse.Namespace, config: dict = {}) -> None:
         bonus_value_alert=config.get("bonus_value_alert") or args.bonus_value_alert,
         bonus_percent_alert=config.get("bonus_percent_alert") or args.bonus_percent_alert,
         alert_repeat_timeout=config.get("alert_repeat_timeout") or args.alert_repeat_timeout,
+        alerts=config.get("alerts") or read_alert_rules(args.alerts),
+        tg_digest=config.get("tg_digest") or args.tg_digest,
         use_merchant_blacklist=config.get("use_merchant_blacklist") or args.use_merchant_blacklist,
         threads=config.get("threads") or args.threads,
         delay=config.get("delay") or args.delay,
         error_delay=config.get("error_delay") or args.error_delay,
+        storage_mode=config.get("storage_mode") or args.storage_mode,
+        offers_max_age=config.get("offers_max_age") or args.offers_max_age,
+        no_cache=config.get("no_cache") or args.no_cache,
+        resume=config.get("resume") or args.resume,
+        shard_size=config.get("shard_size") or args.shard_size or (SHARD_SIZE if args.shard else 0),
+        metrics_dir=config.get("metrics_dir") or args.metrics,
+        profile_dir=config.get("profile_dir") or args.profile,
         log_level=config.get("log_level") or args.log_level,
     )
     parser_instance.parse()
 
 
+def run_daemon(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="mmparser daemon",
+        description="Запуск задач из папки конфигов по расписанию в одном процессе, на общих соединениях",
+        formatter_class=help_formatter,
+    )
+    parser.add_argument("config_dir", type=str, help='Папка с конфигами задач. В конфиге задачи: "interval" - интервал запуска в минутах, "priority" - приоритет')
+    parser.add_argument("-proxy", type=str, help="Строка прокси в формате protocol://username:password@ip:port")
+    parser.add_argument("-proxy-list", type=str, help="Путь к файлу с прокси в формате protocol://username:password@ip:port")
+    parser.add_argument("-allow-direct", action="store_true", help="Использовать прямое соединение параллельно с прокси")
+    parser.add_argument("-delay", type=float, help="Начальная задержка между запросами в секундах для одного соединения, далее подстраивается автоматически. По умолчанию: 1.8")
+    parser.add_argument("-max-jobs", type=int, default=2, help="Максимум одновременно выполняемых задач. По умолчанию: 2")
+    parser.add_argument("-log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], default="INFO", help="Уровень лога. По умолчанию: INFO")
+    parser.add_argument("-no-version-check", action="store_true", help=f"Не проверять новую версию, также переменная окружения {utils.NO_VERSION_CHECK_ENV}")
+    args = parser.parse_args(argv)
+
+    print_logo()
+    utils.check_for_new_version(skip=args.no_version_check)
+    if not Path(args.config_dir).is_dir():
+        raise ConfigError("Папка конфигов не найдена!")
+    from core.daemon import Daemon
+
+    Daemon(
+        config_dir=args.config_dir,
+        proxy=args.proxy,
+        proxy_file_path=args.proxy_list,
+        allow_direct=args.allow_direct,
+        delay=args.delay,
+        max_jobs=max(1, args.max_jobs),
+        log_level=args.log_level,
+    ).run()
+
+
+def run_export(argv: list[str]) -> None:
+    from core.export import EXPORT_FORMATS, PARQUET_COMPRESSIONS, TEXT_COMPRESSIONS, default_output_path, export_offers
+
+    parser = argparse.ArgumentParser(
+        prog="mmparser export",
+        description="Потоковый экспорт результатов из storage.sqlite в CSV, JSONL или Parquet",
+        formatter_class=help_formatter,
+    )
+    parser.add_argument("-jobs", type=int, nargs="+", help="ID задач. По умолчанию: все задачи")
+    parser.add_argument("-job-name", type=str, help="Название задачи, все ее запуски")
+    parser.add_argument("-since", type=str, help='Начало периода парсинга, "ГГГГ-ММ-ДД" или "ГГГГ-ММ-ДД ЧЧ:ММ:СС"')
+    parser.add_argument("-until", type=str, help="Конец периода парсинга, не включительно, в том же формате")
+    parser.add_argument("-format", choices=EXPORT_FORMATS, default="csv", help="Формат. По умолчанию: csv")
+    parser.add_argument("-compression", choices=sorted({*TEXT_COMPRESSIONS, *PARQUET_COMPRESSIONS}), help="Сжатие: gzip, bz2, xz для csv и jsonl, snappy, gzip, zstd, brotli, lz4 для parquet")
+    parser.add_argument("-chunk-size", type=int, default=10000, help="Строк в одной пачке чтения и записи. По умолчанию: 10000")
+    parser.add_argument("-o", "-output", dest="output", type=str, help="Путь к файлу, - для вывода в stdout. По умолчанию: mmparser_export.<формат>")
+    parser.add_argument("-db", type=str, default="storage.sqlite", help="Путь к БД. По умолчанию: storage.sqlite")
+    args = parser.parse_args(argv)
+
+    if not Path(args.db).exists():
+        raise ConfigError(f"БД {args.db} не найдена!")
+    output = args.output or default_output_path(args.format, args.compression)
+    rows_total = export_offers(
+        output,
+        export_format=args.format,
+        compression=args.compression,
+        job_ids=args.jobs,
+        job_name=args.job_name,
+        since=args.since,
+        until=args.until,
+        chunk_size=max(1, args.chunk_size),
+        db_filename=args.db,
+    )
+    if output != "-":
+        print(f"Выгружено {rows_total} строк в {output}")
+
+
 def main():
-    parser = argparse.ArgumentParser(prog="mmparser", description="Парсер/скрапер megamarket.ru", formatter_class=RichHelpFormatter)
+    if sys.argv[1:2] == ["export"]:
+        return run_export(sys.argv[2:])
+    if sys.argv[1:2] == ["daemon"]:
+        # отдельный разбор аргументов, позиционный url основной команды конфликтует с подкомандами
+        return run_daemon(sys.argv[2:])
+    parser = argparse.ArgumentParser(prog="mmparser", description="Парсер/скрапер megamarket.ru", formatter_class=help_formatter)
     parser.add_argument("url", nargs="?", type=str, help="URL для парсинга")
     parser.add_argument("-job-name", type=str, help="Название задачи, без этого параметра будет автоопределено")
     parser.add_argument("-config", type=str, help="Путь к конфигу парсера")
@@ -62,19 +175,33 @@ def main():
     parser.add_argument("-bonus-percent-alert", type=float, help="Если процент бонусов товара равно или выше данного значения, уведомлять в TG")
     parser.add_argument("-use-merchant-blacklist", action="store_true", help="Использовать черный список продавцов с ограничением на списание бонусов")
     parser.add_argument("-alert-repeat-timeout", type=float, help="Если походящий по параметрам товар уже был отправлен в TG, повторно уведомлять по истечении заданного времени, в часах")
+    parser.add_argument("-alerts", type=str, help="Путь к JSON файлу с правилами уведомлений, см. README")
+    parser.add_argument("-tg-digest", type=float, help="Отправлять уведомления в TG одним сообщением раз в заданное время, в минутах, и в конце задачи")
     parser.add_argument("-threads", type=int, help="Количество потоков. По умолчанию: 1 на каждое соединиение")
-    parser.add_argument("-delay", type=float, help="Задержка между запросами в секундах при работе в одном потоке. По умолчанию: 1.8")
+    parser.add_argument("-delay", type=float, help="Начальная задержка между запросами в секундах для одного соединения, далее подстраивается автоматически. По умолчанию: 1.8")
     parser.add_argument("-error-delay", type=float, help="Задержка между запосами в секундах в случае ошибки при работе в одном потоке. По умолчанию: 5")
+    parser.add_argument("-storage", dest="storage_mode", choices=["full", "changes"], default="full", help="Режим хранения: full - все предложения каждого запуска, changes - только изменения цены, бонусов, количества и даты доставки. По умолчанию: full")
+    parser.add_argument("-offers-max-age", type=float, help="Инкрементальный режим: запрашивать предложения товара, только если в выдаче изменились цена, бонусы или число предложений, или прошло больше заданного времени, в часах. Включает -storage changes")
+    parser.add_argument("-no-cache", action="store_true", help="Не использовать кэш ответов api для url, адреса, профиля и карточек товаров")
+    parser.add_argument("-resume", action="store_true", help="Продолжить незавершенный запуск задачи с неспаршенных страниц")
+    parser.add_argument("-shard", action="store_true", help=f"Делить выдачу больше {SHARD_SIZE} товаров на диапазоны цен, чтобы спарсить ее целиком")
+    parser.add_argument("-shard-size", type=int, help=f"То же, что -shard, с заданным числом товаров в диапазоне. По умолчанию: {SHARD_SIZE}")
+    parser.add_argument("-metrics", type=str, help="Папка для сводки метрик запуска в JSON и textfile для Prometheus")
+    parser.add_argument("-profile", type=str, help="Папка для результатов профилирования: pstats, collapsed stacks этапов для flame graph и прирост памяти")
+    parser.add_argument("-engine", choices=ENGINES, default="threads", help="Движок парсинга: потоки или asyncio. По умолчанию: threads")
     parser.add_argument("-log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], default="INFO", help="Уровень лога. По умолчанию: INFO")
+    parser.add_argument("-no-version-check", action="store_true", help=f"Не проверять новую версию, также переменная окружения {utils.NO_VERSION_CHECK_ENV}")
     args = parser.parse_args()
 
     print_logo()
-    utils.check_for_new_version()
+    utils.check_for_new_version(skip=args.no_version_check)
 
     if not args.config:
         if args.url:
             run_url_parser(args)
         else:
+            from core.interactive_config import create_config
+
             create_config()
 
     if args.config:
@@ -0,0 +1,295 @@
+"""Метрики запросов и этапов задачи: сводка в JSON и textfile для Prometheus"""
+
+import json
+import os
+import threading
+from bisect import bisect_left
+from pathlib import Path
+from time import time
+from urllib.parse import urlsplit
+
+# Границы корзин гистограмм в секундах, как у клиентов Prometheus
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, память не зависит от числа наблюдений"""
+
+    def __init__(self):
+        self.counts: list[int] = [0] * len(BUCKETS)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def __sub__(self, other: "Histogram") -> "Histogram":
+        histogram = Histogram()
+        histogram.counts = [count - other_count for count, other_count in zip(self.counts, other.counts)]
+        histogram.sum = self.sum - other.sum
+        histogram.count = self.count - other.count
+        return histogram
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля линейной интерполяцией внутри корзины"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if BUCKETS[index] != float("inf") else lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return BUCKETS[-2]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p90": round(self.quantile(0.9), 6),
+            "p99": round(self.quantile(0.99), 6),
+        }
+
+
+def proxy_label(proxy: str | None) -> str:
+    """Прокси без пароля, для метрик и логов"""
+    if not proxy:
+        return "direct"
+    parts = urlsplit(proxy)
+    user = f"{parts.username}@" if parts.username else ""
+    return f"{parts.scheme}://{user}{parts.hostname}:{parts.port}"
+
+
+def transferred_bytes(response) -> tuple[int, int]:
+    """Отправлено и получено байт запросом, по данным curl"""
+    # curl_cffi уже загружен парсером, импорт здесь не замедляет экспорт, которому нужен только Histogram
+    from curl_cffi import CurlInfo
+
+    infos = getattr(response, "infos", None) or {}
+    sent = infos.get(CurlInfo.REQUEST_SIZE, 0) + infos.get(CurlInfo.SIZE_UPLOAD_T, 0)
+    received = infos.get(CurlInfo.HEADER_SIZE, 0) + infos.get(CurlInfo.SIZE_DOWNLOAD_T, 0)
+    return int(sent), int(received)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Метрики одного запуска задачи, потокобезопасно"""
+
+    def __init__(self, job_name: str = "", db_writer=None):
+        self.job_name = job_name
+        self.started_at = time()
+        self.lock = threading.Lock()
+        self.endpoint_latency: dict[str, Histogram] = {}
+        self.proxy_latency: dict[str, Histogram] = {}
+        self.requests: dict[tuple[str, str, str], int] = {}
+        self.errors: dict[tuple[str, str], int] = {}
+        self.retries: dict[str, int] = {}
+        self.failures: dict[str, int] = {}
+        self.bytes_sent: dict[str, int] = {}
+        self.bytes_received: dict[str, int] = {}
+        self.cache_hits: dict[str, int] = {}
+        self.connection_wait = Histogram()
+        self.notify_latency = Histogram()
+        self.notifications: dict[str, int] = {}
+        self.items: int = 0
+        # писатель БД может быть общим для нескольких задач, считаем разницу с моментом старта
+        self.db_writer = db_writer
+        self.db_write_start = db_writer.write_latency.copy() if db_writer else Histogram()
+        self.db_rows_start = db_writer.rows_written if db_writer else 0
+
+    def observe_request(self, endpoint: str, proxy: str | None, latency: float, result: str, response=None, error: str | None = None) -> None:
+        """Учесть запрос к api, `result` - ok, throttled или error"""
+        proxy = proxy_label(proxy)
+        sent, received = transferred_bytes(response)
+        with self.lock:
+            self.endpoint_latency.setdefault(endpoint, Histogram()).observe(latency)
+            self.proxy_latency.setdefault(proxy, Histogram()).observe(latency)
+            key = (endpoint, proxy, result)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if error:
+                self.errors[(endpoint, error)] = self.errors.get((endpoint, error), 0) + 1
+            self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + sent
+            self.bytes_received[endpoint] = self.bytes_received.get(endpoint, 0) + received
+
+    def observe_retry(self, endpoint: str) -> None:
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def observe_failure(self, endpoint: str) -> None:
+        """Запрос не удался за все попытки"""
+        with self.lock:
+            self.failures[endpoint] = self.failures.get(endpoint, 0) + 1
+
+    def observe_cache_hit(self, endpoint: str) -> None:
+        with self.lock:
+            self.cache_hits[endpoint] = self.cache_hits.get(endpoint, 0) + 1
+
+    def observe_wait(self, seconds: float) -> None:
+        """Время ожидания свободного соединения"""
+        with self.lock:
+            self.connection_wait.observe(seconds)
+
+    def observe_notify(self, seconds: float, success: bool) -> None:
+        result = "ok" if success else "error"
+        with self.lock:
+            self.notify_latency.observe(seconds)
+            self.notifications[result] = self.notifications.get(result, 0) + 1
+
+    def _db_write(self) -> tuple[Histogram, int]:
+        if not self.db_writer:
+            return Histogram(), 0
+        return self.db_writer.write_latency - self.db_write_start, self.db_writer.rows_written - self.db_rows_start
+
+    def _requests_by_result(self, key_filter) -> dict[str, int]:
+        requests_by_result: dict[str, int] = {}
+        for key, count in self.requests.items():
+            if key_filter(key):
+                requests_by_result[key[2]] = requests_by_result.get(key[2], 0) + count
+        return requests_by_result
+
+    def summary(self) -> dict:
+        """Сводка запуска задачи"""
+        with self.lock:
+            duration = time() - self.started_at
+            db_write, db_rows = self._db_write()
+            requests_by_result = self._requests_by_result(lambda key: True)
+            requests_total = sum(requests_by_result.values())
+            endpoints = {}
+            for endpoint, histogram in sorted(self.endpoint_latency.items()):
+                endpoints[endpoint] = {
+                    "latency": histogram.summary(),
+                    "requests": self._requests_by_result(lambda key: key[0] == endpoint),
+                    "retries": self.retries.get(endpoint, 0),
+                    "failures": self.failures.get(endpoint, 0),
+                    "bytes_sent": self.bytes_sent.get(endpoint, 0),
+                    "bytes_received": self.bytes_received.get(endpoint, 0),
+                    "errors": {error: count for (name, error), count in self.errors.items() if name == endpoint},
+                }
+            proxies = {}
+            for proxy, histogram in sorted(self.proxy_latency.items()):
+                proxies[proxy] = {
+                    "latency": histogram.summary(),
+                    "requests": self._requests_by_result(lambda key: key[1] == proxy),
+                }
+            return {
+                "job": self.job_name,
+                "started_at": self.started_at,
+                "duration": round(duration, 3),
+                "items": self.items,
+                "items_per_second": round(self.items / duration, 3) if duration else 0.0,
+                "requests": requests_total,
+                "requests_per_second": round(requests_total / duration, 3) if duration else 0.0,
+                "requests_by_result": requests_by_result,
+                "retries": sum(self.retries.values()),
+                "failures": sum(self.failures.values()),
+                "cache_hits": dict(self.cache_hits),
+                "bytes_sent": sum(self.bytes_sent.values()),
+                "bytes_received": sum(self.bytes_received.values()),
+                "connection_wait": self.connection_wait.summary(),
+                "db_write": {**db_write.summary(), "rows": db_rows},
+                "notify": {**self.notify_latency.summary(), "results": dict(self.notifications)},
+                "endpoints": endpoints,
+                "proxies": proxies,
+            }
+
+    def _histogram_lines(self, name: str, histogram: Histogram, **labels) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(**labels, le=_format_number(bucket))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(**labels)} {_format_number(histogram.sum)}")
+        lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+        return lines
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        job = self.job_name
+        with self.lock:
+            db_write, db_rows = self._db_write()
+            lines = [
+                "# HELP mmparser_request_duration_seconds Длительность запросов к api по эндпоинтам",
+                "# TYPE mmparser_request_duration_seconds histogram",
+            ]
+            for endpoint, histogram in sorted(self.endpoint_latency.items()):
+                lines += self._histogram_lines("mmparser_request_duration_seconds", histogram, job=job, endpoint=endpoint)
+            lines += [
+                "# HELP mmparser_proxy_request_duration_seconds Длительность запросов к api по прокси",
+                "# TYPE mmparser_proxy_request_duration_seconds histogram",
+            ]
+            for proxy, histogram in sorted(self.proxy_latency.items()):
+                lines += self._histogram_lines("mmparser_proxy_request_duration_seconds", histogram, job=job, proxy=proxy)
+            lines += ["# HELP mmparser_requests_total Запросы к api по результату", "# TYPE mmparser_requests_total counter"]
+            for (endpoint, proxy, result), count in sorted(self.requests.items()):
+                lines.append(f"mmparser_requests_total{_labels(job=job, endpoint=endpoint, proxy=proxy, result=result)} {count}")
+            for name, help_text, values in (
+                ("mmparser_retries_total", "Повторные попытки запросов", self.retries),
+                ("mmparser_request_failures_total", "Запросы, не удавшиеся за все попытки", self.failures),
+                ("mmparser_cache_hits_total", "Ответы api из кэша", self.cache_hits),
+                ("mmparser_bytes_sent_total", "Отправлено байт", self.bytes_sent),
+                ("mmparser_bytes_received_total", "Получено байт", self.bytes_received),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for endpoint, count in sorted(values.items()):
+                    lines.append(f"{name}{_labels(job=job, endpoint=endpoint)} {count}")
+            lines += ["# HELP mmparser_connection_wait_seconds Ожидание свободного соединения", "# TYPE mmparser_connection_wait_seconds histogram"]
+            lines += self._histogram_lines("mmparser_connection_wait_seconds", self.connection_wait, job=job)
+            lines += ["# HELP mmparser_db_write_seconds Запись пачек в БД", "# TYPE mmparser_db_write_seconds histogram"]
+            lines += self._histogram_lines("mmparser_db_write_seconds", db_write, job=job)
+            lines += ["# HELP mmparser_db_rows_written_total Записано строк в БД", "# TYPE mmparser_db_rows_written_total counter"]
+            lines.append(f"mmparser_db_rows_written_total{_labels(job=job)} {db_rows}")
+            lines += ["# HELP mmparser_notify_seconds Отправка уведомлений в TG", "# TYPE mmparser_notify_seconds histogram"]
+            lines += self._histogram_lines("mmparser_notify_seconds", self.notify_latency, job=job)
+            lines += ["# HELP mmparser_notifications_total Уведомления в TG по результату", "# TYPE mmparser_notifications_total counter"]
+            for result, count in sorted(self.notifications.items()):
+                lines.append(f"mmparser_notifications_total{_labels(job=job, result=result)} {count}")
+            lines += [
+                "# HELP mmparser_items_total Спаршено предложений",
+                "# TYPE mmparser_items_total gauge",
+                f"mmparser_items_total{_labels(job=job)} {self.items}",
+                "# HELP mmparser_job_duration_seconds Длительность запуска задачи",
+                "# TYPE mmparser_job_duration_seconds gauge",
+                f"mmparser_job_duration_seconds{_labels(job=job)} {_format_number(time() - self.started_at)}",
+                "# HELP mmparser_job_last_run_timestamp_seconds Время начала последнего запуска задачи",
+                "# TYPE mmparser_job_last_run_timestamp_seconds gauge",
+                f"mmparser_job_last_run_timestamp_seconds{_labels(job=job)} {_format_number(self.started_at)}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def write(self, directory: str) -> tuple[Path, Path]:
+        """Записать сводку и textfile Prometheus в папку, файлы заменяются атомарно"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"mmparser_{self.job_name or 'job'}"
+        json_path, prom_path = directory / f"{name}.json", directory / f"{name}.prom"
+        for path, content in ((json_path, json.dumps(self.summary(), indent=4, ensure_ascii=False)), (prom_path, self.prometheus())):
+            temp_path = path.with_suffix(path.suffix + ".tmp")
+            temp_path.write_text(content, encoding="utf-8")
+            os.replace(temp_path, path)
+        return json_path, prom_path
@@ -1,4 +1,6 @@
+from collections import deque
 from dataclasses import dataclass, field
+from time import time
 from typing import Optional
 
 
@@ -26,8 +28,181 @@ class ParsedOffer:
         return int((self.bonus_amount / self.price) * 100)
 
 
+# AIMD подстройка интервала запросов соединения
+RATE_INCREASE = 0.01  # запросов в секунду, прибавка к скорости за каждый успешный запрос
+RATE_DECREASE = 0.5  # множитель скорости при ответе "слишком частые запросы"
+MIN_INTERVAL = 0.2
+MAX_INTERVAL = 60.0
+
+# Здоровье соединения
+HEALTH_ALPHA = 0.1  # вес нового значения в скользящих средних задержки и долей ошибок
+QUARANTINE_ERRORS = 3  # ошибок подряд до карантина
+QUARANTINE_ERROR_RATE = 0.5
+QUARANTINE_BASE = 30.0  # секунд, удваивается при каждом повторном карантине
+QUARANTINE_MAX = 3600.0
+QUARANTINE_CARRY_MAX = 300.0  # секунд, дольше карантин прошлого запуска не переносится
+
+PAGE_TRIES = 3  # попыток страницы каталога, каждая со своими повторами запроса
+SHARD_SIZE = 10000  # товаров в диапазоне цен по умолчанию для -shard, здесь, чтобы main не импортировал парсер
+
+
 class Connection:
-    def __init__(self, proxy: str | None):
+    def __init__(self, proxy: str | None, interval: float = 1.8):
         self.proxy_string: str | None = proxy
         self.usable_at: float = 0
         self.busy = False
+        self.interval: float = interval
+        self.success_count: int = 0
+        self.throttle_count: int = 0
+        self.error_count: int = 0
+        self.latency: float = 0
+        self.error_rate: float = 0
+        self.throttle_rate: float = 0
+        self.consecutive_errors: int = 0
+        self.quarantine_level: int = 0
+        self.quarantined_until: float = 0
+        self.handshake_count: int = 0
+
+    @property
+    def rate(self) -> float:
+        """Текущая скорость запросов в секунду"""
+        return 1 / self.interval
+
+    @property
+    def sort_key(self) -> float:
+        """Ожидаемое время завершения запроса через соединение, быстрые соединения выбираются раньше"""
+        return self.usable_at + self.latency
+
+    def _update_health(self, latency: float | None = None, error: bool = False, throttle: bool = False) -> None:
+        if latency is not None:
+            self.latency = latency if not self.latency else self.latency + HEALTH_ALPHA * (latency - self.latency)
+        self.error_rate += HEALTH_ALPHA * (error - self.error_rate)
+        self.throttle_rate += HEALTH_ALPHA * (throttle - self.throttle_rate)
+
+    def on_success(self, latency: float, rate_limited: bool = True) -> None:
+        """Учесть успешный запрос, для запросов с ограничением скорости аддитивно увеличить скорость"""
+        self.success_count += 1
+        self.consecutive_errors = 0
+        self._update_health(latency)
+        if self.error_rate < QUARANTINE_ERROR_RATE / 2:
+            self.quarantine_level = 0
+        if rate_limited:
+            self.interval = max(MIN_INTERVAL, 1 / (self.rate + RATE_INCREASE))
+
+    def on_throttle(self, latency: float | None = None) -> None:
+        """Мультипликативно снизить скорость после ответа api - слишком частые запросы"""
+        self.throttle_count += 1
+        self.consecutive_errors = 0
+        self._update_health(latency, throttle=True)
+        self.interval = min(MAX_INTERVAL, 1 / (self.rate * RATE_DECREASE))
+
+    def on_error(self) -> float:
+        """Учесть ошибку соединения, вернуть длительность карантина в секундах или 0"""
+        self.error_count += 1
+        self.consecutive_errors += 1
+        self._update_health(error=True)
+        if self.consecutive_errors < QUARANTINE_ERRORS and self.error_rate < QUARANTINE_ERROR_RATE:
+            return 0
+        duration = min(QUARANTINE_MAX, QUARANTINE_BASE * 2**self.quarantine_level)
+        self.quarantine_level += 1
+        self.consecutive_errors = 0
+        self.quarantined_until = time() + duration
+        return duration
+
+    def reset_counters(self) -> None:
+        """Обнулить счетчики запросов после сохранения статистики"""
+        self.success_count = self.throttle_count = self.error_count = self.handshake_count = 0
+
+    def stats(self) -> dict:
+        """Статистика соединения для сохранения между запусками"""
+        return {
+            "interval": self.interval,
+            "latency": self.latency,
+            "error_rate": self.error_rate,
+            "throttle_rate": self.throttle_rate,
+            "requests": self.success_count + self.throttle_count + self.error_count,
+            "errors": self.error_count,
+            "throttles": self.throttle_count,
+            "quarantine_level": self.quarantine_level,
+            "quarantined_until": self.quarantined_until,
+        }
+
+    def load_stats(self, stats: dict) -> None:
+        """Восстановить статистику соединения из прошлых запусков"""
+        self.interval = max(MIN_INTERVAL, stats.get("interval") or self.interval)
+        self.latency = stats.get("latency") or 0
+        self.error_rate = stats.get("error_rate") or 0
+        self.throttle_rate = stats.get("throttle_rate") or 0
+        self.quarantine_level = stats.get("quarantine_level") or 0
+        # карантин прошлого запуска не должен надолго задерживать следующий
+        self.quarantined_until = min(stats.get("quarantined_until") or 0, time() + QUARANTINE_CARRY_MAX)
+
+
+class PageWindow:
+    """Очередь страниц каталога или поиска с ограниченным числом одновременно обрабатываемых.
+
+    Страница - пара (диапазон цен, offset), без парсинга по диапазонам цен диапазон пустой.
+    Страницы выдаются по возрастанию offset, страницы разных диапазонов чередуются, не более `size`
+    одновременно, поэтому память и число лишних запросов не зависят от размера каталога.
+    Страница с ошибкой возвращается в начало очереди, не более PAGE_TRIES раз.
+    После страницы, за которой товаров в наличии нет, следующие страницы ее диапазона не выдаются.
+    """
+
+    def __init__(self, pages: list[tuple[str, int]], size: int):
+        self.pending: deque[tuple[str, int]] = deque(sorted(pages, key=lambda page: (page[1], page[0])))
+        self.size: int = max(1, size)
+        self.in_flight: set[tuple[str, int]] = set()
+        self.tries: dict[tuple[str, int], int] = {}
+        self.last_pages: dict[str, int] = {}
+        self.done: int = 0
+        self.failed: list[tuple[str, int]] = []
+
+    def _is_after_last(self, page: tuple[str, int]) -> bool:
+        last_offset = self.last_pages.get(page[0])
+        return last_offset is not None and page[1] > last_offset
+
+    def take(self) -> list[tuple[str, int]]:
+        """Страницы, которые можно начать сейчас"""
+        pages = []
+        while self.pending and len(self.in_flight) < self.size:
+            page = self.pending.popleft()
+            self.in_flight.add(page)
+            pages.append(page)
+        return pages
+
+    def complete(self, page: tuple[str, int], parse_next: bool) -> bool:
+        """Отметить страницу спаршенной, вернуть True, если за ней впервые нет товаров в наличии"""
+        self.in_flight.discard(page)
+        self.done += 1
+        shard, offset = page
+        if parse_next or self._is_after_last(page) or self.last_pages.get(shard) == offset:
+            return False
+        self.last_pages[shard] = offset
+        self.pending = deque(pending_page for pending_page in self.pending if not self._is_after_last(pending_page))
+        return True
+
+    def fail(self, page: tuple[str, int]) -> bool:
+        """Вернуть страницу с ошибкой в очередь, False если попытки исчерпаны"""
+        self.in_flight.discard(page)
+        if self._is_after_last(page):
+            return False
+        self.tries[page] = self.tries.get(page, 0) + 1
+        if self.tries[page] >= PAGE_TRIES:
+            self.failed.append(page)
+            return False
+        self.pending.appendleft(page)
+        return True
+
+    def drop(self, page: tuple[str, int]) -> None:
+        """Убрать не начатую из-за остановки страницу"""
+        self.in_flight.discard(page)
+
+    @property
+    def total(self) -> int:
+        """Ожидаемое число спаршенных страниц, для полосы прогресса"""
+        in_flight = sum(1 for page in self.in_flight if not self._is_after_last(page))
+        return self.done + len(self.pending) + in_flight
+
+    @property
+    def finished(self) -> bool:
+        return not self.pending and not self.in_flight
@@ -1,25 +1,56 @@
 """mmparser"""
 
+import hashlib
 import logging
+import os
 from datetime import datetime
-from time import sleep, time
+from time import perf_counter, sleep, time
 import threading
 import concurrent.futures
+import contextlib
 import sys
 import json
+import re
 from typing import Iterable
 import signal
-from pathlib import Path
 from urllib.parse import urlparse, parse_qsl, parse_qs, unquote, urljoin
 
 from rich.progress import BarColumn, Progress, SpinnerColumn, TextColumn, TimeRemainingColumn
 from rich.logging import RichHandler
-from curl_cffi import requests
+from curl_cffi import requests, CurlInfo
 
-from .models import ParsedOffer, Connection
-from .exceptions import ConfigError, ApiError
+from .alerts import AlertRule, compile_rules, threshold_rules
+from .models import ParsedOffer, Connection, PageWindow, PAGE_TRIES
+from .connection_pool import ConnectionPool, SessionPool, load_connection_stats, save_connection_stats
+from .metrics import Metrics
+from .profiling import Profiler, profiled
+from .exceptions import ConfigError, ApiError, ParsingStopped
 from . import db_utils, utils
-from .telegram import TelegramClient, validate_tg_credentials
+from .telegram import NotificationQueue, TelegramClient, validate_tg_credentials
+
+API_BASE_URL = "https://megamarket.ru/api/mobile/v1"
+
+# Данные curl о запросе: новые соединения и размеры для метрик
+CURL_INFOS = [CurlInfo.NUM_CONNECTS, CurlInfo.REQUEST_SIZE, CurlInfo.SIZE_UPLOAD_T, CurlInfo.HEADER_SIZE, CurlInfo.SIZE_DOWNLOAD_T]
+
+# Время жизни кэша ответов редко меняющихся эндпоинтов api, в секундах
+API_CACHE_TTL = {
+    "urlService/url/parse": 86400,
+    "addressSuggestService/address/suggest": 7 * 86400,
+    "profileService/address/list": 3600,
+    "securityService/profile/get": 600,
+    "catalogService/productCardMainInfo/get": 3600,
+}
+
+# Размер страницы каталога: по умолчанию, варианты для проверки по убыванию и время жизни найденного
+PAGE_LIMIT = 44
+PAGE_LIMIT_CANDIDATES = (200, 100, PAGE_LIMIT)
+PAGE_LIMIT_TTL = 7 * 86400
+PAGE_LIMIT_PROBE_TRIES = 3
+
+# Парсинг по диапазонам цен: фильтр цены api и верхняя граница цены
+PRICE_FILTER_ID = "88C83F68482F447C9F4E401955196697"
+PRICE_MAX = 100_000_000
 
 
 class Parser_url:
@@ -45,10 +76,24 @@ class Parser_url:
         bonus_value_alert: float | None = None,
         bonus_percent_alert: float | None = None,
         alert_repeat_timeout: float | None = None,
+        alerts: list | dict | None = None,
+        tg_digest: float | None = None,
         threads: int | None = None,
         delay: float | None = None,
         error_delay: float | None = None,
+        storage_mode: str = "full",
+        offers_max_age: float | None = None,
+        no_cache: bool = False,
+        resume: bool = False,
+        shard_size: int = 0,
+        api_base_url: str = API_BASE_URL,
+        metrics_dir: str = "",
+        profile_dir: str = "",
         log_level: str = "INFO",
+        connection_pool: ConnectionPool | None = None,
+        session_pool: SessionPool | None = None,
+        db_writer: db_utils.DbWriter | None = None,
+        show_progress: bool = True,
     ):
         self.cookie_file_path = cookie_file_path
         self.proxy = proxy
@@ -63,7 +108,11 @@ class Parser_url:
 
         self.region_id = "50"
 
-        self.connections: list[Connection] = []
+        # пул соединений, сессии и писатель БД могут быть общими для нескольких задач, см. daemon
+        self.connection_pool: ConnectionPool | None = connection_pool
+        self.connections: list[Connection] = connection_pool.connections if connection_pool else []
+        self.owns_connections: bool = connection_pool is None
+        self.show_progress: bool = show_progress
         self.parsed_proxies: set | None = None
         self.cookie_dict: dict | None = None
         self.profile: dict = {}
@@ -72,11 +121,14 @@ class Parser_url:
 
         self.logger: logging.Logger = self._create_logger(self.log_level)
         self.tg_client: TelegramClient | None = None
+        self.notification_queue: NotificationQueue | None = None
 
         self.url: str = url
         self.job_name: str = job_name
         self.include: str = include
         self.exclude: str = exclude
+        self.include_pattern: re.Pattern | None = None
+        self.exclude_pattern: re.Pattern | None = None
         self.blacklist_path: str = blacklist
         self.all_cards: bool = all_cards
         self.no_cards: bool = no_cards
@@ -85,12 +137,24 @@ class Parser_url:
         self.account_alert: bool = account_alert
         self.use_merchant_blacklist: bool = use_merchant_blacklist
         self.merchant_blacklist: Iterable[str] = utils.load_blacklist() if use_merchant_blacklist else [""]
-        self.price_value_alert: float = price_value_alert or float("-inf")
-        self.price_bonus_value_alert: float = price_bonus_value_alert or float("-inf")
-        self.bonus_value_alert: float = bonus_value_alert or float("inf")
-        self.bonus_percent_alert: float = bonus_percent_alert or float("inf")
+        self.price_value_alert: float | None = price_value_alert
+        self.price_bonus_value_alert: float | None = price_bonus_value_alert
+        self.bonus_value_alert: float | None = bonus_value_alert
+        self.bonus_percent_alert: float | None = bonus_percent_alert
+        self.alerts: list | dict = alerts or []
+        self.alert_rule: AlertRule | None = None
         self.alert_repeat_timeout: float = alert_repeat_timeout or 0
+        self.tg_digest: float = tg_digest or 0
         self.threads: int = threads
+        self.storage_mode: str = storage_mode
+        self.offers_max_age: float = offers_max_age or 0
+        self.no_cache: bool = no_cache
+        self.resume: bool = resume
+        self.shard_size: int = shard_size or 0
+        # адрес api можно заменить на локальный сервер, см. tests/mock_server.py
+        self.api_base_url: str = api_base_url.rstrip("/")
+        self.metrics_dir: str = metrics_dir
+        self.profiler: Profiler | None = Profiler(profile_dir) if profile_dir else None
 
         self.blacklist: list = []
         self.parsed_url: dict = None
@@ -99,14 +163,44 @@ class Parser_url:
         self.job_id: int = None
 
         self.address_id: str = None
+        self.notification_history: dict[tuple, float] = {}
+        self.offers_executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self.merchant_executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self.merchant_inns: dict[str, str] = {}
+        self.merchant_inn_requests: dict[str, concurrent.futures.Future] = {}
+        self.offer_state: dict[tuple, tuple] = {}
+        self.seen_offers: set[tuple] = set()
+        self.changed_offers_counter: int = 0
+        self.listing_state: dict[str, tuple] = {}
+        self.goods_offers: dict[str, list[tuple]] = {}
+        self.skipped_offers_counter: int = 0
+        # страницы, не спаршенные за PAGE_TRIES попыток, с ними выдача неполная
+        self.failed_pages: int = 0
+        self.page_checkpoints: dict[tuple[str, int], bool] = {}
+        self.page_limit: int = PAGE_LIMIT
+        # фильтры выдачи диапазонов цен и уже спаршенные товары, диапазоны пересекаются на границах
+        self.shard_filters: dict[str, list[dict]] = {}
+        self.seen_goods: set[str] = set()
+        self.resumed: bool = False
+        # остановка по Ctrl-C: новые страницы не начинаются, начатые дорабатываются
+        self.stop_event = threading.Event()
         self.lock = threading.Lock()
+        self.db_writer = db_writer or db_utils.DbWriter()
+        self.owns_db_writer: bool = db_writer is None
+        self.metrics = Metrics(db_writer=self.db_writer)
         self._set_up()
-        self.session = self._new_session()
+        self.session_pool = session_pool or SessionPool(self._new_session)
+        self.owns_session_pool: bool = session_pool is None
 
-    def _new_session(self) -> requests.Session:
-        """Создание новой сессии"""
-        session = requests.Session(impersonate="chrome")
-        session.cookies.update(self.cookie_dict)
+    def _new_session(self, connection: Connection) -> requests.Session:
+        """Создание новой сессии для `Соединения`"""
+        session = requests.Session(
+            impersonate="chrome",
+            proxy=connection.proxy_string,
+            use_thread_local_curl=False,
+            curl_infos=CURL_INFOS,
+        )
+        session.cookies.update(self.cookie_dict or {})
         session.cookies["adult_disclaimer_confirmed"] = "1"
         return session
 
@@ -125,33 +219,37 @@ class Parser_url:
             is_valid_proxy = utils.proxy_format_check(self.proxy)
             if not is_valid_proxy:
                 raise ConfigError(f"Прокси {self.proxy} не верного формата!")
-            self.connections = [Connection(self.proxy)]
+            self.connections = [Connection(self.proxy, self.connection_success_delay)]
         elif self.parsed_proxies:
             for proxy in self.parsed_proxies:
                 is_valid_proxy = utils.proxy_format_check(proxy)
                 if not is_valid_proxy:
                     raise ConfigError(f"Прокси {proxy} не верного формата!")
-            self.connections = [Connection(proxy) for proxy in self.parsed_proxies]
+            self.connections = [Connection(proxy, self.connection_success_delay) for proxy in self.parsed_proxies]
         if self.connections and self.allow_direct:
-            self.connections.append(Connection(None))
+            self.connections.append(Connection(None, self.connection_success_delay))
         elif not self.connections:
-            self.connections = [Connection(None)]
+            self.connections = [Connection(None, self.connection_success_delay)]
+        self.connection_pool = ConnectionPool(self.connections)
+
+    def _load_connection_stats(self) -> None:
+        """Начать со статистики, накопленной соединениями в прошлых запусках"""
+        load_connection_stats(self.connections)
+        self.connection_pool = ConnectionPool(self.connections)
+
+    def _save_connection_stats(self) -> None:
+        """Сохранить статистику соединений и вывести сводку по ним"""
+        save_connection_stats(self.connections, self.db_writer, self.logger)
 
     def _get_connection(self) -> Connection:
-        """Получить самое позднее использованное `Соединение`"""
-        while True:
-            free_proxies = [proxy for proxy in self.connections if not proxy.busy]
-            if free_proxies:
-                oldest_proxy = min(free_proxies, key=lambda obj: obj.usable_at)
-                current_time = time()
-                if oldest_proxy.usable_at <= current_time:
-                    return oldest_proxy
-                sleep(oldest_proxy.usable_at - time())
-                return self._get_connection()
-            # No free proxies, wait and retry
-            sleep(1)
-
-    def _api_request(self, api_url: str, json_data: dict, tries: int = 10, delay: float = 0) -> dict:
+        """Дождаться и занять самое позднее использованное `Соединение`"""
+        wait_start = perf_counter()
+        connection = self.connection_pool.acquire()
+        self.metrics.observe_wait(perf_counter() - wait_start)
+        return connection
+
+    def _prepare_api_payload(self, json_data: dict) -> dict:
+        """Добавить в тело запроса данные авторизации"""
         json_data["addressId"] = ""
         json_data["auth"] = {
             "locationId": self.region_id,
@@ -159,45 +257,129 @@ class Parser_url:
             "appVersion": 0,
             "os": "UNKNOWN_OS",
         }
+        return json_data
+
+    def _api_cache_key(self, api_url: str, json_data: dict) -> tuple[str, float] | None:
+        """Ключ кэша ответа и его время жизни, None если ответ эндпоинта не кэшируется.
+
+        Ключ учитывает эндпоинт, тело запроса и аккаунт из cookies.
+        """
+        ttl = API_CACHE_TTL.get(self._endpoint(api_url))
+        if not ttl or self.no_cache:
+            return None
+        account = sorted((self.cookie_dict or {}).items())
+        key = json.dumps([api_url, json_data, account], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(key.encode()).hexdigest(), ttl
+
+    def _endpoint(self, api_url: str) -> str:
+        """Эндпоинт api без базового адреса, для кэша и метрик"""
+        return api_url.removeprefix(f"{self.api_base_url}/")
+
+    def _load_cached_response(self, api_url: str, cache_key: tuple[str, float] | None) -> dict | None:
+        if not cache_key:
+            return None
+        response_data = db_utils.load_api_cache(cache_key[0], time())
+        if response_data is not None:
+            self.logger.debug("Ответ api из кэша")
+            self.metrics.observe_cache_hit(self._endpoint(api_url))
+        return response_data
+
+    def _cache_response(self, cache_key: tuple[str, float] | None, response_data: dict) -> None:
+        if cache_key:
+            db_utils.save_api_cache(cache_key[0], response_data, time(), cache_key[1])
+
+    def _api_request(self, api_url: str, json_data: dict, tries: int = 10, rate_limited: bool = False) -> dict:
+        json_data = self._prepare_api_payload(json_data)
+        cache_key = self._api_cache_key(api_url, json_data)
+        cached_response = self._load_cached_response(api_url, cache_key)
+        if cached_response is not None:
+            return cached_response
+        endpoint = self._endpoint(api_url)
         for i in range(0, tries):
+            if i:
+                self.metrics.observe_retry(endpoint)
             proxy = self._get_connection()
-            proxy.busy = True
             self.logger.debug("Прокси : %s", proxy.proxy_string)
+            request_start = time()
+            error = None
             try:
-                response = self.session.post(api_url, json=json_data, proxy=proxy.proxy_string, verify=False)
+                response = self.session_pool.get(proxy).post(api_url, json=json_data, verify=False)
+                SessionPool.count_handshakes(proxy, response)
                 response_data: dict = response.json()
-            except Exception:
-                response = None
-            if response and response.status_code == 200 and not response_data.get("error"):
-                proxy.usable_at = time() + delay
-                proxy.busy = False
+            except Exception as exc:
+                response = response_data = None
+                error = type(exc).__name__
+                self.logger.debug("Ошибка запроса %s через %s: %s", endpoint, proxy.proxy_string, exc)
+            latency = time() - request_start
+            success = self._update_connection(proxy, response, response_data, rate_limited, latency)
+            self.connection_pool.release(proxy)
+            self._observe_request(endpoint, proxy, response, response_data, success, latency, error)
+            if success:
+                self._cache_response(cache_key, response_data)
                 return response_data
-            if response and response.status_code == 200 and response_data.get("code") == 7:
-                self.logger.debug("Соединение %s: слишком частые запросы", proxy.proxy_string)
-                proxy.usable_at = time() + self.connection_error_delay
-            else:
+            if not self._is_throttled(response, response_data):
                 sleep(1 * i)
-            proxy.busy = False
 
+        self.metrics.observe_failure(endpoint)
         raise ApiError("Ошибка получения данных api")
 
+    def _observe_request(self, endpoint: str, proxy: Connection, response, response_data: dict | None, success: bool, latency: float, error: str | None) -> None:
+        """Учесть запрос в метриках"""
+        if success:
+            result = "ok"
+        elif self._is_throttled(response, response_data):
+            result = "throttled"
+        else:
+            result = "error"
+            if not error:
+                error = f"http_{response.status_code}" if response.status_code != 200 else f"api_{response_data.get('code')}"
+        self.metrics.observe_request(endpoint, proxy.proxy_string, latency, result, response, error)
+
+    def _is_throttled(self, response, response_data: dict | None) -> bool:
+        """Ответ api - слишком частые запросы"""
+        return bool(response and response.status_code == 200 and response_data.get("code") == 7)
+
+    def _update_connection(self, proxy: Connection, response, response_data: dict | None, rate_limited: bool, latency: float) -> bool:
+        """Обновить статистику и время доступности `Соединения` по результату запроса, вернуть успешность запроса.
+
+        Запросы с `rate_limited` выдерживают выученный интервал соединения, остальные выполняются без паузы.
+        Соединение с частыми ошибками уходит в карантин, если есть другие соединения не в карантине.
+        """
+        success = bool(response and response.status_code == 200 and not response_data.get("error"))
+        if success:
+            proxy.on_success(latency, rate_limited)
+            proxy.usable_at = time() + (proxy.interval if rate_limited else 0)
+        elif self._is_throttled(response, response_data):
+            proxy.on_throttle(latency)
+            self.logger.debug("Соединение %s: слишком частые запросы, интервал %.2f с", proxy.proxy_string, proxy.interval)
+            proxy.usable_at = time() + self.connection_error_delay
+        elif not response or response.status_code != 200:
+            quarantine = proxy.on_error()
+            if quarantine and self.connection_pool.quarantine(proxy):
+                self.logger.warning("Соединение %s: частые ошибки, карантин %.0f с", proxy.proxy_string, quarantine)
+        return success
+
+    @profiled("profile")
     def _get_profile(self) -> None:
         """Получить и сохранить информацию профиля ММ"""
-        response_json = self._api_request("https://megamarket.ru/api/mobile/v1/securityService/profile/get", json_data={})
+        response_json = self._api_request(f"{self.api_base_url}/securityService/profile/get", json_data={})
         self.profile = response_json["profile"]
 
+    @profiled("setup")
     def _set_up(self) -> None:
         """Парсинг и валидация конфигурации"""
         if self.tg_config:
             if not validate_tg_credentials(self.tg_config):
                 raise ConfigError(f"Конфиг {self.tg_config} не прошел проверку!")
             self.tg_client = TelegramClient(self.tg_config, self.logger)
-        self.parsed_proxies = self.proxy_file_path and utils.parse_proxy_file(self.proxy_file_path)
-        self._proxies_set_up()
+            self.notification_queue = NotificationQueue(self._send_notification, self.logger, self.tg_digest * 60)
+        if self.owns_connections:
+            self.parsed_proxies = self.proxy_file_path and utils.parse_proxy_file(self.proxy_file_path)
+            self._proxies_set_up()
         self.cookie_dict = self.cookie_file_path and utils.parse_cookie_file(self.cookie_file_path)
 
-        # Make Ctrl-C work when deamon threads are running
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self._on_sigint)
 
         regex_check = self.include and utils.validate_regex(self.include)
         if regex_check is False:
@@ -205,64 +387,234 @@ class Parser_url:
         regex_check = self.exclude and utils.validate_regex(self.exclude)
         if regex_check is False:
             raise ConfigError(f'Неверное выражение "{self.exclude}"!')
+        self.include_pattern = re.compile(self.include) if self.include else None
+        self.exclude_pattern = re.compile(self.exclude) if self.exclude else None
+        alert_rules = threshold_rules(self.price_value_alert, self.price_bonus_value_alert, self.bonus_value_alert, self.bonus_percent_alert)
+        alert_rules += self.alerts if isinstance(self.alerts, list) else [self.alerts]
+        self.alert_rule = compile_rules(alert_rules) if alert_rules else None
         if self.blacklist_path:
             self._read_blacklist_file()
+        if self.offers_max_age and self.storage_mode != "changes":
+            self.logger.warning("Инкрементальный режим сравнивает предложения с прошлым запуском, режим хранения изменен на changes")
+            self.storage_mode = "changes"
         self.threads = self.threads or len(self.connections)
-        if not Path(db_utils.FILENAME).exists():
-            db_utils.create_db()
+        db_utils.create_db()
+        if self.owns_connections:
+            self._load_connection_stats()
+        if self.use_merchant_blacklist:
+            self.merchant_inns = db_utils.load_merchant_inns()
+
+    def _on_sigint(self, signum, frame) -> None:
+        """Первый Ctrl-C - мягкая остановка, повторный - немедленный выход"""
+        if self.stop_event.is_set():
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGINT)
+            return
+        self.logger.warning("Остановка: дожидаемся начатых страниц, повторный Ctrl-C - выход сразу")
+        self.stop()
+
+    def stop(self) -> None:
+        """Мягко остановить парсинг: не начинать новых страниц, дождаться начатых и записать результаты"""
+        self.stop_event.set()
 
     def parse(self) -> None:
-        """Метод запуска парсинга"""
-        self.start_time = datetime.now()
-        self.logger.info("Целевой URL: %s", self.url)
-        self.logger.info("Потоков: %s", self.threads)
-        if self.cookie_file_path:
-            self._get_profile()
-            if self.profile.get("isAuthenticated"):
-                self.logger.info("Аккаунт: %s", self.profile["phone"])
+        """Метод запуска парсинга, с `profile_dir` - под профилировщиком"""
+        if not self.profiler or self.profiler.running:
+            return self._parse()
+        if not self.profiler.start():
+            self.logger.warning("Профилировщик уже запущен другой задачей, замеряется только время этапов")
+        elif self.profiler.cprofile_error:
+            self.logger.warning("cProfile недоступен (%s), замеряется только время этапов и память", self.profiler.cprofile_error)
+        try:
+            with self.profiler.span("parse"):
+                self._parse()
+        finally:
+            self.profiler.stop()
+            self._report_profile()
+
+    def _parse(self) -> None:
+        try:
+            self.start_time = datetime.now()
+            self.scraped_tems_counter = 0
+            self.metrics = Metrics(db_writer=self.db_writer)
+            self.logger.info("Целевой URL: %s", self.url)
+            self.logger.info("Потоков: %s", self.threads)
+            if self.cookie_file_path and not self.profile.get("isAuthenticated"):
+                # при повторных запусках задачи профиль с выполненным входом не запрашивается заново
+                self._get_profile()
+                if self.profile.get("isAuthenticated"):
+                    self.logger.info("Аккаунт: %s", self.profile["phone"])
+                else:
+                    self.logger.warning("Вход в аккаунт не выполнен")
+                    if self.account_alert and self.tg_client:
+                        self.tg_client.notify(f"Вход в аккаунт {self.cookie_file_path} не выполнен!")
+                        raise Exception(f"Вход в аккаунт {self.cookie_file_path} не выполнен!")
+            if not self.address_id:
+                # при повторных запусках задачи используется уже определенный адрес
+                self._set_up_address()
+            self.parse_input_url()
+            if self.parsed_url and not self.job_name:
+                search_text = self.parsed_url.get("searchText", {})
+                collection_title = (self.parsed_url.get("collection", {}) or {}).get("title")
+                merchant = (self.parsed_url.get("merchant", {}) or {}).get("slug")
+                unknown = "Не_определено"
+                self.job_name = search_text or collection_title or merchant or unknown
+                self.job_name = utils.slugify(self.job_name)
+            self._load_notification_history()
+            if self.parsed_url["type"] == "TYPE_PRODUCT_CARD":
+                self._parse_card()
+                self.logger.info("%s %s", self.job_name, self.start_time.strftime("%d-%m-%Y %H:%M:%S"))
             else:
-                self.logger.warning("Вход в аккаунт не выполнен")
-                if self.account_alert and self.tg_client:
-                    self.tg_client.notify(f"Вход в аккаунт {self.cookie_file_path} не выполнен!")
-                    raise Exception(f"Вход в аккаунт {self.cookie_file_path} не выполнен!")
+                self._start_job(resume=self.resume)
+                self.logger.info("%s %s", self.job_name, self.start_time.strftime("%d-%m-%Y %H:%M:%S"))
+                while self._parse_multi_page():
+                    # редирект до первой страницы выдачи: та же задача продолжается по адресу каталога
+                    self.parse_input_url()
+                self.logger.info("Спаршено %s товаров", self.scraped_tems_counter)
+            if self.owns_connections:
+                self._save_connection_stats()
+            if self.stop_event.is_set():
+                # задача остается незавершенной, ее можно продолжить с -resume
+                self.db_writer.flush()
+                self.logger.warning("Парсинг остановлен, продолжить задачу %s: -resume", self.job_name)
+            else:
+                self._save_offer_changes()
+                db_utils.finish_job(self.job_id, self.db_writer)
+        finally:
+            try:
+                if self.notification_queue:
+                    # отправить оставшиеся уведомления и дайджест до сводки метрик, в том числе после ошибки
+                    self.notification_queue.close()
+                self._report_metrics()
+                if self.owns_session_pool:
+                    self.session_pool.close()
+            finally:
+                if self.owns_db_writer:
+                    # поток писателя - daemon, без close очередь записей теряется при ошибке или Ctrl-C
+                    self.db_writer.close()
+
+    def _start_job(self, resume: bool = False) -> None:
+        """Создать запись задачи в БД или с `resume` продолжить незавершенную,
+        в режиме хранения изменений загрузить прошлое состояние предложений"""
+        self.job_id = resume and db_utils.load_unfinished_job(self.job_name)
+        self.resumed = bool(self.job_id)
+        self.shard_filters = {}
+        self.seen_goods = set()
+        self.failed_pages = 0
+        if self.resumed:
+            self.page_checkpoints = db_utils.load_page_checkpoints(self.job_id)
+            self.logger.info("Продолжаем незавершенную задачу %s, спаршено страниц: %s", self.job_id, len(self.page_checkpoints))
+            if self.shard_size:
+                self.seen_goods = db_utils.load_job_goods_ids(self.job_id)
+        else:
+            self.job_id = db_utils.new_job(self.job_name)
+            self.page_checkpoints = {}
+        if self.storage_mode == "changes":
+            self.offer_state = db_utils.load_offer_state(self.job_name)
+            self.seen_offers = set()
+            self.changed_offers_counter = 0
+        if self.offers_max_age:
+            self.listing_state = db_utils.load_listing_state(self.job_name, self.offers_max_age * 3600)
+            self.goods_offers = {}
+            for key in self.offer_state:
+                self.goods_offers.setdefault(key[0], []).append(key)
+            self.skipped_offers_counter = 0
+
+    def _save_offer_changes(self) -> None:
+        """Отметить пропавшие с прошлого запуска предложения"""
+        if self.storage_mode != "changes" or not self.job_id:
+            return
+        if self.resumed or self.failed_pages:
+            # предложения страниц, спаршенных до остановки или не спаршенных из-за ошибок, не отмечены как увиденные
+            reason = f"не спаршено страниц: {self.failed_pages}" if self.failed_pages else "задача продолжена"
+            self.logger.info("Изменившихся предложений: %s, пропавшие не отмечаются, %s", self.changed_offers_counter, reason)
+            self.offer_state = {}
+            self.seen_offers = set()
+            return
+        disappeared = self.offer_state.keys() - self.seen_offers
+        db_utils.mark_offers_disappeared(self.db_writer, self.job_name, disappeared)
+        self.logger.info("Изменившихся предложений: %s, пропавших: %s", self.changed_offers_counter, len(disappeared))
+        if self.offers_max_age:
+            self.logger.info("Товаров без изменений в выдаче, предложения не запрашивались: %s", self.skipped_offers_counter)
+        # состояние загружается заново при следующем запуске задачи
+        self.offer_state = {}
+        self.seen_offers = set()
+
+    @profiled("address")
+    def _set_up_address(self) -> None:
+        """Определить адрес и регион доставки"""
         if self.address:
             self._get_address_from_string(self.address)
         elif self.profile.get("isAuthenticated"):
             self._get_profile_default_address()
         if (not self.address_id or not self.region_id) and self.cookie_dict:
             self._get_address_info(self.cookie_dict)
-        self.parse_input_url()
-        if self.parsed_url and not self.job_name:
-            search_text = self.parsed_url.get("searchText", {})
-            collection_title = (self.parsed_url.get("collection", {}) or {}).get("title")
-            merchant = (self.parsed_url.get("merchant", {}) or {}).get("slug")
-            unknown = "Не_определено"
-            self.job_name = search_text or collection_title or merchant or unknown
-            self.job_name = utils.slugify(self.job_name)
-        if self.parsed_url["type"] == "TYPE_PRODUCT_CARD":
-            self._parse_card()
-            self.logger.info("%s %s", self.job_name, self.start_time.strftime("%d-%m-%Y %H:%M:%S"))
-        else:
-            self.job_id = db_utils.new_job(self.job_name)
-            self.logger.info("%s %s", self.job_name, self.start_time.strftime("%d-%m-%Y %H:%M:%S"))
-            self._parse_multi_page()
-            self.logger.info("Спаршено %s товаров", self.scraped_tems_counter)
-        db_utils.finish_job(self.job_id)
+
+    def _report_metrics(self) -> None:
+        """Вывести сводку метрик запуска, сохранить JSON и textfile Prometheus в `metrics_dir`"""
+        self.metrics.job_name = self.job_name
+        self.metrics.items = self.scraped_tems_counter
+        summary = self.metrics.summary()
+        self.logger.info(
+            "Запросов: %s (%.1f/с), слишком частых: %s, ошибок: %s, повторов: %s, ожидание соединения: %.1f с",
+            summary["requests"],
+            summary["requests_per_second"],
+            summary["requests_by_result"].get("throttled", 0),
+            summary["requests_by_result"].get("error", 0),
+            summary["retries"],
+            summary["connection_wait"]["sum"],
+        )
+        for endpoint, endpoint_summary in summary["endpoints"].items():
+            self.logger.debug("%s: p50 %.3f с, p99 %.3f с", endpoint, endpoint_summary["latency"]["p50"], endpoint_summary["latency"]["p99"])
+        if self.metrics_dir:
+            json_path, prom_path = self.metrics.write(self.metrics_dir)
+            self.logger.info("Метрики сохранены в %s и %s", json_path, prom_path)
+
+    def _report_profile(self) -> None:
+        """Вывести время этапов и сохранить результаты профилирования в `profile_dir`"""
+        for path, count, total, average, maximum in self.profiler.span_summary():
+            self.logger.info("Этап %s: %s раз, всего %.2f с, среднее %.3f с, макс %.3f с", path, count, total, average, maximum)
+        if self.profiler.memory_peak:
+            self.logger.info("Пик памяти: %.1f МБ", self.profiler.memory_peak / 2**20)
+        paths = self.profiler.write(self.job_name)
+        self.logger.info("Результаты профилирования сохранены в %s", ", ".join(map(str, paths)))
+
+    def _load_notification_history(self) -> None:
+        """Загрузить историю уведомлений для проверки повторов"""
+        if self.alert_repeat_timeout and self.tg_client:
+            self.notification_history = db_utils.load_notifications(self.alert_repeat_timeout * 3600)
+            self.logger.debug("Загружено %s записей истории уведомлений", len(self.notification_history))
 
     def _read_blacklist_file(self):
         blacklist_file_contents: str = open(self.blacklist_path, "r", encoding="utf-8").read()
         self.blacklist = [line for line in blacklist_file_contents.split("\n") if line]
 
+    def _is_offer_changed(self, parsed_offer: ParsedOffer) -> bool:
+        """Изменилось ли предложение с прошлого запуска задачи, запомнить его новое состояние"""
+        key = (parsed_offer.goods_id, parsed_offer.merchant_id)
+        state = (parsed_offer.price, parsed_offer.price_bonus, parsed_offer.bonus_amount, parsed_offer.available_quantity, parsed_offer.delivery_date)
+        self.seen_offers.add(key)
+        if self.offer_state.get(key) == state:
+            return False
+        self.offer_state[key] = state
+        return True
+
+    @profiled("db_export")
     def _export_to_db(self, parsed_offer: ParsedOffer) -> None:
-        """Экспорт одного предложения в базу данных"""
-        with self.lock:
-            db_utils.add_to_db(
-                self.job_id,
+        """Экспорт одного предложения в базу данных.
+
+        В режиме хранения `changes` строка истории пишется только при изменении цены, бонусов, количества или даты доставки.
+        """
+        if self.storage_mode == "changes":
+            with self.lock:
+                if not self._is_offer_changed(parsed_offer):
+                    return
+                self.changed_offers_counter += 1
+            db_utils.save_offer_state(
+                self.db_writer,
                 self.job_name,
                 parsed_offer.goods_id,
                 parsed_offer.merchant_id,
-                parsed_offer.url,
-                parsed_offer.title,
                 parsed_offer.price,
                 parsed_offer.price_bonus,
                 parsed_offer.bonus_amount,
@@ -271,14 +623,32 @@ class Parser_url:
                 parsed_offer.delivery_date,
                 parsed_offer.merchant_name,
                 parsed_offer.merchant_rating,
-                parsed_offer.notified,
             )
+        db_utils.add_to_db(
+            self.db_writer,
+            self.job_id,
+            parsed_offer.goods_id,
+            parsed_offer.merchant_id,
+            parsed_offer.url,
+            parsed_offer.title,
+            parsed_offer.image_url,
+            parsed_offer.price,
+            parsed_offer.price_bonus,
+            parsed_offer.bonus_amount,
+            parsed_offer.bonus_percent,
+            parsed_offer.available_quantity,
+            parsed_offer.delivery_date,
+            parsed_offer.merchant_name,
+            parsed_offer.merchant_rating,
+            parsed_offer.notified,
+        )
 
+    @profiled("url_parse")
     def parse_input_url(self, tries: int = 10) -> dict:
         """Парсинг url мм с использованием api самого мм"""
         json_data = {"url": self.url}
         response_json = self._api_request(
-            "https://megamarket.ru/api/mobile/v1/urlService/url/parse",
+            f"{self.api_base_url}/urlService/url/parse",
             json_data,
             tries=tries,
         )
@@ -296,7 +666,7 @@ class Parser_url:
     def _get_profile_default_address(self) -> None:
         """Получить данные адреса аккаунта мм"""
         json_data = {}
-        response_json = self._api_request("https://megamarket.ru/api/mobile/v1/profileService/address/list", json_data)
+        response_json = self._api_request(f"{self.api_base_url}/profileService/address/list", json_data)
         address = [address for address in response_json["profileAddresses"] if address["isDefault"] is True]
         if address:
             self.address_id = address[0]["addressId"]
@@ -321,7 +691,7 @@ class Parser_url:
         """Установить адрес доставки по строке адреса"""
         json_data = {"count": 10, "isSkipRegionFilter": True, "query": address}
         response_json = self._api_request(
-            "https://megamarket.ru/api/mobile/v1/addressSuggestService/address/suggest",
+            f"{self.api_base_url}/addressSuggestService/address/suggest",
             json_data,
         )
         address = response_json.get("items")
@@ -333,26 +703,77 @@ class Parser_url:
         else:
             sys.exit(f"По запросу {address} адрес не найден!")
 
-    def _get_merchant_inn(self, merchant_id: str) -> str:
-        """Получить ИНН по ID продавца"""
+    def _request_merchant_inn(self, merchant_id: str) -> str:
+        """Запросить ИНН по ID продавца"""
         json_data = {"merchantId": merchant_id}
-        response_json = self._api_request("https://megamarket.ru/api/mobile/v1/partnerService/merchant/legalInfo/get", json_data)
+        response_json = self._api_request(f"{self.api_base_url}/partnerService/merchant/legalInfo/get", json_data)
         return response_json["merchant"]["legalInfo"]["inn"]
 
-    def _parse_item(self, item: dict):
-        """Парсинг дефолтного предложения товара"""
-        if item["favoriteOffer"]["merchantName"] in self.blacklist:
-            self.logger.debug("Пропуск %s", item["favoriteOffer"]["merchantName"])
+    def _cache_merchant_inn(self, merchant_id: str, merchant_inn: str) -> None:
+        self.merchant_inns[merchant_id] = merchant_inn
+        db_utils.add_merchant_inn(self.db_writer, merchant_id, merchant_inn)
+
+    def _get_merchant_inn(self, merchant_id: str) -> str:
+        """Получить ИНН по ID продавца из кэша или api.
+
+        Одновременные запросы одного продавца объединяются в один запрос к api.
+        """
+        merchant_inn = self.merchant_inns.get(merchant_id)
+        if merchant_inn is not None:
+            return merchant_inn
+        with self.lock:
+            inn_request = self.merchant_inn_requests.get(merchant_id)
+            is_owner = inn_request is None
+            if is_owner:
+                inn_request = self.merchant_inn_requests[merchant_id] = concurrent.futures.Future()
+        if not is_owner:
+            return inn_request.result()
+        try:
+            merchant_inn = self._request_merchant_inn(merchant_id)
+        except Exception as exc:
+            inn_request.set_exception(exc)
+            raise
+        else:
+            self._cache_merchant_inn(merchant_id, merchant_inn)
+            inn_request.set_result(merchant_inn)
+        finally:
+            with self.lock:
+                self.merchant_inn_requests.pop(merchant_id, None)
+        return merchant_inn
+
+    def _prefetch_merchant_inns(self, merchant_ids: Iterable[str]) -> None:
+        """Заранее получить ИНН неизвестных продавцов, параллельно"""
+        if not self.use_merchant_blacklist:
             return
+        unknown_ids = {merchant_id for merchant_id in merchant_ids if merchant_id not in self.merchant_inns}
+        if not unknown_ids:
+            return
+        self.logger.debug("Запрос ИНН %s продавцов", len(unknown_ids))
+        if self.merchant_executor:
+            futures = [self.merchant_executor.submit(self._get_merchant_inn, merchant_id) for merchant_id in unknown_ids]
+            concurrent.futures.wait(futures)
+        else:
+            for merchant_id in unknown_ids:
+                self._get_merchant_inn(merchant_id)
 
-        if self.use_merchant_blacklist:
-            merchant_inn = self._get_merchant_inn(item["favoriteOffer"]["merchantId"])
-            if merchant_inn in self.merchant_blacklist:
-                self.logger.debug("Пропуск %s", item["favoriteOffer"]["merchantName"])
-                return
+    def _is_merchant_skipped(self, merchant_name: str, merchant_inn: str | None = None) -> bool:
+        """Проверка продавца по черным спискам"""
+        if merchant_name in self.blacklist or (merchant_inn is not None and merchant_inn in self.merchant_blacklist):
+            self.logger.debug("Пропуск %s", merchant_name)
+            return True
+        return False
 
-        self.scraped_tems_counter += 1
+    def _parse_item(self, item: dict) -> ParsedOffer | None:
+        """Парсинг дефолтного предложения товара, None если продавец исключен"""
+        merchant_name = item["favoriteOffer"]["merchantName"]
+        if self._is_merchant_skipped(merchant_name):
+            return None
+        if self.use_merchant_blacklist and self._is_merchant_skipped(merchant_name, self._get_merchant_inn(item["favoriteOffer"]["merchantId"])):
+            return None
+        return self._item_to_parsed_offer(item)
 
+    def _item_to_parsed_offer(self, item: dict) -> ParsedOffer:
+        """Дефолтное предложение товара из выдачи каталога или поиска"""
         delivery_date_iso: str = item["favoriteOffer"]["deliveryPossibilities"][0].get("displayDeliveryDate", "")
         delivery_date = delivery_date_iso.split("T")[0]
 
@@ -369,9 +790,19 @@ class Parser_url:
             merchant_name=item["favoriteOffer"]["merchantName"],
             image_url=item["goods"]["titleImage"],
         )
+        return parsed_offer
 
-        parsed_offer.notified = self._notify_if_notify_check(parsed_offer)
-        self._export_to_db(parsed_offer)
+    def _process_parsed_offers(self, parsed_offers: list[ParsedOffer | None]) -> None:
+        """Уведомление и сохранение предложений страницы или товара, правила уведомлений проверяются сразу для всех"""
+        parsed_offers = [parsed_offer for parsed_offer in parsed_offers if parsed_offer is not None]
+        if not parsed_offers:
+            return
+        with self.lock:
+            self.scraped_tems_counter += len(parsed_offers)
+        alerts = self.alert_rule(parsed_offers) if self.tg_client and self.alert_rule else [False] * len(parsed_offers)
+        for parsed_offer, alert in zip(parsed_offers, alerts):
+            parsed_offer.notified = alert and self._notify(parsed_offer)
+            self._export_to_db(parsed_offer)
 
     def _filters_convert(self, parsed_url: dict) -> dict:
         """Конвертация фильтров каталога или поиска"""
@@ -384,18 +815,16 @@ class Parser_url:
                 url_filter["type"] = 2
         return parsed_url
 
-    def _parse_offer(self, item: dict, offer: dict) -> None:
-        """Парсинг предложения товара"""
-        if offer["merchantName"] in self.blacklist:
-            self.logger.debug("Пропуск %s", offer["merchantName"])
-            return
-
-        if self.use_merchant_blacklist:
-            merchant_inn = self._get_merchant_inn(offer["merchantId"])
-            if merchant_inn in self.merchant_blacklist:
-                self.logger.debug("Пропуск %s", offer["merchantName"])
-                return
+    def _parse_offer(self, item: dict, offer: dict) -> ParsedOffer | None:
+        """Парсинг предложения товара, None если продавец исключен"""
+        if self._is_merchant_skipped(offer["merchantName"]):
+            return None
+        if self.use_merchant_blacklist and self._is_merchant_skipped(offer["merchantName"], self._get_merchant_inn(offer["merchantId"])):
+            return None
+        return self._offer_to_parsed_offer(item, offer)
 
+    def _offer_to_parsed_offer(self, item: dict, offer: dict) -> ParsedOffer:
+        """Предложение продавца из ответа productOffers"""
         delivery_date_iso: str = offer["deliveryPossibilities"][0]["date"]
         delivery_date = delivery_date_iso.split("T")[0]
 
@@ -419,31 +848,29 @@ class Parser_url:
             merchant_rating=offer["merchantSummaryRating"],
             image_url=item["titleImage"],
         )
+        return parsed_offer
 
-        self.scraped_tems_counter += 1
-        parsed_offer.notified = self._notify_if_notify_check(parsed_offer)
-        self._export_to_db(parsed_offer)
-
-    def _notify_if_notify_check(self, parsed_offer: ParsedOffer):
-        """Отправить уведомление в tg если предложение подходит по параметрам"""
-        time_diff = 0
-        last_notified = None
-        if self.alert_repeat_timeout:
-            last_notified = db_utils.get_last_notified(parsed_offer.goods_id, parsed_offer.merchant_id, parsed_offer.price, parsed_offer.bonus_amount)
-            last_notified = datetime.strptime(last_notified, "%Y-%m-%d %H:%M:%S") if last_notified else None
-            if last_notified:
-                now = datetime.now()
-                time_diff = now - last_notified
-        if (
-            (parsed_offer.bonus_percent >= self.bonus_percent_alert or parsed_offer.bonus_amount >= self.bonus_value_alert or parsed_offer.price <= self.price_value_alert or parsed_offer.price_bonus <= self.price_bonus_value_alert)
-            and (not last_notified or (last_notified and time_diff.total_seconds() > self.alert_repeat_timeout * 3600))
-            and self.tg_client
-        ):
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                message = self._format_tg_message(parsed_offer)
-                executor.submit(self.tg_client.notify, message, parsed_offer.image_url)
-                return True
-        return False
+    def _notify(self, parsed_offer: ParsedOffer) -> bool:
+        """Отправить уведомление в tg о предложении, подошедшем по правилам, если о нем еще не уведомляли"""
+        notification_key = (parsed_offer.goods_id, parsed_offer.merchant_id, parsed_offer.price, parsed_offer.bonus_amount)
+        now = time()
+        with self.lock:
+            last_notified = self.notification_history.get(notification_key)
+            if self.alert_repeat_timeout and last_notified and now - last_notified <= self.alert_repeat_timeout * 3600:
+                return False
+            self.notification_history[notification_key] = now
+        if not self.notification_queue.put(self._format_tg_message(parsed_offer), parsed_offer.image_url):
+            with self.lock:
+                self.notification_history.pop(notification_key, None)
+            return False
+        db_utils.add_notification(self.db_writer, *notification_key, notified_at=now)
+        return True
+
+    @profiled("notify")
+    def _send_notification(self, message: str, image_url: str | None = None) -> None:
+        notify_start = perf_counter()
+        success = self.tg_client.notify(message, image_url)
+        self.metrics.observe_notify(perf_counter() - notify_start, bool(success))
 
     def _format_tg_message(self, parsed_offer: ParsedOffer) -> str:
         """Форматировать данные для отправки в telegram"""
@@ -459,9 +886,9 @@ class Parser_url:
             f"☎️ <b>Аккаунт:</b> {self.profile.get('phone')}"
         )
 
-    def _get_offers(self, goods_id: str, delay: int = 0) -> list[dict]:
-        """Получить список предложений товара"""
-        json_data = {
+    def _offers_payload(self, goods_id: str) -> dict:
+        """Тело запроса предложений товара"""
+        return {
             "addressId": self.address_id,
             "collectionId": None,
             "goodsId": goods_id,
@@ -473,14 +900,19 @@ class Parser_url:
             "requestVersion": 11,
             "shopInfo": {},
         }
-        response_json = self._api_request("https://megamarket.ru/api/mobile/v1/catalogService/productOffers/get", json_data, delay=delay)
+
+    @profiled("get_offers")
+    def _get_offers(self, goods_id: str, rate_limited: bool = False) -> list[dict]:
+        """Получить список предложений товара"""
+        json_data = self._offers_payload(goods_id)
+        response_json = self._api_request(f"{self.api_base_url}/catalogService/productOffers/get", json_data, rate_limited=rate_limited)
         return response_json["offers"]
 
-    def _get_page(self, offset: int) -> dict:
-        """Получить страницу каталога или поиска"""
+    def _page_payload(self, offset: int, limit: int = PAGE_LIMIT, shard: str = "") -> dict:
+        """Тело запроса страницы каталога или поиска"""
         json_data = {
             "requestVersion": 10,
-            "limit": 44,
+            "limit": limit,
             "offset": offset,
             "isMultiCategorySearch": self.parsed_url.get("isMultiCategorySearch", False),
             "searchByOriginalQuery": False,
@@ -490,7 +922,7 @@ class Parser_url:
             "ageMore18": None,
             "addressId": self.address_id,
             "showNotAvailable": True,
-            "selectedFilters": self.parsed_url.get("selectedListingFilters", []),
+            "selectedFilters": self.shard_filters.get(shard) or self.parsed_url.get("selectedListingFilters", []),
         }
         if self.parsed_url.get("type", "") == "TYPE_MENU_NODE":
             self.parsed_url["collection"] = self.parsed_url["collection"] or self.parsed_url["menuNode"]["collection"]
@@ -498,11 +930,17 @@ class Parser_url:
         json_data["searchText"] = self.parsed_url["searchText"] if self.parsed_url["searchText"] else None
         json_data["selectedAssumedCollectionId"] = self.parsed_url["collection"]["collectionId"] if self.parsed_url["collection"] else None
         json_data["merchant"] = {"id": self.parsed_url["merchant"]["id"]} if self.parsed_url["merchant"] else None
+        return json_data
 
+    @profiled("get_page")
+    def _get_page(self, offset: int, limit: int | None = None, tries: int = 10, shard: str = "") -> dict:
+        """Получить страницу каталога или поиска, с `shard` - страницу диапазона цен"""
+        json_data = self._page_payload(offset, limit or self.page_limit, shard)
         response_json = self._api_request(
-            "https://megamarket.ru/api/mobile/v1/catalogService/catalog/search",
+            f"{self.api_base_url}/catalogService/catalog/search",
             json_data,
-            delay=self.connection_success_delay,
+            tries=tries,
+            rate_limited=True,
         )
 
         if response_json.get("error"):
@@ -510,42 +948,126 @@ class Parser_url:
         if response_json.get("success") is True:
             return response_json
 
+    @profiled("parse_page")
     def _parse_page(self, response_json: dict) -> bool:
         """Парсинг страницы каталога или поиска"""
         items_per_page = int(response_json.get("limit"))
         if items_per_page == 0:
             # костыль для косяка мм
             return False
+        items = self._claim_items(response_json["items"])
         page_progress = self.rich_progress.add_task(f"[orange]Страница {int(int(response_json.get('offset')) / items_per_page) + 1}")
-        self.rich_progress.update(page_progress, total=len(response_json["items"]))
-        for item in response_json["items"]:
-            item_title = item["goods"]["title"]
-            if self._exclude_check(item_title) or (item["isAvailable"] is not True) or (not self._include_check(item_title)):
-                # пропускаем, если товар не доступен или исключен
+        self.rich_progress.update(page_progress, total=len(items))
+        offers_futures: list[concurrent.futures.Future] = []
+        page_offers: list[ParsedOffer | None] = []
+        try:
+            self._prefetch_merchant_inns(
+                item["favoriteOffer"]["merchantId"]
+                for item in items
+                if not self._is_item_skipped(item) and not self._needs_offers(item) and item["favoriteOffer"]["merchantName"] not in self.blacklist
+            )
+            for item in items:
+                item_title = item["goods"]["title"]
+                if self._is_item_skipped(item):
+                    # пропускаем, если товар не доступен или исключен
+                    self.rich_progress.update(page_progress, advance=1)
+                    continue
+                if self._needs_offers(item):
+                    if self._is_listing_unchanged(item):
+                        self._skip_unchanged_offers(item)
+                        self.rich_progress.update(page_progress, advance=1)
+                        continue
+                    self.logger.info("Парсим предложения %s", item_title)
+                    # предложения товаров запрашиваются параллельно через общий пул соединений
+                    offers_future = self.offers_executor.submit(self._parse_listing_offers, item)
+                    offers_future.add_done_callback(lambda _: self._advance_page_progress(page_progress))
+                    offers_futures.append(offers_future)
+                    continue
+                page_offers.append(self._parse_item(item))
                 self.rich_progress.update(page_progress, advance=1)
-                continue
-            is_listing = self.parsed_url["type"] == "TYPE_LISTING"
-            if self.all_cards or (not self.no_cards and (item["hasOtherOffers"] or item["offerCount"] > 1 or is_listing)):
-                self.logger.info("Парсим предложения %s", item_title)
-                offers = self._get_offers(item["goods"]["goodsId"], delay=self.connection_success_delay)
-                for offer in offers:
-                    self._parse_offer(item["goods"], offer)
-            else:
-                self._parse_item(item)
-            self.rich_progress.update(page_progress, advance=1)
+            self._process_parsed_offers(page_offers)
 
-        self.rich_progress.remove_task(page_progress)
+            for offers_future in concurrent.futures.as_completed(offers_futures):
+                offers_future.result()
+        except BaseException:
+            # страница будет спаршена повторно
+            self._release_items(items)
+            raise
+        finally:
+            self.rich_progress.remove_task(page_progress)
         parse_next_page = response_json["items"] and response_json["items"][-1]["isAvailable"]
         return parse_next_page
 
+    def _advance_page_progress(self, page_progress) -> None:
+        """Продвинуть полосу страницы, после ошибки страницы ее полоса уже убрана"""
+        with contextlib.suppress(KeyError):
+            self.rich_progress.update(page_progress, advance=1)
+
+    def _is_item_skipped(self, item: dict) -> bool:
+        """Товар не доступен или исключен фильтрами"""
+        item_title = item["goods"]["title"]
+        return bool(self._exclude_check(item_title) or (item["isAvailable"] is not True) or (not self._include_check(item_title)))
+
+    def _claim_items(self, items: list[dict]) -> list[dict]:
+        """Товары страницы, которые еще не спаршены в других диапазонах цен, отметить спаршенными"""
+        if not self.shard_size:
+            return items
+        claimed_items = []
+        with self.lock:
+            for item in items:
+                goods_id = item["goods"]["goodsId"].split("_")[0]
+                if goods_id not in self.seen_goods:
+                    self.seen_goods.add(goods_id)
+                    claimed_items.append(item)
+        return claimed_items
+
+    def _release_items(self, items: list[dict]) -> None:
+        """Снять отметку спаршенных товаров страницы, которая не спаршена"""
+        if not self.shard_size:
+            return
+        with self.lock:
+            self.seen_goods.difference_update(item["goods"]["goodsId"].split("_")[0] for item in items)
+
+    def _needs_offers(self, item: dict) -> bool:
+        """Нужно ли запрашивать все предложения товара"""
+        is_listing = self.parsed_url["type"] == "TYPE_LISTING"
+        return self.all_cards or (not self.no_cards and (item["hasOtherOffers"] or item["offerCount"] > 1 or is_listing))
+
+    @staticmethod
+    def _listing_signature(item: dict) -> tuple:
+        """Данные товара в выдаче, по изменению которых видно изменение его предложений"""
+        return (item["favoriteOffer"]["finalPrice"], item["favoriteOffer"]["bonusAmount"], item["offerCount"])
+
+    def _is_listing_unchanged(self, item: dict) -> bool:
+        """Инкрементальный режим: выдача товара не изменилась с прошлого запроса предложений, не старше `offers_max_age`"""
+        if not self.offers_max_age:
+            return False
+        return self.listing_state.get(item["goods"]["goodsId"].split("_")[0]) == self._listing_signature(item)
+
+    def _skip_unchanged_offers(self, item: dict) -> None:
+        """Считать прошлые предложения товара актуальными без запроса"""
+        self.logger.debug("Предложения %s не изменились", item["goods"]["title"])
+        with self.lock:
+            self.seen_offers.update(self.goods_offers.get(item["goods"]["goodsId"].split("_")[0], ()))
+            self.skipped_offers_counter += 1
+
+    def _save_listing_signature(self, item: dict) -> None:
+        if self.offers_max_age:
+            db_utils.save_listing_state(self.db_writer, self.job_name, item["goods"]["goodsId"].split("_")[0], *self._listing_signature(item))
+
+    def _parse_listing_offers(self, item: dict) -> None:
+        """Получение и парсинг всех предложений товара из выдачи каталога или поиска"""
+        self._parse_offers(item["goods"], True)
+        self._save_listing_signature(item)
+
     def _exclude_check(self, title: str) -> bool:
-        if self.exclude:
-            return self.exclude.match(title)
+        if self.exclude_pattern:
+            return bool(self.exclude_pattern.match(title))
         return False
 
     def _include_check(self, title: str) -> bool:
-        if self.include:
-            return self.include.match(title)
+        if self.include_pattern:
+            return bool(self.include_pattern.match(title))
         return True
 
     def _create_progress_bar(self) -> None:
@@ -556,64 +1078,233 @@ class Parser_url:
             BarColumn(),
             TextColumn("[progress.percentage]{task.completed}/{task.total}"),
             TimeRemainingColumn(elapsed_when_finished=True, compact=True),
+            disable=not self.show_progress,
         )
         self.rich_progress.start()
 
     def _get_card_info(self, goods_id: str) -> dict:
         """Получить карточку товара"""
         json_data = {"goodsId": goods_id, "merchantId": "0"}
-        response_json = self._api_request("https://megamarket.ru/api/mobile/v1/catalogService/productCardMainInfo/get", json_data)
+        response_json = self._api_request(f"{self.api_base_url}/catalogService/productCardMainInfo/get", json_data)
         return response_json["goods"]
 
+    def _parse_offers(self, item: dict, rate_limited: bool = False) -> None:
+        """Получение и парсинг всех предложений товара"""
+        offers = self._get_offers(item["goodsId"], rate_limited=rate_limited)
+        self._prefetch_merchant_inns(offer["merchantId"] for offer in offers if offer["merchantName"] not in self.blacklist)
+        self._process_parsed_offers([self._parse_offer(item, offer) for offer in offers])
+
     def _parse_card(self) -> None:
         """Парсинг карточки товара"""
         item = self._get_card_info(self.parsed_url["goods"]["goodsId"])
-        offers = self._get_offers(self.parsed_url["goods"]["goodsId"])
         self.job_name = utils.slugify(item["title"])
-        self.job_id = db_utils.new_job(self.job_name)
-        for offer in offers:
-            self._parse_offer(item, offer)
+        self._start_job()
+        self._parse_offers(item)
+
+    def _remaining_pages(self, pages: list[tuple[str, int]]) -> list[tuple[str, int]]:
+        """Страницы без отметки о завершении. После страницы, за которой товаров в наличии нет, страницы ее диапазона не парсятся"""
+        last_pages: dict[str, int] = {}
+        for (shard, offset), parse_next in self.page_checkpoints.items():
+            if not parse_next:
+                last_pages[shard] = min(offset, last_pages.get(shard, offset))
+        remaining_pages = [page for page in pages if page not in self.page_checkpoints and page[1] <= last_pages.get(page[0], page[1])]
+        if self.page_checkpoints:
+            self.logger.info("Осталось страниц: %s из %s", len(remaining_pages), len(pages))
+        return remaining_pages
+
+    def _page_finished(self, window: PageWindow, page: tuple[str, int], exception: BaseException | None, parse_next_page: bool | None) -> None:
+        """Учесть результат страницы в окне страниц"""
+        if isinstance(exception, ParsingStopped):
+            window.drop(page)
+        elif exception is not None:
+            if not window.fail(page) and page in window.failed:
+                self.failed_pages += 1
+                self.logger.error("Страница с offset %s%s не спаршена за %s попыток: %s", page[1], f" диапазона цен {page[0]}" if page[0] else "", PAGE_TRIES, exception)
+        elif window.complete(page, parse_next_page):
+            self.logger.info("Дальше товары не в наличии, их не парсим")
+
+    def _save_page_checkpoint(self, page: tuple[str, int], parse_next_page: bool) -> None:
+        db_utils.save_page_checkpoint(self.db_writer, self.job_id, *page, parse_next_page, self.page_limit)
+
+    def _page_limit_cache_key(self) -> str:
+        return f"page_limit:{self.api_base_url}/catalogService/catalog/search"
+
+    def _load_page_limit(self) -> int | None:
+        """Размер страницы продолжаемой задачи или найденный ранее наибольший размер, который принимает api"""
+        if self.resumed:
+            page_limit = db_utils.load_page_limit(self.job_id)
+            if page_limit:
+                return page_limit
+        cached = db_utils.load_api_cache(self._page_limit_cache_key(), time())
+        return cached and cached["limit"]
+
+    def _accepted_page_limit(self, limit: int, response_json: dict) -> int:
+        """Размер страницы, который api выдал на запрос с `limit`. Подтвержденный полной страницей размер кэшируется"""
+        items = len(response_json["items"])
+        accepted = min(limit, int(response_json.get("limit") or limit))
+        if items < accepted and items < int(response_json["total"]):
+            # api урезал страницу до своего максимума
+            accepted = items
+        if items and items == accepted:
+            db_utils.save_api_cache(self._page_limit_cache_key(), {"limit": accepted}, time(), PAGE_LIMIT_TTL)
+            self.logger.info("Размер страницы: %s", accepted)
+        return accepted or PAGE_LIMIT
+
+    def _get_first_page(self) -> dict:
+        """Первая страница каталога или поиска с наибольшим размером страницы, который принимает api"""
+        page_limit = self._load_page_limit()
+        if page_limit:
+            self.page_limit = page_limit
+            return self._get_page(0)
+        for limit in PAGE_LIMIT_CANDIDATES:
+            try:
+                response_json = self._get_page(0, limit, tries=PAGE_LIMIT_PROBE_TRIES)
+            except ApiError:
+                self.logger.debug("Размер страницы %s не принят api", limit)
+                continue
+            self.page_limit = self._accepted_page_limit(limit, response_json)
+            return response_json
+        self.page_limit = PAGE_LIMIT
+        return self._get_page(0)
+
+    def _is_item_available(self, offset: int, shard: str = "") -> bool:
+        """Запросить один товар выдачи, в наличии ли он"""
+        items = self._get_page(offset, limit=1, shard=shard)["items"]
+        return bool(items) and items[0]["isAvailable"] is True
+
+    def _find_last_page(self, response_json: dict, items_per_page: int, item_count_total: int, shard: str = "") -> int:
+        """Offset последней страницы, которую нужно парсить.
 
-    def _process_page(self, offset: int, main_job) -> bool:
+        Товары не в наличии идут в конце выдачи. Если последний товар выдачи не в наличии,
+        первая страница, последний товар которой не в наличии, ищется бинарным поиском
+        запросами по одному товару - за log2(страниц) запросов вместо лишних страниц.
+        """
+        last_offset = (item_count_total - 1) // items_per_page * items_per_page
+        items = response_json["items"]
+        if last_offset <= 0 or not items or items[-1]["isAvailable"] is not True:
+            return 0
+        if self._is_item_available(item_count_total - 1, shard):
+            return last_offset
+        # на странице low последний товар в наличии, на странице high - нет
+        low, high = 0, last_offset // items_per_page
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self._is_item_available(middle * items_per_page + items_per_page - 1, shard):
+                low = middle
+            else:
+                high = middle
+        self.logger.info("Товары в наличии на %s страницах из %s", high + 1, last_offset // items_per_page + 1)
+        return high * items_per_page
+
+    def _price_bounds(self) -> tuple[int, int]:
+        """Диапазон цен из фильтров url"""
+        low, high = 0, PRICE_MAX
+        for url_filter in self.parsed_url.get("selectedListingFilters", []):
+            if url_filter.get("filterId") == PRICE_FILTER_ID:
+                if url_filter["type"] == 1:
+                    low = max(low, int(float(url_filter["value"])))
+                elif url_filter["type"] == 2:
+                    high = min(high, int(float(url_filter["value"])))
+        return low, high
+
+    def _add_shard(self, low: int, high: int) -> str:
+        """Фильтры выдачи диапазона цен, вернуть его ключ"""
+        shard = f"{low}-{high}"
+        url_filters = [url_filter for url_filter in self.parsed_url.get("selectedListingFilters", []) if url_filter.get("filterId") != PRICE_FILTER_ID]
+        self.shard_filters[shard] = url_filters + [
+            {"filterId": PRICE_FILTER_ID, "type": 1, "value": str(low)},
+            {"filterId": PRICE_FILTER_ID, "type": 2, "value": str(high)},
+        ]
+        return shard
+
+    def _probe_shard(self, price_range: tuple[int, int]) -> dict:
+        """Первый товар диапазона цен, для числа товаров в нем"""
+        return self._get_page(0, limit=1, shard=self._add_shard(*price_range))
+
+    def _split_shards(self, probes: list[tuple[tuple[int, int], dict]]) -> tuple[list[tuple[str, dict]], list[tuple[int, int]]]:
+        """Диапазоны, товары которых помещаются в `shard_size`, и диапазоны для деления пополам.
+
+        Соседние половины пересекаются по цене на границе, повторы товаров отсеиваются при парсинге.
+        """
+        shards, price_ranges = [], []
+        for (low, high), response_json in probes:
+            item_count_total = int(response_json["total"])
+            if not item_count_total:
+                continue
+            if item_count_total <= self.shard_size or high - low <= 1:
+                if item_count_total > self.shard_size:
+                    self.logger.warning("В диапазоне цен %s-%s товаров %s, больше %s", low, high, item_count_total, self.shard_size)
+                shards.append((f"{low}-{high}", response_json))
+                continue
+            middle = (low + high) // 2
+            price_ranges += [(low, middle), (middle, high)]
+        return shards, price_ranges
+
+    def _sharded_pages(self, items_per_page: int) -> list[tuple[str, int]]:
+        """Разделить выдачу на диапазоны цен не больше `shard_size` товаров и вернуть их страницы"""
+        price_ranges, shards = [self._price_bounds()], []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            while price_ranges:
+                level_shards, price_ranges = self._split_shards(list(zip(price_ranges, executor.map(self._probe_shard, price_ranges))))
+                shards += level_shards
+            last_offsets = list(
+                executor.map(lambda shard: self._find_last_page(shard[1], items_per_page, int(shard[1]["total"]), shard[0]), shards)
+            )
+        self.logger.info("Диапазонов цен: %s", len(shards))
+        return [(shard, offset) for (shard, _), last_offset in zip(shards, last_offsets) for offset in range(0, last_offset + 1, items_per_page)]
+
+    def _process_page(self, page: tuple[str, int], main_job, response_json: dict | None = None) -> bool:
         """Получение и парсинг страницы каталога или поиска"""
-        response_json = self._get_page(offset)
+        if self.stop_event.is_set():
+            raise ParsingStopped()
+        shard, offset = page
+        response_json = response_json or self._get_page(offset, shard=shard)
         parse_next_page = self._parse_page(response_json)
+        self._save_page_checkpoint(page, parse_next_page)
         self.rich_progress.update(main_job, advance=1)
         return parse_next_page
 
-    def _parse_multi_page(self) -> None:
-        """Запуск и менеджмент парсинга каталога или поиска"""
+    @profiled("crawl")
+    def _parse_multi_page(self) -> bool:
+        """Запуск и менеджмент парсинга каталога или поиска, вернуть True при редиректе"""
         start_offset = 0
-        response_json = self._get_page(start_offset)
+        response_json = self._get_first_page()
         if len(response_json["items"]) == 0 and response_json["processor"]["type"] in ("MENU_NODE", "COLLECTION"):
             self.logger.debug("Редирект в каталог")
             self.url = urljoin("https://megamarket.ru", response_json["processor"]["url"])
-            return self.parse()
-        items_per_page = int(response_json.get("limit"))
+            return True
+        items_per_page = min(int(response_json.get("limit")), self.page_limit)
         item_count_total = int(response_json["total"])
 
-        pages_to_parse = list(range(start_offset, item_count_total, items_per_page))
+        if self.shard_size and items_per_page and item_count_total > self.shard_size:
+            pages = self._sharded_pages(items_per_page)
+        else:
+            last_offset = self._find_last_page(response_json, items_per_page, item_count_total) if items_per_page else 0
+            pages = [("", offset) for offset in range(start_offset, last_offset + 1, items_per_page or 1)]
+        window = PageWindow(self._remaining_pages(pages), self.threads)
         self._create_progress_bar()
-        main_job = self.rich_progress.add_task("[green]Общий прогресс", total=len(pages_to_parse))
-        max_threads = min(len(pages_to_parse), self.threads)
-        while pages_to_parse:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-                futures = {executor.submit(self._process_page, page, main_job): page for page in pages_to_parse}
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        parse_next_page = future.result()
-                    except Exception:
-                        continue
-                    page = futures[future]
-                    if page in pages_to_parse:
-                        pages_to_parse.remove(page)
-                    if not parse_next_page:
-                        self.logger.info("Дальше товары не в наличии, их не парсим")
-                        for fut in futures:
-                            future_page = futures[fut]
-                            if future_page > page:
-                                if future_page in pages_to_parse:
-                                    pages_to_parse.remove(future_page)
-                                self.rich_progress.update(main_job, total=len(pages_to_parse))
-                                fut.cancel()
-        self.rich_progress.stop()
+        try:
+            main_job = self.rich_progress.add_task("[green]Общий прогресс", total=window.total)
+            # пулы закрываются и при ошибке, иначе их потоки остаются после каждого неудачного запуска демона
+            with (
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as self.offers_executor,
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as self.merchant_executor,
+                concurrent.futures.ThreadPoolExecutor(max_workers=window.size) as executor,
+            ):
+                futures: dict[concurrent.futures.Future, tuple[str, int]] = {}
+                while not window.finished:
+                    if not self.stop_event.is_set():
+                        for page in window.take():
+                            # первая страница уже получена
+                            first_page = response_json if page == ("", start_offset) and not window.tries.get(page) else None
+                            futures[executor.submit(self._process_page, page, main_job, first_page)] = page
+                    if not futures:
+                        break
+                    done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        exception = future.exception()
+                        self._page_finished(window, futures.pop(future), exception, None if exception else future.result())
+                    self.rich_progress.update(main_job, total=window.total)
+        finally:
+            self.rich_progress.stop()
+        return False
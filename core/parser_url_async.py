@@ -0,0 +1,344 @@
+"""mmparser, asyncio движок"""
+
+import asyncio
+from time import perf_counter, time
+from urllib.parse import urljoin
+
+from curl_cffi import requests, AsyncCurl
+
+from .models import Connection, PageWindow, ParsedOffer
+from .connection_pool import AsyncConnectionPool, SessionPool
+from .exceptions import ApiError, ParsingStopped
+from .parser_url import Parser_url, CURL_INFOS, PAGE_LIMIT, PAGE_LIMIT_CANDIDATES, PAGE_LIMIT_PROBE_TRIES
+from .profiling import profiled
+from . import utils
+
+
+class Parser_url_async(Parser_url):
+    """Парсер с asyncio движком.
+
+    Настройка, профиль, адрес и разбор url выполняются как в `Parser_url`.
+    Страницы, предложения и запросы ИНН продавцов выполняются корутинами
+    в одном event loop через `AsyncSession` curl_cffi, без потока на каждое соединение.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.async_curl: AsyncCurl | None = None
+        self.async_session_pool: SessionPool | None = None
+        self.async_connection_pool: AsyncConnectionPool | None = None
+        self.merchant_inn_tasks: dict[str, asyncio.Task] = {}
+
+    def _new_async_session(self, connection: Connection) -> requests.AsyncSession:
+        """Создание новой асинхронной сессии для `Соединения`, на общем `AsyncCurl`"""
+        session = requests.AsyncSession(
+            impersonate="chrome",
+            proxy=connection.proxy_string,
+            async_curl=self.async_curl,
+            max_clients=1,
+            curl_infos=CURL_INFOS,
+        )
+        session.cookies.update(self.cookie_dict or {})
+        session.cookies["adult_disclaimer_confirmed"] = "1"
+        return session
+
+    def _run(self, coroutine):
+        """Запустить корутину в новом event loop с асинхронной сессией"""
+
+        async def runner():
+            self.async_curl = AsyncCurl()
+            self.async_session_pool = SessionPool(self._new_async_session)
+            self.async_connection_pool = AsyncConnectionPool(self.connections)
+            try:
+                return await coroutine
+            finally:
+                await self.async_session_pool.aclose()
+                await self.async_curl.close()
+                self.async_curl = None
+
+        return asyncio.run(runner())
+
+    async def _get_connection_async(self) -> Connection:
+        """Дождаться и занять самое позднее использованное `Соединение`"""
+        wait_start = perf_counter()
+        connection = await self.async_connection_pool.acquire()
+        self.metrics.observe_wait(perf_counter() - wait_start)
+        return connection
+
+    async def _api_request_async(self, api_url: str, json_data: dict, tries: int = 10, rate_limited: bool = False) -> dict:
+        json_data = self._prepare_api_payload(json_data)
+        cache_key = self._api_cache_key(api_url, json_data)
+        cached_response = self._load_cached_response(api_url, cache_key)
+        if cached_response is not None:
+            return cached_response
+        endpoint = self._endpoint(api_url)
+        for i in range(0, tries):
+            if i:
+                self.metrics.observe_retry(endpoint)
+            proxy = await self._get_connection_async()
+            self.logger.debug("Прокси : %s", proxy.proxy_string)
+            request_start = time()
+            error = None
+            try:
+                response = await self.async_session_pool.get(proxy).post(api_url, json=json_data, verify=False)
+                SessionPool.count_handshakes(proxy, response)
+                response_data: dict = response.json()
+            except asyncio.CancelledError:
+                self.async_connection_pool.release(proxy)
+                raise
+            except Exception as exc:
+                response = response_data = None
+                error = type(exc).__name__
+                self.logger.debug("Ошибка запроса %s через %s: %s", endpoint, proxy.proxy_string, exc)
+            latency = time() - request_start
+            success = self._update_connection(proxy, response, response_data, rate_limited, latency)
+            self.async_connection_pool.release(proxy)
+            self._observe_request(endpoint, proxy, response, response_data, success, latency, error)
+            if success:
+                self._cache_response(cache_key, response_data)
+                return response_data
+            if not self._is_throttled(response, response_data):
+                await asyncio.sleep(1 * i)
+
+        self.metrics.observe_failure(endpoint)
+        raise ApiError("Ошибка получения данных api")
+
+    async def _request_merchant_inn_async(self, merchant_id: str) -> str:
+        """Запросить ИНН по ID продавца"""
+        json_data = {"merchantId": merchant_id}
+        try:
+            response_json = await self._api_request_async(f"{self.api_base_url}/partnerService/merchant/legalInfo/get", json_data)
+        finally:
+            self.merchant_inn_tasks.pop(merchant_id, None)
+        merchant_inn = response_json["merchant"]["legalInfo"]["inn"]
+        self._cache_merchant_inn(merchant_id, merchant_inn)
+        return merchant_inn
+
+    async def _get_merchant_inn_async(self, merchant_id: str) -> str:
+        """Получить ИНН по ID продавца из кэша или api, одновременные запросы одного продавца объединяются"""
+        merchant_inn = self.merchant_inns.get(merchant_id)
+        if merchant_inn is not None:
+            return merchant_inn
+        inn_task = self.merchant_inn_tasks.get(merchant_id)
+        if inn_task is None:
+            inn_task = self.merchant_inn_tasks[merchant_id] = asyncio.create_task(self._request_merchant_inn_async(merchant_id))
+        return await asyncio.shield(inn_task)
+
+    async def _prefetch_merchant_inns_async(self, merchant_ids) -> None:
+        """Заранее получить ИНН неизвестных продавцов, параллельно"""
+        if not self.use_merchant_blacklist:
+            return
+        unknown_ids = {merchant_id for merchant_id in merchant_ids if merchant_id not in self.merchant_inns}
+        if unknown_ids:
+            self.logger.debug("Запрос ИНН %s продавцов", len(unknown_ids))
+            await asyncio.gather(*(self._get_merchant_inn_async(merchant_id) for merchant_id in unknown_ids), return_exceptions=True)
+
+    @profiled("get_offers")
+    async def _get_offers_async(self, goods_id: str, rate_limited: bool = False) -> list[dict]:
+        """Получить список предложений товара"""
+        json_data = self._offers_payload(goods_id)
+        response_json = await self._api_request_async(f"{self.api_base_url}/catalogService/productOffers/get", json_data, rate_limited=rate_limited)
+        return response_json["offers"]
+
+    @profiled("get_page")
+    async def _get_page_async(self, offset: int, limit: int | None = None, tries: int = 10, shard: str = "") -> dict:
+        """Получить страницу каталога или поиска, с `shard` - страницу диапазона цен"""
+        json_data = self._page_payload(offset, limit or self.page_limit, shard)
+        response_json = await self._api_request_async(
+            f"{self.api_base_url}/catalogService/catalog/search",
+            json_data,
+            tries=tries,
+            rate_limited=True,
+        )
+        if response_json.get("error"):
+            raise ApiError()
+        if response_json.get("success") is True:
+            return response_json
+
+    async def _parse_item_async(self, item: dict) -> ParsedOffer | None:
+        """Парсинг дефолтного предложения товара, None если продавец исключен"""
+        merchant_name = item["favoriteOffer"]["merchantName"]
+        if self._is_merchant_skipped(merchant_name):
+            return None
+        if self.use_merchant_blacklist and self._is_merchant_skipped(merchant_name, await self._get_merchant_inn_async(item["favoriteOffer"]["merchantId"])):
+            return None
+        return self._item_to_parsed_offer(item)
+
+    async def _parse_offer_async(self, item: dict, offer: dict) -> ParsedOffer | None:
+        """Парсинг предложения товара, None если продавец исключен"""
+        if self._is_merchant_skipped(offer["merchantName"]):
+            return None
+        if self.use_merchant_blacklist and self._is_merchant_skipped(offer["merchantName"], await self._get_merchant_inn_async(offer["merchantId"])):
+            return None
+        return self._offer_to_parsed_offer(item, offer)
+
+    async def _parse_offers_async(self, item: dict, rate_limited: bool = False) -> None:
+        """Получение и парсинг всех предложений товара"""
+        offers = await self._get_offers_async(item["goodsId"], rate_limited=rate_limited)
+        await self._prefetch_merchant_inns_async(offer["merchantId"] for offer in offers if offer["merchantName"] not in self.blacklist)
+        self._process_parsed_offers(await asyncio.gather(*(self._parse_offer_async(item, offer) for offer in offers)))
+
+    @profiled("parse_page")
+    async def _parse_page_async(self, response_json: dict) -> bool:
+        """Парсинг страницы каталога или поиска"""
+        items_per_page = int(response_json.get("limit"))
+        if items_per_page == 0:
+            # костыль для косяка мм
+            return False
+        items = self._claim_items(response_json["items"])
+        page_progress = self.rich_progress.add_task(f"[orange]Страница {int(int(response_json.get('offset')) / items_per_page) + 1}")
+        self.rich_progress.update(page_progress, total=len(items))
+        page_offers: list[ParsedOffer | None] = []
+
+        async def parse(item: dict) -> None:
+            if not self._is_item_skipped(item):
+                if self._needs_offers(item):
+                    if self._is_listing_unchanged(item):
+                        self._skip_unchanged_offers(item)
+                    else:
+                        self.logger.info("Парсим предложения %s", item["goods"]["title"])
+                        await self._parse_offers_async(item["goods"], rate_limited=True)
+                        self._save_listing_signature(item)
+                else:
+                    page_offers.append(await self._parse_item_async(item))
+            self._advance_page_progress(page_progress)
+
+        try:
+            await self._prefetch_merchant_inns_async(
+                item["favoriteOffer"]["merchantId"]
+                for item in items
+                if not self._is_item_skipped(item) and not self._needs_offers(item) and item["favoriteOffer"]["merchantName"] not in self.blacklist
+            )
+            await asyncio.gather(*(parse(item) for item in items))
+            self._process_parsed_offers(page_offers)
+        except BaseException:
+            # страница будет спаршена повторно
+            self._release_items(items)
+            raise
+        finally:
+            self.rich_progress.remove_task(page_progress)
+        parse_next_page = response_json["items"] and response_json["items"][-1]["isAvailable"]
+        return parse_next_page
+
+    async def _get_first_page_async(self) -> dict:
+        """Первая страница каталога или поиска с наибольшим размером страницы, который принимает api"""
+        page_limit = self._load_page_limit()
+        if page_limit:
+            self.page_limit = page_limit
+            return await self._get_page_async(0)
+        for limit in PAGE_LIMIT_CANDIDATES:
+            try:
+                response_json = await self._get_page_async(0, limit, tries=PAGE_LIMIT_PROBE_TRIES)
+            except ApiError:
+                self.logger.debug("Размер страницы %s не принят api", limit)
+                continue
+            self.page_limit = self._accepted_page_limit(limit, response_json)
+            return response_json
+        self.page_limit = PAGE_LIMIT
+        return await self._get_page_async(0)
+
+    async def _is_item_available_async(self, offset: int, shard: str = "") -> bool:
+        """Запросить один товар выдачи, в наличии ли он"""
+        items = (await self._get_page_async(offset, limit=1, shard=shard))["items"]
+        return bool(items) and items[0]["isAvailable"] is True
+
+    async def _find_last_page_async(self, response_json: dict, items_per_page: int, item_count_total: int, shard: str = "") -> int:
+        """Offset последней страницы, которую нужно парсить, см. `Parser_url._find_last_page`"""
+        last_offset = (item_count_total - 1) // items_per_page * items_per_page
+        items = response_json["items"]
+        if last_offset <= 0 or not items or items[-1]["isAvailable"] is not True:
+            return 0
+        if await self._is_item_available_async(item_count_total - 1, shard):
+            return last_offset
+        low, high = 0, last_offset // items_per_page
+        while high - low > 1:
+            middle = (low + high) // 2
+            if await self._is_item_available_async(middle * items_per_page + items_per_page - 1, shard):
+                low = middle
+            else:
+                high = middle
+        self.logger.info("Товары в наличии на %s страницах из %s", high + 1, last_offset // items_per_page + 1)
+        return high * items_per_page
+
+    async def _probe_shard_async(self, price_range: tuple[int, int]) -> dict:
+        """Первый товар диапазона цен, для числа товаров в нем"""
+        return await self._get_page_async(0, limit=1, shard=self._add_shard(*price_range))
+
+    async def _sharded_pages_async(self, items_per_page: int) -> list[tuple[str, int]]:
+        """Разделить выдачу на диапазоны цен, см. `Parser_url._sharded_pages`"""
+        price_ranges, shards = [self._price_bounds()], []
+        while price_ranges:
+            probes = await asyncio.gather(*(self._probe_shard_async(price_range) for price_range in price_ranges))
+            level_shards, price_ranges = self._split_shards(list(zip(price_ranges, probes)))
+            shards += level_shards
+        last_offsets = await asyncio.gather(
+            *(self._find_last_page_async(response_json, items_per_page, int(response_json["total"]), shard) for shard, response_json in shards)
+        )
+        self.logger.info("Диапазонов цен: %s", len(shards))
+        return [(shard, offset) for (shard, _), last_offset in zip(shards, last_offsets) for offset in range(0, last_offset + 1, items_per_page)]
+
+    async def _process_page_async(self, page: tuple[str, int], main_job, response_json: dict | None = None) -> bool:
+        """Получение и парсинг страницы каталога или поиска"""
+        if self.stop_event.is_set():
+            raise ParsingStopped()
+        shard, offset = page
+        response_json = response_json or await self._get_page_async(offset, shard=shard)
+        parse_next_page = await self._parse_page_async(response_json)
+        self._save_page_checkpoint(page, parse_next_page)
+        self.rich_progress.update(main_job, advance=1)
+        return parse_next_page
+
+    async def _parse_multi_page_async(self) -> bool:
+        """Запуск и менеджмент парсинга каталога или поиска, вернуть True при редиректе"""
+        start_offset = 0
+        response_json = await self._get_first_page_async()
+        if len(response_json["items"]) == 0 and response_json["processor"]["type"] in ("MENU_NODE", "COLLECTION"):
+            self.logger.debug("Редирект в каталог")
+            self.url = urljoin("https://megamarket.ru", response_json["processor"]["url"])
+            return True
+        items_per_page = min(int(response_json.get("limit")), self.page_limit)
+        item_count_total = int(response_json["total"])
+
+        if self.shard_size and items_per_page and item_count_total > self.shard_size:
+            pages = await self._sharded_pages_async(items_per_page)
+        else:
+            last_offset = await self._find_last_page_async(response_json, items_per_page, item_count_total) if items_per_page else 0
+            pages = [("", offset) for offset in range(start_offset, last_offset + 1, items_per_page or 1)]
+        window = PageWindow(self._remaining_pages(pages), self.threads)
+        self._create_progress_bar()
+        tasks: dict[asyncio.Task, tuple[str, int]] = {}
+        try:
+            main_job = self.rich_progress.add_task("[green]Общий прогресс", total=window.total)
+            while not window.finished:
+                if not self.stop_event.is_set():
+                    for page in window.take():
+                        # первая страница уже получена
+                        first_page = response_json if page == ("", start_offset) and not window.tries.get(page) else None
+                        tasks[asyncio.create_task(self._process_page_async(page, main_job, first_page))] = page
+                if not tasks:
+                    break
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    exception = task.exception()
+                    self._page_finished(window, tasks.pop(task), exception, None if exception else task.result())
+                self.rich_progress.update(main_job, total=window.total)
+        finally:
+            # при ошибке начатые страницы отменяются, полоса прогресса останавливается
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.rich_progress.stop()
+        return False
+
+    @profiled("crawl")
+    def _parse_multi_page(self) -> bool:
+        """Запуск парсинга каталога или поиска в event loop, вернуть True при редиректе"""
+        return self._run(self._parse_multi_page_async())
+
+    def _parse_card(self) -> None:
+        """Парсинг карточки товара"""
+        item = self._get_card_info(self.parsed_url["goods"]["goodsId"])
+        self.job_name = utils.slugify(item["title"])
+        self._start_job()
+        self._run(self._parse_offers_async(item))
@@ -0,0 +1,218 @@
+"""Профилирование запуска задачи: cProfile, tracemalloc и время этапов парсинга"""
+
+import cProfile
+import contextvars
+import functools
+import inspect
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+# cProfile и tracemalloc глобальны для процесса, одновременно профилируется одна задача
+_profiling_lock = threading.Lock()
+
+# Стек этапов текущего потока или задачи asyncio
+_span_stack: contextvars.ContextVar[tuple[str, ...]] = contextvars.ContextVar("mmparser_span_stack", default=())
+
+MEMORY_TOP = 30
+
+# С Python 3.12 cProfile работает через sys.monitoring: в процессе может быть включен только один
+# профилировщик, и он видит все потоки. До 3.12 cProfile включается в каждом потоке отдельно
+PROCESS_WIDE_PROFILE = sys.version_info >= (3, 12)
+
+
+class SpanStats:
+    __slots__ = ("count", "total", "max", "children")
+
+    def __init__(self):
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.children: float = 0.0
+
+    @property
+    def self_time(self) -> float:
+        """Время без вложенных этапов. Вложенные этапы asyncio идут параллельно, поэтому не меньше нуля"""
+        return max(0.0, self.total - self.children)
+
+
+class Profiler:
+    """Профилировщик запуска задачи.
+
+    `span` замеряет время этапа, вложенные этапы образуют стек, как в flame graph.
+    Между `start` и `stop` работают cProfile для всех потоков и tracemalloc.
+    Если cProfile занят другим инструментом, замеряется только время этапов и память.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.lock = threading.Lock()
+        self.spans: dict[tuple[str, ...], SpanStats] = {}
+        self.running: bool = False
+        self.owns_profiling: bool = False
+        self.profile: cProfile.Profile | None = None
+        self.thread_profiles: list[cProfile.Profile] = []
+        self.memory_start: tracemalloc.Snapshot | None = None
+        self.memory_end: tracemalloc.Snapshot | None = None
+        self.memory_peak: int = 0
+        self.started_tracemalloc: bool = False
+        self.cprofile_error: str | None = None
+
+    @contextmanager
+    def span(self, name: str):
+        """Замерить время этапа"""
+        parent = _span_stack.get()
+        path = parent + (name,)
+        token = _span_stack.set(path)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            duration = perf_counter() - start
+            _span_stack.reset(token)
+            with self.lock:
+                stats = self.spans.get(path)
+                if stats is None:
+                    stats = self.spans[path] = SpanStats()
+                stats.count += 1
+                stats.total += duration
+                stats.max = max(stats.max, duration)
+                if parent:
+                    self.spans.setdefault(parent, SpanStats()).children += duration
+
+    def _profile_thread(self, frame, event, arg) -> None:
+        """Включить отдельный cProfile в новом потоке, вызывается через `threading.setprofile`"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # профилировщик не должен ронять сам поток, снимаем хук только в этом потоке
+            sys.setprofile(None)
+            return
+        with self.lock:
+            self.thread_profiles.append(profile)
+
+    def start(self) -> bool:
+        """Включить cProfile и tracemalloc, вернуть False если уже профилируется другая задача"""
+        self.running = True
+        self.owns_profiling = _profiling_lock.acquire(blocking=False)
+        if not self.owns_profiling:
+            return False
+        self.thread_profiles = []
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        self.memory_start = tracemalloc.take_snapshot()
+        self.cprofile_error = None
+        self.profile = cProfile.Profile()
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            self.profile = None
+            self.cprofile_error = str(e)
+            return True
+        if not PROCESS_WIDE_PROFILE:
+            threading.setprofile(self._profile_thread)
+        return True
+
+    def stop(self) -> None:
+        self.running = False
+        if not self.owns_profiling:
+            return
+        if self.profile is not None:
+            self.profile.disable()
+            if not PROCESS_WIDE_PROFILE:
+                threading.setprofile(None)
+        self.memory_end = tracemalloc.take_snapshot()
+        self.memory_peak = tracemalloc.get_traced_memory()[1]
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        _profiling_lock.release()
+        self.owns_profiling = False
+
+    def stats(self) -> pstats.Stats | None:
+        """Объединенная статистика cProfile основного потока и рабочих потоков"""
+        stats = None
+        for profile in [self.profile, *self.thread_profiles]:
+            if profile is None:
+                continue
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        return stats
+
+    def collapsed(self) -> str:
+        """Этапы в формате collapsed stacks для flamegraph.pl и speedscope, собственное время в микросекундах"""
+        with self.lock:
+            lines = [f"{';'.join(path)} {round(stats.self_time * 1e6)}" for path, stats in sorted(self.spans.items()) if stats.count]
+        return "\n".join(lines) + "\n"
+
+    def memory_top(self, limit: int = MEMORY_TOP) -> list[tracemalloc.StatisticDiff]:
+        """Строки кода с наибольшим приростом памяти за запуск"""
+        if not self.memory_start or not self.memory_end:
+            return []
+        return self.memory_end.compare_to(self.memory_start, "lineno")[:limit]
+
+    def span_summary(self) -> list[tuple[str, int, float, float, float]]:
+        """Этапы по убыванию общего времени: путь, количество, общее, среднее и максимальное время"""
+        with self.lock:
+            rows = [(";".join(path), stats.count, stats.total, stats.total / stats.count, stats.max) for path, stats in self.spans.items() if stats.count]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def write(self, job_name: str) -> list[Path]:
+        """Записать pstats, collapsed stacks этапов и прирост памяти в папку, вернуть пути файлов"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"mmparser_{job_name or 'job'}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        paths = []
+        stats = self.stats()
+        if stats is not None:
+            pstats_path = self.directory / f"{name}.pstats"
+            stats.dump_stats(pstats_path)
+            paths.append(pstats_path)
+        collapsed_path = self.directory / f"{name}.collapsed"
+        collapsed_path.write_text(self.collapsed(), encoding="utf-8")
+        paths.append(collapsed_path)
+        memory_top = self.memory_top()
+        if memory_top:
+            memory_path = self.directory / f"{name}.memory.txt"
+            lines = [f"Пик памяти: {self.memory_peak / 2**20:.1f} МБ", *map(str, memory_top)]
+            memory_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+            paths.append(memory_path)
+        return paths
+
+
+def profiled(name: str):
+    """Декоратор метода парсера: замерить время этапа `name`, если включено профилирование"""
+
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                if self.profiler is None:
+                    return await method(self, *args, **kwargs)
+                with self.profiler.span(name):
+                    return await method(self, *args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return method(self, *args, **kwargs)
+            with self.profiler.span(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
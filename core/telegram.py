@@ -1,7 +1,29 @@
+import queue
+import re
+import threading
+from time import monotonic, sleep
+
 from curl_cffi import requests
 
+# Лимиты Telegram: не чаще 1 сообщения в секунду в личный чат и 20 в минуту в группу
+CHAT_INTERVAL = 1.0
+GROUP_INTERVAL = 3.0
+SEND_TRIES = 5
+MESSAGE_LIMIT = 4096
+QUEUE_SIZE = 1000
+
+# Время последней отправки по чатам, общее для всех клиентов процесса
+_chat_sent_at: dict[tuple[str, str], float] = {}
+_chat_lock = threading.Lock()
+
+# Конфиги, прошедшие проверку, ошибки не кэшируются: токен или сеть могут заработать при следующей проверке
+_valid_tg_configs: set[str] = set()
+
 
 def validate_tg_credentials(tg_config: str):
+    if tg_config in _valid_tg_configs:
+        return True
+
     def is_valid_token(bot_token):
         url = f"https://api.telegram.org/bot{bot_token}/getMe"
         return requests.get(url).ok
@@ -18,6 +40,7 @@ def validate_tg_credentials(tg_config: str):
         return False
     if not is_valid_token(bot_token) or not is_valid_chat_id(bot_token, chat_id):
         return False
+    _valid_tg_configs.add(tg_config)
     return True
 
 
@@ -28,23 +51,169 @@ class TelegramClient:
         self.logger = logger
         if not self.bot_token or not self.chat_id:
             raise Exception("Не валидный конфиг Telegram!")
+        # сессия переиспользует соединение с api, curl не потокобезопасен
+        self.session = requests.Session()
+        self.session_lock = threading.Lock()
+
+    def _wait_chat_slot(self) -> None:
+        """Дождаться, когда в чат можно отправить следующее сообщение"""
+        interval = GROUP_INTERVAL if self.chat_id.startswith("-") else CHAT_INTERVAL
+        key = (self.bot_token, self.chat_id)
+        with _chat_lock:
+            now = monotonic()
+            send_at = max(now, _chat_sent_at.get(key, 0) + interval)
+            _chat_sent_at[key] = send_at
+        if send_at > now:
+            sleep(send_at - now)
+
+    def _send(self, method: str, params: dict) -> None:
+        """Отправить запрос к Bot API, при 429 подождать `retry_after` и повторить"""
+        url = f"https://api.telegram.org/bot{self.bot_token}/{method}"
+        for attempt in range(1, SEND_TRIES + 1):
+            self._wait_chat_slot()
+            with self.session_lock:
+                response = self.session.post(url, json=params)
+            if response.status_code != 429 or attempt == SEND_TRIES:
+                response.raise_for_status()
+                return
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 1)
+            except (ValueError, AttributeError):
+                # 429 от прокси или балансировщика может прийти не в JSON
+                retry_after = 1
+            self.logger.warning("Слишком частые уведомления в TG, повтор через %s с", retry_after)
+            sleep(retry_after)
 
     def notify(self, message, image_url=None):
         if image_url:
-            base_url = f"https://api.telegram.org/bot{self.bot_token}/sendPhoto"
             params = {"chat_id": self.chat_id, "caption": message, "photo": image_url, "parse_mode": "HTML"}
             try:
-                response = requests.get(base_url, params=params)
-                response.raise_for_status()
+                self._send("sendPhoto", params)
                 self.logger.info("Уведомление успешно отправлено!")
+                return True
             except Exception as e:
                 self.logger.info(f"Ошибка отправки сообщения с картинкой: {e}")
+                return False
         else:
-            base_url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
             params = {"chat_id": self.chat_id, "text": message, "parse_mode": "HTML"}
             try:
-                response = requests.get(base_url, params=params)
-                response.raise_for_status()
+                self._send("sendMessage", params)
                 self.logger.info("Сообщение успешно отправлено!")
+                return True
             except Exception as e:
                 self.logger.info(f"Ошибка отправки сообщения: {e}")
+                return False
+
+
+def fit_message(message: str, limit: int = MESSAGE_LIMIT) -> str:
+    """Обрезать сообщение до `limit` по границам строк, каждая строка уведомления - законченный HTML"""
+    if len(message) <= limit:
+        return message
+    fitted = ""
+    for line in message.split("\n"):
+        candidate = f"{fitted}\n{line}" if fitted else line
+        if len(candidate) > limit:
+            break
+        fitted = candidate
+    if fitted:
+        return fitted
+    # первая строка длиннее лимита: без тегов и не разрывая HTML-сущность в конце
+    text = re.sub(r"<[^>]*>", "", message.split("\n")[0])[:limit]
+    return re.sub(r"&[^;\s]*$", "", text)
+
+
+def split_digest(messages: list[str], limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Собрать сообщения в дайджесты не длиннее `limit`, не разрывая сообщения и HTML разметку"""
+    digests, current = [], ""
+    for message in messages:
+        message = fit_message(message, limit)
+        if current and len(current) + 2 + len(message) > limit:
+            digests.append(current)
+            current = ""
+        current = f"{current}\n\n{message}" if current else message
+    if current:
+        digests.append(current)
+    return digests
+
+
+class NotificationQueue:
+    """Очередь уведомлений с одним фоновым отправителем.
+
+    Потоки парсинга только кладут уведомление в ограниченную очередь и не ждут Telegram,
+    при переполнении уведомление отбрасывается. С `digest_interval` уведомления копятся
+    и отправляются одним сообщением раз в `digest_interval` секунд, без картинок.
+    """
+
+    def __init__(self, send, logger, digest_interval: float = 0, maxsize: int = QUEUE_SIZE):
+        self.send = send
+        self.logger = logger
+        self.digest_interval = digest_interval
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.thread: threading.Thread | None = None
+        self.start_lock = threading.Lock()
+        self.dropped: int = 0
+
+    def _ensure_started(self) -> None:
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="NotificationQueue", daemon=True)
+                self.thread.start()
+
+    def put(self, message: str, image_url: str | None = None) -> bool:
+        """Поставить уведомление в очередь, вернуть False если очередь переполнена"""
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((message, image_url))
+        except queue.Full:
+            self.dropped += 1
+            self.logger.warning("Очередь уведомлений переполнена, уведомление отброшено")
+            return False
+        return True
+
+    def flush(self) -> None:
+        """Дождаться отправки всех уведомлений, включая накопленный дайджест"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        """Отправить очередь и остановить отправителя"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+    def _deliver(self, message: str, image_url: str | None = None) -> None:
+        try:
+            self.send(message, image_url)
+        except Exception:
+            self.logger.exception("Ошибка отправки уведомления")
+
+    def _run(self) -> None:
+        messages: list[str] = []
+        deadline = monotonic() + self.digest_interval
+        while True:
+            timeout = max(0, deadline - monotonic()) if messages else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if isinstance(item, tuple) and item:
+                if not self.digest_interval:
+                    self._deliver(*item)
+                    continue
+                if not messages:
+                    deadline = monotonic() + self.digest_interval
+                messages.append(item[0])
+                if monotonic() < deadline:
+                    continue
+            if messages:
+                for digest in split_digest(messages):
+                    self._deliver(digest)
+                messages = []
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
@@ -1,24 +1,18 @@
 from pathlib import Path
 import re
 import json
+import os
 import time
-import pkg_resources
-from curl_cffi import requests
+from importlib import metadata
 from rich.console import Console
-from packaging import version
 
 from . import exceptions
 
-try:
-    from lxml import html
-except ImportError:
-    _has_lxml = False
-else:
-    _has_lxml = True
-
 BLACKLIST_URL = "https://megamarket.ru/promo/prodavtsy-s-oghranichieniiem-na-spisaniie-bonusov/"
 BLACKLIST_FILE = "merchant_blacklist.txt"
 UPDATE_INTERVAL = 86400  # 24 часа
+VERSION_CHECK_FILE = "mmparser_latest_version.txt"
+NO_VERSION_CHECK_ENV = "MMPARSER_NO_VERSION_CHECK"
 
 
 def print_logo():
@@ -79,6 +73,16 @@ def remove_chars(text: str) -> str:
 
 
 def parse_blacklist_page() -> set[str]:
+    # curl_cffi и lxml импортируются только при обновлении блеклиста, чтобы не замедлять запуск
+    from curl_cffi import requests
+
+    try:
+        from lxml import html
+    except ImportError:
+        _has_lxml = False
+    else:
+        _has_lxml = True
+
     response = requests.get(BLACKLIST_URL)
     html_content = response.text
 
@@ -120,25 +124,37 @@ def load_blacklist() -> set[str]:
 
 def get_current_version(package_name: str) -> str | None:
     try:
-        current_version = pkg_resources.get_distribution(package_name).version
-        return current_version
-    except pkg_resources.DistributionNotFound:
+        return metadata.version(package_name)
+    except metadata.PackageNotFoundError:
         return None
 
 
 def get_latest_version(package_name: str) -> str | None:
-    url = f"https://api.github.com/repos/xob0t/{package_name}/releases/latest"
+    version_check_path = Path(VERSION_CHECK_FILE)
+    if version_check_path.exists() and time.time() - version_check_path.stat().st_mtime < UPDATE_INTERVAL:
+        return version_check_path.read_text(encoding="utf-8").strip() or None
+
+    from curl_cffi import requests
 
+    url = f"https://api.github.com/repos/xob0t/{package_name}/releases/latest"
     try:
         response = requests.get(url, impersonate="chrome", timeout=2)
         response.raise_for_status()
         data = response.json()
-        return data.get("tag_name", "")
+        latest_version = data.get("tag_name", "")
     except Exception:
-        return None
+        # неудачная проверка тоже запоминается, без сети запуск не ждет таймаут каждый раз
+        latest_version = ""
+    # последняя версия запрашивается у GitHub не чаще раза в сутки
+    version_check_path.write_text(latest_version, encoding="utf-8")
+    return latest_version or None
+
 
+def check_for_new_version(skip: bool = False) -> None:
+    if skip or os.environ.get(NO_VERSION_CHECK_ENV):
+        return
+    from packaging import version
 
-def check_for_new_version() -> None:
     console = Console(highlight=False)
     package_name = "mmparser"
     current_version = get_current_version(package_name)
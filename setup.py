@@ -8,7 +8,6 @@ setup(
     url="https://github.com/xob0t/mmparser",
     packages=find_packages(),
     install_requires=[
-        "setuptools",
         "rich",
         "rich-argparse",
         "curl-cffi",
@@ -17,6 +16,7 @@ setup(
     ],
     extras_require={
         "lxml": ["lxml"],
+        "parquet": ["pyarrow"],
     },
     entry_points={"console_scripts": ["mmparser = core.main:main"]},
 )
@@ -0,0 +1,61 @@
+import json
+import unittest
+
+from core.alerts import compile_rules, threshold_rules
+from core.exceptions import ConfigError
+from core.models import ParsedOffer
+
+
+def make_offer(title: str = "Смартфон Apple iPhone", price: float = 10000, bonus_amount: int = 0, quantity: int = 5, merchant_name: str = "Продавец") -> ParsedOffer:
+    return ParsedOffer(
+        title=title,
+        url="",
+        image_url="",
+        price=price,
+        price_bonus=price - bonus_amount,
+        bonus_amount=bonus_amount,
+        available_quantity=quantity,
+        goods_id="1",
+        delivery_date="",
+        merchant_id="1",
+        merchant_name=merchant_name,
+    )
+
+
+class TestAlertRules(unittest.TestCase):
+    def test_rules(self):
+        rule = compile_rules(
+            [
+                {"bonus_percent": {"min": 30}, "price": {"max": 20000}},
+                {"any": [{"title": "samsung"}, {"merchant": "^мега"}], "price_bonus": [None, 5000], "not": {"quantity": [None, 1]}},
+            ]
+        )
+        offers = [
+            make_offer(bonus_amount=3000),
+            make_offer(price=30000, bonus_amount=10000),
+            make_offer(title="Samsung Galaxy", price=4000),
+            make_offer(title="Samsung Galaxy", price=4000, quantity=1),
+            make_offer(price=4000, merchant_name="Мегамаркет"),
+            make_offer(price=4000),
+        ]
+        self.assertEqual(rule(offers), [True, False, True, False, True, False])
+
+    def test_thresholds(self):
+        rule = compile_rules(threshold_rules(price_value_alert=5000, bonus_percent_alert=50))
+        self.assertEqual(rule([make_offer(price=4000), make_offer(bonus_amount=5000), make_offer()]), [True, True, False])
+        self.assertEqual(threshold_rules(), [])
+
+    def test_invalid(self):
+        for rules in ([{"price": {"max": "5000"}}], [{"pirce": [1, 2]}], [{"title": "("}], [{"any": []}], [{}]):
+            with self.subTest(rules=rules), self.assertRaises(ConfigError):
+                compile_rules(rules)
+
+    def test_not_finite(self):
+        # 1e999 в JSON - inf, -price-value-alert принимает inf и nan
+        for rules in (json.loads('[{"price": {"max": 1e999}}]'), [{"bonus_amount": [float("nan"), None]}], [{"quantity": [10**400, None]}], threshold_rules(price_value_alert=float("inf"))):
+            with self.subTest(rules=rules), self.assertRaises(ConfigError):
+                compile_rules(rules)
+
+
+if __name__ == "__main__":
+    unittest.main()
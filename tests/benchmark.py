@@ -0,0 +1,148 @@
+"""Бенчмарк пропускной способности парсера на локальном сервере `tests/mock_server.py`.
+
+Для каждого движка и числа прокси парсит каталог мок-сервера и выводит
+товаров/с, запросов/с, p50/p99 задержки запросов и число ответов code 7.
+
+Запуск:
+    python -m tests.benchmark -engines threads async -proxies 1 4 8 -items 2000 -latency 0.05
+"""
+
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+from time import perf_counter
+
+from rich.console import Console
+from rich.table import Table
+
+from core.parser_url import Parser_url
+from core.parser_url_async import Parser_url_async
+from tests.mock_server import MockConfig, MockServer
+
+ENGINES = {"threads": Parser_url, "async": Parser_url_async}
+SEARCH_URL = "https://megamarket.ru/catalog/?q=mock"
+
+
+def _timed(parser_class: type[Parser_url]) -> type[Parser_url]:
+    """Подкласс парсера, запоминающий задержку каждого запроса"""
+
+    class TimedParser(parser_class):
+        def __init__(self, *args, **kwargs):
+            self.latencies: list[float] = []
+            self.latencies_lock = threading.Lock()
+            super().__init__(*args, **kwargs)
+
+        def _update_connection(self, proxy, response, response_data, rate_limited, latency):
+            with self.latencies_lock:
+                self.latencies.append(latency)
+            return super()._update_connection(proxy, response, response_data, rate_limited, latency)
+
+    return TimedParser
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(percent) - 1]
+
+
+def run_benchmark(engine: str, proxies: int, config: MockConfig, threads: int | None = None, delay: float = 0.2) -> dict:
+    """Один прогон парсера на новом мок-сервере, в отдельной временной папке с БД"""
+    work_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir, MockServer(config) as server:
+        os.chdir(temp_dir)
+        try:
+            kwargs = {}
+            if proxies > 1:
+                with open("proxies.txt", "w", encoding="utf-8") as proxy_file:
+                    proxy_file.write("\n".join(server.proxy(number) for number in range(proxies)))
+                kwargs["proxy_file_path"] = "proxies.txt"
+            parser = _timed(ENGINES[engine])(
+                SEARCH_URL,
+                threads=threads,
+                delay=delay,
+                no_cache=True,
+                log_level="WARNING",
+                api_base_url=server.api_url,
+                show_progress=False,
+                **kwargs,
+            )
+            start = perf_counter()
+            parser.parse()
+            elapsed = perf_counter() - start
+        finally:
+            os.chdir(work_dir)
+        requests_total = sum(server.api.request_counts.values())
+        return {
+            "engine": engine,
+            "proxies": proxies,
+            "threads": parser.threads,
+            "items": parser.scraped_tems_counter,
+            "requests": requests_total,
+            "throttled": server.api.throttled_count,
+            "seconds": elapsed,
+            "items_per_second": parser.scraped_tems_counter / elapsed,
+            "requests_per_second": requests_total / elapsed,
+            "latency_p50": _percentile(parser.latencies, 50),
+            "latency_p99": _percentile(parser.latencies, 99),
+        }
+
+
+def print_results(results: list[dict]) -> None:
+    table = Table(title="mmparser benchmark")
+    for column in ("движок", "прокси", "потоков", "товаров", "запросов", "code 7", "сек", "товаров/с", "запросов/с", "p50, мс", "p99, мс"):
+        table.add_column(column, justify="right")
+    for result in results:
+        table.add_row(
+            result["engine"],
+            str(result["proxies"]),
+            str(result["threads"]),
+            str(result["items"]),
+            str(result["requests"]),
+            str(result["throttled"]),
+            f"{result['seconds']:.2f}",
+            f"{result['items_per_second']:.1f}",
+            f"{result['requests_per_second']:.1f}",
+            f"{result['latency_p50'] * 1000:.1f}",
+            f"{result['latency_p99'] * 1000:.1f}",
+        )
+    Console().print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк mmparser на локальном мок-сервере")
+    parser.add_argument("-engines", nargs="+", choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument("-proxies", type=int, nargs="+", default=[1, 4, 8], help="Число прокси (клиентов мок-сервера), 1 - прямое соединение")
+    parser.add_argument("-threads", type=int, help="Количество потоков. По умолчанию: 1 на каждое соединение")
+    parser.add_argument("-delay", type=float, default=0.2, help="Начальная задержка между запросами соединения")
+    parser.add_argument("-items", type=int, default=1000, help="Товаров в выдаче")
+    parser.add_argument("-multi-offer-ratio", type=float, default=0.3, help="Доля товаров с несколькими предложениями")
+    parser.add_argument("-offers", type=int, default=5, help="Предложений у товара с несколькими предложениями")
+    parser.add_argument("-latency", type=float, default=0.02, help="Задержка ответа сервера в секундах")
+    parser.add_argument("-throttle-rate", type=float, default=0.0, help="Доля случайных ответов code 7")
+    parser.add_argument("-rate-limit", type=float, default=0.0, help="Запросов в секунду на прокси, сверх - code 7")
+    parser.add_argument("-json", type=str, help="Сохранить результаты в json файл")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        total_items=args.items,
+        multi_offer_ratio=args.multi_offer_ratio,
+        offers_per_item=args.offers,
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        rate_limit=args.rate_limit,
+    )
+    results = [run_benchmark(engine, proxies, config, args.threads, args.delay) for engine in args.engines for proxies in args.proxies]
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import threading
+import unittest
+from time import sleep, time
+from unittest import mock
+
+from core.connection_pool import ConnectionPool, load_connection_stats
+from core.models import QUARANTINE_CARRY_MAX, QUARANTINE_ERRORS, Connection
+
+
+class TestConnectionPool(unittest.TestCase):
+    """Карантин соединений с частыми ошибками"""
+
+    def _fail(self, pool: ConnectionPool, connection: Connection) -> bool:
+        """Ошибки подряд через занятое соединение, вернуть, ушло ли оно в карантин"""
+        quarantined = False
+        for _ in range(QUARANTINE_ERRORS):
+            if connection.on_error():
+                quarantined = pool.quarantine(connection)
+        pool.release(connection)
+        return quarantined
+
+    def _acquire(self, pool: ConnectionPool, timeout: float) -> Connection | None:
+        """`acquire` в отдельном потоке, None если соединение не получено за `timeout`"""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(pool.acquire()), daemon=True)
+        thread.start()
+        thread.join(timeout)
+        return result[0] if result else None
+
+    @mock.patch("core.models.QUARANTINE_BASE", 0.3)
+    def test_quarantine_and_recovery(self):
+        bad, good = Connection("bad"), Connection("good")
+        pool = ConnectionPool([bad, good])
+        self.assertIs(pool.acquire(), bad)
+        self.assertTrue(self._fail(pool, bad))
+        self.assertGreater(bad.quarantined_until, time())
+        # пока плохое соединение в карантине, выдается только хорошее
+        self.assertIs(pool.acquire(), good)
+        self.assertGreater(bad.usable_at, time())
+        pool.release(good)
+        sleep(0.3)
+        # после карантина соединение снова доступно
+        connections = {pool.acquire(), pool.acquire()}
+        self.assertEqual(connections, {bad, good})
+        bad.on_success(0.1)
+        self.assertEqual(bad.quarantine_level, 0)
+
+    @mock.patch("core.models.QUARANTINE_BASE", 60)
+    def test_all_quarantined(self):
+        first, second = Connection("first"), Connection("second")
+        pool = ConnectionPool([first, second])
+        self.assertIs(pool.acquire(), first)
+        self.assertTrue(self._fail(pool, first))
+        self.assertIs(pool.acquire(), second)
+        # последнее доступное соединение в карантин не уходит
+        self.assertFalse(self._fail(pool, second))
+        self.assertEqual(second.quarantined_until, 0)
+        self.assertIs(self._acquire(pool, 1), second)
+
+    def test_single_connection(self):
+        connection = Connection(None)
+        pool = ConnectionPool([connection])
+        self.assertIs(pool.acquire(), connection)
+        self.assertFalse(self._fail(pool, connection))
+        self.assertIs(self._acquire(pool, 1), connection)
+
+    def test_load_stats(self):
+        connections = [Connection("first"), Connection("second")]
+        stats = {
+            "first": {"quarantined_until": time() + 3600, "error_rate": 0.9},
+            "second": {"quarantined_until": time() + 100, "error_rate": 0.9},
+        }
+        with mock.patch("core.connection_pool.db_utils.load_proxy_stats", return_value=stats):
+            load_connection_stats(connections)
+        first, second = connections
+        # карантин прошлого запуска переносится не дольше QUARANTINE_CARRY_MAX
+        self.assertLessEqual(first.usable_at, time() + QUARANTINE_CARRY_MAX)
+        self.assertGreater(first.usable_at, time())
+        # все соединения в карантине, соединение с самым коротким остается доступным
+        self.assertEqual(second.quarantined_until, 0)
+        self.assertIs(self._acquire(ConnectionPool(connections), 1), second)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from core.db_utils import DbWriter
+
+
+class TestDbWriter(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "storage.sqlite")
+        with sqlite3.connect(self.filename) as sqlite_connection:
+            sqlite_connection.execute("CREATE TABLE state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _rows(self) -> dict:
+        with sqlite3.connect(self.filename) as sqlite_connection:
+            return dict(sqlite_connection.execute("SELECT key, value FROM state"))
+
+    def test_order(self):
+        writer = DbWriter(self.filename, batch_size=100, flush_interval=10)
+        insert = "INSERT INTO state (key, value) VALUES (?, ?)"
+        update = "UPDATE state SET value = ? WHERE key = ?"
+        # обновление после вставки той же строки не должно выполниться раньше нее
+        writer.execute(insert, ("a", 1))
+        writer.execute(update, (2, "a"))
+        writer.execute(insert, ("b", 1))
+        writer.execute(update, (3, "b"))
+        writer.close()
+        self.assertEqual(self._rows(), {"a": 2, "b": 3})
+        self.assertEqual(writer.rows_written, 4)
+
+    def test_error(self):
+        writer = DbWriter(self.filename, batch_size=100, flush_interval=10)
+        insert = "INSERT INTO state (key, value) VALUES (?, ?)"
+        writer.execute(insert, ("a", 1))
+        writer.execute(insert, ("a", 2))
+        writer.execute(insert, ("b", 1))
+        with self.assertLogs("rich", level="ERROR"), self.assertRaises(sqlite3.IntegrityError):
+            writer.flush()
+        # поток записи продолжает работать, ошибка поднимается один раз
+        writer.execute(insert, ("c", 1))
+        writer.close()
+        self.assertEqual(self._rows(), {"a": 1, "b": 1, "c": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,370 @@
+import cProfile
+import csv
+import glob
+import gzip
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from rich.progress import Progress
+
+from core import db_utils, export, parser_url, utils
+from core.models import ParsedOffer
+from core.parser_url import Parser_url
+from core.parser_url_async import Parser_url_async
+from tests.mock_server import MockApi, MockConfig, MockServer
+
+
+class TestMockParse(unittest.TestCase):
+    """Полный парсинг поиска на локальном мок-сервере, без сети"""
+
+    def setUp(self):
+        self.work_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.work_dir)
+        self.temp_dir.cleanup()
+
+    def _parse(self, parser_class, config: MockConfig, **kwargs) -> tuple[Parser_url, MockServer]:
+        with MockServer(config) as server:
+            with open("proxies.txt", "w", encoding="utf-8") as proxy_file:
+                proxy_file.write("\n".join(server.proxy(number) for number in range(4)))
+            parser = parser_class(
+                "https://megamarket.ru/catalog/?q=mock",
+                proxy_file_path="proxies.txt",
+                delay=0.2,
+                error_delay=0.2,
+                no_cache=True,
+                log_level="WARNING",
+                api_base_url=server.api_url,
+                show_progress=False,
+                **kwargs,
+            )
+            parser.parse()
+        return parser, server
+
+    def _expected_offers(self, server: MockServer) -> int:
+        config = server.api.config
+        available_items = config.total_items if config.available_items is None else config.available_items
+        return sum(config.offers_per_item if server.api._is_multi_offer(index) else 1 for index in range(available_items))
+
+    def test_parse(self):
+        for parser_class in (Parser_url, Parser_url_async):
+            with self.subTest(engine=parser_class.__name__):
+                config = MockConfig(total_items=100, available_items=70, latency=0.005, latency_jitter=0)
+                parser, server = self._parse(parser_class, config)
+                expected = self._expected_offers(server)
+                self.assertEqual(parser.scraped_tems_counter, expected)
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    rows = sqlite_connection.execute("SELECT COUNT(*) FROM offers WHERE job_id = ?", (parser.job_id,)).fetchone()[0]
+                self.assertEqual(rows, expected)
+
+    def test_redirect(self):
+        for parser_class in (Parser_url, Parser_url_async):
+            with self.subTest(engine=parser_class.__name__):
+                config = MockConfig(total_items=50, redirect=True, latency=0.002, latency_jitter=0)
+                parser, server = self._parse(parser_class, config, job_name=f"redirect_{parser_class.__name__}")
+                self.assertEqual(parser.url, "https://megamarket.ru/catalog/mock/")
+                self.assertEqual(parser.scraped_tems_counter, self._expected_offers(server))
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    jobs = sqlite_connection.execute("SELECT id, completed IS NOT NULL FROM jobs WHERE name = ?", (parser.job_name,)).fetchall()
+                # редирект продолжает ту же задачу, незавершенной записи задачи не остается
+                self.assertEqual(jobs, [(parser.job_id, 1)])
+
+    def test_resume(self):
+        for parser_class in (Parser_url, Parser_url_async):
+            with self.subTest(engine=parser_class.__name__):
+                job_name = f"resume_{parser_class.__name__}"
+                config = MockConfig(total_items=440, page_limit=44, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+                save_page_checkpoint = Parser_url._save_page_checkpoint
+                checkpoints = []
+
+                def stop_after_pages(parser, page, parse_next_page):
+                    save_page_checkpoint(parser, page, parse_next_page)
+                    checkpoints.append(page)
+                    if len(checkpoints) == 3:
+                        parser.stop()
+
+                with mock.patch.object(Parser_url, "_save_page_checkpoint", stop_after_pages):
+                    parser, server = self._parse(parser_class, config, job_name=job_name)
+                self.assertTrue(parser.stop_event.is_set())
+                first_job_id = parser.job_id
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    done_pages = sqlite_connection.execute("SELECT COUNT(*) FROM page_checkpoints WHERE job_id = ?", (first_job_id,)).fetchone()[0]
+                    first_rows = sqlite_connection.execute("SELECT COUNT(*) FROM offers WHERE job_id = ?", (first_job_id,)).fetchone()[0]
+                self.assertGreaterEqual(done_pages, 3)
+                self.assertLess(done_pages, 10)
+                self.assertLess(first_rows, 440)
+
+                parser, server = self._parse(parser_class, config, job_name=job_name, resume=True)
+                self.assertEqual(parser.job_id, first_job_id)
+                # спаршенные до остановки страницы не запрашиваются повторно
+                self.assertEqual(parser.scraped_tems_counter, 440 - first_rows)
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    jobs = sqlite_connection.execute("SELECT id, completed IS NOT NULL FROM jobs WHERE name = ?", (job_name,)).fetchall()
+                    pages = sqlite_connection.execute("SELECT COUNT(*) FROM page_checkpoints WHERE job_id = ?", (first_job_id,)).fetchone()[0]
+                    rows = sqlite_connection.execute("SELECT COUNT(DISTINCT goods_id), COUNT(*) FROM offers WHERE job_id = ?", (first_job_id,)).fetchone()
+                self.assertEqual(jobs, [(first_job_id, 1)])
+                self.assertEqual(pages, 10)
+                self.assertEqual(rows, (440, 440))
+
+    def test_availability_boundary(self):
+        for parser_class in (Parser_url, Parser_url_async):
+            with self.subTest(engine=parser_class.__name__):
+                # 50 страниц выдачи, товары в наличии только на первых трех
+                config = MockConfig(total_items=2200, available_items=130, page_limit=44, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+                parser, server = self._parse(parser_class, config)
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    pages = sqlite_connection.execute('SELECT "offset", parse_next FROM page_checkpoints WHERE job_id = ? ORDER BY "offset"', (parser.job_id,)).fetchall()
+                    rows = sqlite_connection.execute("SELECT COUNT(*) FROM offers WHERE job_id = ?", (parser.job_id,)).fetchone()[0]
+                self.assertEqual(pages, [(0, 1), (44, 1), (88, 0)])
+                self.assertEqual(rows, 130)
+                # граница наличия ищется запросами по одному товару, страницы после нее не запрашиваются
+                self.assertLess(server.api.request_counts["catalogService/catalog/search"], 15)
+
+    def test_merchant_inns(self):
+        # свежий файл черного списка не скачивается заново, продавец 3 в нем
+        with open(utils.BLACKLIST_FILE, "w", encoding="utf-8") as blacklist_file:
+            blacklist_file.write("7700001003")
+        config = MockConfig(total_items=100, merchants=50, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+        parser, server = self._parse(Parser_url, config, use_merchant_blacklist=True)
+        self.assertEqual(server.api.request_counts["partnerService/merchant/legalInfo/get"], 50)
+        with sqlite3.connect("storage.sqlite") as sqlite_connection:
+            merchants = dict(sqlite_connection.execute("SELECT merchant_id, inn FROM merchants"))
+            rows = sqlite_connection.execute("SELECT COUNT(*), SUM(merchant_id = '1003') FROM offers WHERE job_id = ?", (parser.job_id,)).fetchone()
+        self.assertEqual(len(merchants), 50)
+        self.assertEqual(merchants["1003"], "7700001003")
+        self.assertEqual(rows, (98, 0))
+        # ИНН продавцов берутся из БД, повторно не запрашиваются
+        parser, server = self._parse(Parser_url, config, use_merchant_blacklist=True)
+        self.assertNotIn("partnerService/merchant/legalInfo/get", server.api.request_counts)
+        self.assertEqual(parser.scraped_tems_counter, 98)
+
+    def test_offers_max_age(self):
+        config = MockConfig(total_items=100, multi_offer_ratio=0.3, offers_per_item=5, latency=0.002, latency_jitter=0)
+        multi_offer_items = sum(1 for index in range(100) if MockApi(config)._is_multi_offer(index))
+        parser, server = self._parse(Parser_url, config, job_name="incremental", storage_mode="changes", offers_max_age=1)
+        self.assertEqual(server.api.request_counts["catalogService/productOffers/get"], multi_offer_items)
+        offer_state = self._offer_state("incremental")
+        with sqlite3.connect("storage.sqlite") as sqlite_connection:
+            listing_state = sqlite_connection.execute("SELECT COUNT(*) FROM listing_state WHERE job_name = 'incremental'").fetchone()[0]
+        self.assertEqual(listing_state, multi_offer_items)
+        self.assertEqual(offer_state, (self._expected_offers(server), 0))
+        # выдача не изменилась: предложения не запрашиваются, прошлые предложения не считаются пропавшими
+        parser, server = self._parse(Parser_url, config, job_name="incremental", storage_mode="changes", offers_max_age=1)
+        self.assertNotIn("catalogService/productOffers/get", server.api.request_counts)
+        self.assertEqual(parser.skipped_offers_counter, multi_offer_items)
+        self.assertEqual(parser.changed_offers_counter, 0)
+        self.assertEqual(self._offer_state("incremental"), offer_state)
+
+    def test_export(self):
+        config = MockConfig(total_items=60, multi_offer_ratio=0.3, latency=0.002, latency_jitter=0)
+        self._parse(Parser_url, config, job_name="other")
+        parser, server = self._parse(Parser_url, config, job_name="export")
+        with sqlite3.connect("storage.sqlite") as sqlite_connection:
+            expected = sorted(sqlite_connection.execute("SELECT goods_id, merchant_id, price FROM offers WHERE job_id = ?", (parser.job_id,)))
+        self.assertEqual(len(expected), self._expected_offers(server))
+        formats = [("csv", None, "offers.csv"), ("jsonl", "gzip", "offers.jsonl.gz")]
+        if export._has_pyarrow:
+            formats.append(("parquet", "snappy", "offers.parquet"))
+        for export_format, compression, path in formats:
+            with self.subTest(export_format=export_format):
+                # маленькие пачки, чтобы выгрузка шла в несколько чтений из БД
+                rows_total = export.export_offers(path, export_format, compression, job_name="export", chunk_size=7)
+                self.assertEqual(rows_total, len(expected))
+                if export_format == "csv":
+                    with open(path, encoding="utf-8", newline="") as csv_file:
+                        rows = list(csv.DictReader(csv_file))
+                    self.assertEqual(list(rows[0]), list(db_utils.EXPORT_COLUMNS))
+                elif export_format == "jsonl":
+                    with gzip.open(path, "rt", encoding="utf-8") as jsonl_file:
+                        rows = [json.loads(line) for line in jsonl_file]
+                else:
+                    rows = export.pyarrow.parquet.read_table(path).to_pylist()
+                self.assertEqual({row["job_name"] for row in rows}, {"export"})
+                self.assertEqual(sorted((str(row["goods_id"]), str(row["merchant_id"]), float(row["price"])) for row in rows), expected)
+
+    def test_crawl_error_cleanup(self):
+        for parser_class in (Parser_url, Parser_url_async):
+            with self.subTest(engine=parser_class.__name__):
+                parsers = []
+
+                def fail(parser, *args):
+                    parsers.append(parser)
+                    raise RuntimeError("ошибка окна страниц")
+
+                config = MockConfig(total_items=100, latency=0.002, latency_jitter=0)
+                with (
+                    mock.patch.object(Parser_url, "_page_finished", fail),
+                    mock.patch.object(Progress, "stop", autospec=True, side_effect=Progress.stop) as progress_stop,
+                ):
+                    with self.assertRaises(RuntimeError):
+                        self._parse(parser_class, config)
+                # пулы потоков закрыты и полоса прогресса остановлена и после ошибки
+                progress_stop.assert_called_once()
+                if parser_class is Parser_url:
+                    self.assertTrue(parsers[0].offers_executor._shutdown)
+                    self.assertTrue(parsers[0].merchant_executor._shutdown)
+                # остается только общая полоса, полосы страниц убраны
+                self.assertEqual(len(parsers[0].rich_progress.task_ids), 1)
+
+    def test_crawl_error_flush(self):
+        parsers = []
+
+        def fail(parser, *args):
+            parsers.append(parser)
+            raise RuntimeError("ошибка окна страниц")
+
+        config = MockConfig(total_items=100, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+        with mock.patch.object(Parser_url, "_page_finished", fail), self.assertRaises(RuntimeError):
+            self._parse(Parser_url, config, metrics_dir="metrics")
+        parser = parsers[0]
+        # очередь записи дописана, сессии закрыты и сводка метрик сохранена и после ошибки
+        self.assertFalse(parser.db_writer.thread.is_alive())
+        self.assertEqual(parser.session_pool.sessions, {})
+        self.assertTrue(glob.glob(os.path.join("metrics", "*.json")))
+        with sqlite3.connect("storage.sqlite") as sqlite_connection:
+            rows = sqlite_connection.execute("SELECT COUNT(*) FROM offers WHERE job_id = ?", (parser.job_id,)).fetchone()[0]
+        self.assertGreaterEqual(rows, 44)
+
+    def test_notify_repeat_timeout(self):
+        with mock.patch("core.parser_url.validate_tg_credentials", return_value=True):
+            parser = Parser_url("https://megamarket.ru/catalog/?q=mock", tg_config="token$chat", alert_repeat_timeout=1, log_level="WARNING", db_writer=mock.Mock())
+        parser.notification_queue = mock.Mock()
+        parsed_offer = ParsedOffer("Товар", "https://megamarket.ru/1", "", 1000, 700, 300, 1, "1", "", "2", "Продавец")
+        with mock.patch("core.parser_url.time", return_value=1000.0) as clock:
+            self.assertTrue(parser._notify(parsed_offer))
+            # повтор в пределах alert_repeat_timeout не отправляется
+            clock.return_value += 3600
+            self.assertFalse(parser._notify(parsed_offer))
+            # другое предложение того же товара отправляется сразу
+            self.assertTrue(parser._notify(ParsedOffer("Товар", "https://megamarket.ru/1", "", 900, 600, 300, 1, "1", "", "2", "Продавец")))
+            # после таймаута о предложении уведомляют снова
+            clock.return_value += 1
+            self.assertTrue(parser._notify(parsed_offer))
+            # уведомление, не попавшее в переполненную очередь, не запоминается
+            parser.notification_queue.put.return_value = False
+            clock.return_value += 3601
+            self.assertFalse(parser._notify(parsed_offer))
+            parser.notification_queue.put.return_value = True
+            self.assertTrue(parser._notify(parsed_offer))
+        self.assertEqual(parser.notification_queue.put.call_count, 5)
+        self.assertEqual(parser.db_writer.execute.call_count, 4)
+
+    def test_session_reuse(self):
+        handshakes = {}
+
+        def save_connection_stats(connections, *args):
+            for connection in connections:
+                handshakes[connection.proxy_string] = (connection.handshake_count, connection.success_count)
+            return save_stats(connections, *args)
+
+        save_stats = parser_url.save_connection_stats
+        config = MockConfig(total_items=400, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+        with (
+            mock.patch.object(parser_url, "save_connection_stats", save_connection_stats),
+            mock.patch.object(Parser_url, "_new_session", autospec=True, side_effect=Parser_url._new_session) as new_session,
+        ):
+            self._parse(Parser_url, config)
+        # одна сессия на соединение, соединение с сервером открывается один раз на прокси за весь запуск
+        self.assertEqual(new_session.call_count, 4)
+        self.assertEqual(len(handshakes), 4)
+        for handshake_count, success_count in handshakes.values():
+            self.assertGreater(success_count, 1)
+            self.assertEqual(handshake_count, 1)
+
+    def test_parse_throttled(self):
+        config = MockConfig(total_items=60, available_items=60, latency=0.005, latency_jitter=0, throttle_rate=0.5)
+        parser, server = self._parse(Parser_url, config)
+        self.assertGreater(server.api.throttled_count, 0)
+        self.assertEqual(parser.scraped_tems_counter, self._expected_offers(server))
+
+    def test_page_limit(self):
+        for reject_over_limit in (False, True):
+            with self.subTest(reject_over_limit=reject_over_limit):
+                config = MockConfig(total_items=1000, page_limit=100, reject_over_limit=reject_over_limit, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+                parser, server = self._parse(Parser_url, config)
+                self.assertEqual(parser.page_limit, 100)
+                self.assertEqual(parser.scraped_tems_counter, self._expected_offers(server))
+                # 10 страниц и проверка наличия последнего товара, отклоненные размеры проверяются до 3 раз
+                self.assertEqual(server.api.request_counts["catalogService/catalog/search"], 14 if reject_over_limit else 11)
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    page_limits = sqlite_connection.execute("SELECT DISTINCT page_limit FROM page_checkpoints WHERE job_id = ?", (parser.job_id,)).fetchall()
+                    cached = sqlite_connection.execute("SELECT response FROM api_cache WHERE key = ?", (parser._page_limit_cache_key(),)).fetchone()
+                    rows = sqlite_connection.execute("SELECT COUNT(*) FROM offers WHERE job_id = ?", (parser.job_id,)).fetchone()[0]
+                # найденный размер страницы сохранен в кэше и в отметках страниц для -resume
+                self.assertEqual(page_limits, [(100,)])
+                self.assertEqual(json.loads(cached[0]), {"limit": 100})
+                self.assertEqual(rows, 1000)
+
+    def test_shards(self):
+        for parser_class in (Parser_url, Parser_url_async):
+            with self.subTest(engine=parser_class.__name__):
+                config = MockConfig(total_items=600, available_items=500, offset_cap=200, page_limit=100, multi_offer_ratio=0, latency=0.002, latency_jitter=0)
+                parser, server = self._parse(parser_class, config, shard_size=150)
+                self.assertEqual(parser.scraped_tems_counter, self._expected_offers(server))
+                with sqlite3.connect("storage.sqlite") as sqlite_connection:
+                    rows = sqlite_connection.execute("SELECT COUNT(DISTINCT goods_id), COUNT(*) FROM offers WHERE job_id = ?", (parser.job_id,)).fetchone()
+                    shards = sqlite_connection.execute("SELECT COUNT(DISTINCT shard), MIN(shard), MAX(\"offset\") FROM page_checkpoints WHERE job_id = ?", (parser.job_id,)).fetchone()
+                self.assertEqual(rows, (500, 500))
+                # выдача больше offset_cap парсится по диапазонам цен, каждый диапазон не доходит до offset_cap
+                self.assertGreater(shards[0], 1)
+                self.assertNotEqual(shards[1], "")
+                self.assertLess(shards[2], 200)
+
+    def test_profile(self):
+        class BusyProfile(cProfile.Profile):
+            def enable(self, *args, **kwargs):
+                raise ValueError("Another profiling tool is already active")
+
+        # по потоку на прокси, cProfile в каждом потоке до 3.12, общий с 3.12, занят другим инструментом
+        cases = {
+            "per_thread": mock.patch("core.profiling.PROCESS_WIDE_PROFILE", False),
+            "process_wide": mock.patch("core.profiling.PROCESS_WIDE_PROFILE", True),
+            "busy": mock.patch("core.profiling.cProfile.Profile", BusyProfile),
+        }
+        for case, patch in cases.items():
+            with self.subTest(case=case), patch:
+                config = MockConfig(total_items=200, available_items=150, page_limit=44, latency=0.002, latency_jitter=0)
+                parser, server = self._parse(Parser_url, config, profile_dir=case)
+                self.assertGreater(parser.threads, 1)
+                self.assertEqual(parser.scraped_tems_counter, self._expected_offers(server))
+                self.assertTrue(glob.glob(os.path.join(case, "*.collapsed")))
+                self.assertEqual(bool(glob.glob(os.path.join(case, "*.pstats"))), case != "busy")
+
+    def _offer_state(self, job_name: str) -> tuple[int, int]:
+        with sqlite3.connect("storage.sqlite") as sqlite_connection:
+            return sqlite_connection.execute(
+                "SELECT COUNT(*), COUNT(disappeared_at) FROM offer_state WHERE job_name = ?", (job_name,)
+            ).fetchone()
+
+    def test_changes_storage(self):
+        def run(**config) -> tuple[Parser_url, MockServer]:
+            config = MockConfig(total_items=132, multi_offer_ratio=0, latency=0.002, latency_jitter=0, **config)
+            return self._parse(Parser_url, config, job_name="changes", storage_mode="changes")
+
+        parser, server = run(available_items=132)
+        self.assertEqual(parser.changed_offers_counter, 132)
+        self.assertEqual(self._offer_state("changes"), (132, 0))
+        # вторая страница не парсится, ее предложения не считаются пропавшими
+        parser, server = run(available_items=132, broken_offsets=(44,))
+        self.assertEqual(parser.failed_pages, 1)
+        self.assertEqual(parser.changed_offers_counter, 0)
+        self.assertEqual(self._offer_state("changes"), (132, 0))
+        # 32 товара больше не в наличии
+        parser, server = run(available_items=100)
+        self.assertEqual(parser.failed_pages, 0)
+        self.assertEqual(self._offer_state("changes"), (132, 32))
+        with sqlite3.connect("storage.sqlite") as sqlite_connection:
+            rows = sqlite_connection.execute("SELECT COUNT(*) FROM offers JOIN jobs ON jobs.id = offers.job_id WHERE jobs.name = 'changes'").fetchone()[0]
+        # строки истории пишутся только при первом появлении предложения
+        self.assertEqual(rows, 132)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""Бенчмарк времени запуска mmparser.
+
+Каждый сценарий запускается в новом интерпретаторе несколько раз, выводится медиана и минимум
+времени и какие тяжелые модули были импортированы. Проверка новой версии отключена.
+
+Запуск:
+    python -m tests.startup_benchmark -runs 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# модули, которые не должны импортироваться без необходимости
+HEAVY_MODULES = ("InquirerPy", "rich_argparse", "lxml", "pkg_resources", "packaging", "curl_cffi", "core.parser_url", "core.daemon", "core.export")
+
+SCENARIOS = {
+    "import": "import core.main",
+    "help": "import sys; from core.main import main; sys.argv = ['mmparser', '-h']; main()",
+    "export help": "import sys; from core.main import main; sys.argv = ['mmparser', 'export', '-h']; main()",
+    "parser": "import core.main; from core.main import get_parser_class; get_parser_class('threads')",
+}
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+try:
+    exec({code!r})
+except SystemExit:
+    pass
+seconds = time.perf_counter() - start
+print({marker!r} + __import__("json").dumps({{"seconds": seconds, "modules": sorted(name for name in {heavy!r} if name in sys.modules)}}))
+"""
+MARKER = "@@startup@@"
+
+
+def measure(code: str) -> dict:
+    """Запустить код в новом интерпретаторе, вернуть время импорта и выполнения и загруженные тяжелые модули"""
+    env = {**os.environ, "MMPARSER_NO_VERSION_CHECK": "1"}
+    probe = PROBE.format(code=code, marker=MARKER, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", probe], cwd=ROOT, env=env, capture_output=True, text=True, encoding="utf-8", check=True).stdout
+    line = next(line for line in output.splitlines() if line.startswith(MARKER))
+    return json.loads(line[len(MARKER) :])
+
+
+def run_benchmark(scenario: str, runs: int) -> dict:
+    results = [measure(SCENARIOS[scenario]) for _ in range(runs)]
+    seconds = [result["seconds"] for result in results]
+    return {
+        "scenario": scenario,
+        "median": statistics.median(seconds),
+        "min": min(seconds),
+        "modules": results[-1]["modules"],
+    }
+
+
+def print_results(results: list[dict]) -> None:
+    table = Table(title="Запуск mmparser")
+    for column in ("Сценарий", "Медиана, мс", "Мин, мс", "Тяжелые модули"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(result["scenario"], f"{result['median'] * 1000:.1f}", f"{result['min'] * 1000:.1f}", ", ".join(result["modules"]) or "-")
+    Console().print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк времени запуска mmparser")
+    parser.add_argument("-scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("-runs", type=int, default=10, help="Запусков каждого сценария")
+    parser.add_argument("-json", type=str, help="Сохранить результаты в json файл")
+    args = parser.parse_args()
+
+    results = [run_benchmark(scenario, max(1, args.runs)) for scenario in args.scenarios]
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from curl_cffi import requests
+
+from core import main as cli, utils
+from core.models import SHARD_SIZE
+from tests.startup_benchmark import measure, SCENARIOS
+
+
+class TestStartup(unittest.TestCase):
+    """Тяжелые модули не импортируются при запуске, см. `tests/startup_benchmark.py`"""
+
+    def test_import(self):
+        self.assertEqual(measure(SCENARIOS["import"])["modules"], [])
+
+    def test_help(self):
+        # справка не импортирует парсер и curl_cffi
+        self.assertEqual(measure(SCENARIOS["help"])["modules"], ["rich_argparse"])
+
+    def test_export_help(self):
+        self.assertEqual(measure(SCENARIOS["export help"])["modules"], ["core.export", "rich_argparse"])
+
+    def test_parser(self):
+        modules = measure(SCENARIOS["parser"])["modules"]
+        self.assertIn("core.parser_url", modules)
+        for module in ("InquirerPy", "rich_argparse", "lxml", "pkg_resources", "packaging", "core.daemon", "core.export"):
+            self.assertNotIn(module, modules)
+
+    def test_failed_version_check(self):
+        work_dir = os.getcwd()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.chdir(temp_dir)
+            try:
+                with mock.patch.object(requests, "get", side_effect=requests.RequestsError("timeout")) as get:
+                    self.assertIsNone(utils.get_latest_version("mmparser"))
+                    # ошибка запомнена на UPDATE_INTERVAL, GitHub не запрашивается повторно
+                    self.assertIsNone(utils.get_latest_version("mmparser"))
+                self.assertEqual(get.call_count, 1)
+                self.assertTrue(os.path.exists(utils.VERSION_CHECK_FILE))
+            finally:
+                os.chdir(work_dir)
+
+    def test_shard_args(self):
+        url = "https://megamarket.ru/catalog/?q=mock"
+        for argv, shard_size in ((["-shard", url], SHARD_SIZE), ([url, "-shard-size", "500"], 500), ([url], 0)):
+            with self.subTest(argv=argv):
+                with (
+                    mock.patch.object(sys, "argv", ["mmparser", *argv, "-no-version-check"]),
+                    mock.patch.object(cli, "print_logo"),
+                    mock.patch.object(cli, "get_parser_class") as get_parser_class,
+                ):
+                    cli.main()
+                # url после -shard не принимается за размер диапазона
+                kwargs = get_parser_class.return_value.call_args.kwargs
+                self.assertEqual((kwargs["url"], kwargs["shard_size"]), (url, shard_size))
+
+
+if __name__ == "__main__":
+    unittest.main()
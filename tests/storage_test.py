@@ -0,0 +1,77 @@
+import functools
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from core import db_utils
+
+LEGACY_TABLE = """
+    CREATE TABLE "{name}" (
+        "goods_id" TEXT, "merchant_id" TEXT, "url" TEXT, "title" TEXT, "price" INTEGER, "price_bonus" INTEGER,
+        "bonus_amount" INTEGER, "bonus_percent" INTEGER, "available_quantity" INTEGER, "delivery_date" TEXT,
+        "merchant_name" TEXT, "merchant_rating" FLOAT, "scraped_at" DATETIME, "notified" BOOL
+    )
+"""
+
+
+class TestStorage(unittest.TestCase):
+    """Схема БД и миграции, без сети"""
+
+    def setUp(self):
+        self.work_dir = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.work_dir)
+        self.temp_dir.cleanup()
+
+    def test_legacy_migration(self):
+        # БД старой версии: таблица jobs и таблица на каждый запуск
+        with sqlite3.connect(db_utils.FILENAME) as sqlite_connection:
+            sqlite_connection.execute('CREATE TABLE "jobs" ("id" INTEGER PRIMARY KEY AUTOINCREMENT, "name" TEXT, "started" DATETIME, "completed" DATETIME)')
+            sqlite_connection.execute("INSERT INTO jobs (name, started) VALUES ('phones', '2024-01-01 10:00:00')")
+            sqlite_connection.execute(LEGACY_TABLE.format(name="phones_1"))
+            sqlite_connection.executemany(
+                'INSERT INTO "phones_1" VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    ("100", "1", "https://megamarket.ru/100", "Телефон", 1000, 900, 100, 10, 3, "2024-01-02", "Продавец", 4.5, "2024-01-01 10:00:00", 0),
+                    ("100", "2", "https://megamarket.ru/100", "Телефон", 1100, 1000, 100, 9, 1, "2024-01-02", "Продавец 2", None, "2024-01-01 10:00:00", 1),
+                    (None, "3", "https://megamarket.ru/x", "Без товара", 500, 500, 0, 0, 1, "2024-01-02", "Продавец 3", None, "2024-01-01 10:00:00", 0),
+                ],
+            )
+        with self.assertLogs("rich", level="WARNING"):
+            db_utils.create_db()
+        new_job_id = db_utils.new_job("phones")
+
+        with sqlite3.connect(db_utils.FILENAME) as sqlite_connection:
+            offers = sqlite_connection.execute("SELECT job_id, goods_id, merchant_id, price FROM offers ORDER BY merchant_id").fetchall()
+            view_rows = sqlite_connection.execute('SELECT merchant_id, title FROM "phones_1" ORDER BY merchant_id').fetchall()
+            orphans = sqlite_connection.execute("SELECT job_id, merchant_id, title FROM legacy_orphan_offers").fetchall()
+            objects = dict(sqlite_connection.execute("SELECT name, type FROM sqlite_master WHERE name LIKE 'phones_%'").fetchall())
+            notifications = sqlite_connection.execute("SELECT goods_id, merchant_id FROM notifications").fetchall()
+        self.assertEqual(offers, [(1, "100", "1", 1000), (1, "100", "2", 1100)])
+        self.assertEqual(view_rows, [("1", "Телефон"), ("2", "Телефон")])
+        self.assertEqual(orphans, [(1, "3", "Без товара")])
+        # представление только у перенесенной таблицы, у нового запуска его нет
+        self.assertEqual(objects, {"phones_1": "view"})
+        self.assertNotEqual(new_job_id, 1)
+        self.assertEqual(notifications, [("100", "2")])
+
+    def test_api_cache_locked(self):
+        db_utils.create_db()
+        connect = functools.partial(sqlite3.connect, timeout=0.1)
+        with sqlite3.connect(db_utils.FILENAME) as writer_connection:
+            # долгая транзакция писателя держит блокировку записи
+            writer_connection.execute("BEGIN IMMEDIATE")
+            with mock.patch.object(db_utils.sqlite3, "connect", connect), self.assertLogs("rich", "WARNING"):
+                db_utils.save_api_cache("key", {"limit": 100}, 1000, 60)
+        self.assertIsNone(db_utils.load_api_cache("key", 1000))
+        db_utils.save_api_cache("key", {"limit": 100}, 1000, 60)
+        self.assertEqual(db_utils.load_api_cache("key", 1000), {"limit": 100})
+
+
+if __name__ == "__main__":
+    unittest.main()
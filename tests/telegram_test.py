@@ -0,0 +1,50 @@
+import logging
+import re
+import unittest
+from unittest import mock
+
+from core import telegram
+from core.telegram import TelegramClient, split_digest, validate_tg_credentials
+
+
+def is_balanced(message: str) -> bool:
+    """Все открытые теги закрыты, сущности не оборваны"""
+    tags = re.findall(r"<(/?)(\w+)[^>]*>", message)
+    opened = [name for closing, name in tags if not closing]
+    closed = [name for closing, name in tags if closing]
+    return sorted(opened) == sorted(closed) and "<" not in re.sub(r"<[^>]*>", "", message) and not re.search(r"&[^;\s]*$", message)
+
+
+class TestTelegram(unittest.TestCase):
+    def test_split_digest(self):
+        message = '🛍 <b>Товар:</b> <a href="https://megamarket.ru/1">Товар &amp; чехол</a>\n💰 <b>Цена:</b> 1000₽\n🟢 <b>Бонусы:</b> 300'
+        digests = split_digest([message] * 5, limit=len(message) * 2 + 2)
+        self.assertEqual(digests, [f"{message}\n\n{message}"] * 2 + [message])
+        # сообщение длиннее лимита обрезается по строкам
+        for limit in range(20, len(message)):
+            for digest in split_digest([message], limit=limit):
+                self.assertLessEqual(len(digest), limit)
+                self.assertTrue(is_balanced(digest), digest)
+
+    def test_validate_caches_success(self):
+        responses = [mock.Mock(ok=False), mock.Mock(ok=True), mock.Mock(ok=True)]
+        with mock.patch.object(telegram.requests, "get", side_effect=responses) as get:
+            self.assertFalse(validate_tg_credentials("token$chat"))
+            # ошибка не кэшируется, повторная проверка снова идет в api
+            self.assertTrue(validate_tg_credentials("token$chat"))
+            self.assertTrue(validate_tg_credentials("token$chat"))
+        self.assertEqual(get.call_count, 3)
+        telegram._valid_tg_configs.discard("token$chat")
+
+    def test_retry_not_json(self):
+        client = TelegramClient("token$chat", logging.getLogger("test"))
+        throttled = mock.Mock(status_code=429)
+        throttled.json.side_effect = ValueError("not json")
+        sent = mock.Mock(status_code=200)
+        with mock.patch.object(client.session, "post", side_effect=[throttled, sent]) as post, mock.patch.object(telegram, "sleep"):
+            self.assertTrue(client.notify("сообщение"))
+        self.assertEqual(post.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()